@@ -0,0 +1,97 @@
+from typing import Dict
+from fastapi import APIRouter, HTTPException
+from fastapi import Depends
+import bson
+import crud
+import schemas
+import models
+import jobs
+from depends import get_db, authorize, get_query_params
+
+router = APIRouter(dependencies=[Depends(get_db)])
+
+# Batches API
+# schedule payroll runs for computations across companies
+@router.post("/",
+            response_model=schemas.BatchInDB,
+            tags=["Batches"],
+            status_code=202
+        )
+async def create_batch(
+            batch_create: schemas.BatchCreate,
+            user: models.User = Depends(authorize(perm="create_computations"))
+        ):
+    computations = []
+    for entry in batch_create.computations:
+        company_db = await crud.get_obj_or_404(model=models.Company, id=entry.company_id)
+        computation_db = models.Computation.objects.filter(id=bson.ObjectId(entry.computation_id),company=company_db).first()
+        if not computation_db:
+            raise HTTPException(status_code=404,detail={
+                "message":f"Computation {entry.computation_id} not found in the company"
+            })
+        computations.append((computation_db, entry.deadline))
+    params = batch_create.model_dump(exclude_none=True, exclude={"name", "computations"})
+    try:
+        batch_db = jobs.submit_batch(batch_create.name, user, computations, params)
+    except ValueError as e:
+        raise HTTPException(status_code=409,detail={
+            "message": f"{e}"
+        })
+    return batch_db.to_dict()
+
+@router.get("/",
+            response_model=schemas.ListResponse,
+            tags=["Batches"],
+            status_code=200
+        )
+async def get_batches(
+            params: Dict = Depends(get_query_params),
+            _: models.User = Depends(authorize(perm="read_computations"))
+        ) -> schemas.ListResponse:
+    return await crud.paginate(model=models.Batch, schema=schemas.BatchInDB, **params)
+
+@router.get("/{batch_id}",
+            response_model=schemas.BatchInDB,
+            tags=["Batches"],
+            status_code=200
+        )
+async def get_batch(
+            batch_id: str,
+            _: models.User = Depends(authorize(perm="read_computations"))
+        ):
+    batch_db = await get_batch_or_404(batch_id)
+    return batch_db.to_dict()
+
+@router.get("/{batch_id}/progress",
+            response_model=schemas.BatchProgress,
+            tags=["Batches"],
+            status_code=200
+        )
+async def get_batch_progress(
+            batch_id: str,
+            _: models.User = Depends(authorize(perm="read_computations"))
+        ):
+    batch_db = await get_batch_or_404(batch_id)
+    return batch_db.progress()
+
+@router.get("/{batch_id}/jobs",
+            response_model=schemas.ListResponse,
+            tags=["Batches"],
+            status_code=200
+        )
+async def get_batch_jobs(
+            batch_id: str,
+            params: Dict = Depends(get_query_params),
+            _: models.User = Depends(authorize(perm="read_computations"))
+        ) -> schemas.ListResponse:
+    batch_db = await get_batch_or_404(batch_id)
+    params['batch'] = batch_db
+    return await crud.paginate(model=models.Job, schema=schemas.JobInDB, **params)
+
+async def get_batch_or_404(batch_id: str) -> models.Batch:
+    batch_db = models.Batch.objects.filter(id=bson.ObjectId(batch_id)).first()
+    if not batch_db:
+        raise HTTPException(status_code=404,detail={
+            "message":"Batch not found"
+        })
+    return batch_db
@@ -0,0 +1,80 @@
+from typing import Dict
+from fastapi import APIRouter, HTTPException
+from fastapi import Depends
+from fastapi.responses import FileResponse
+import bson
+import os
+import crud
+import schemas
+import models
+from depends import get_db, authorize, get_query_params
+
+router = APIRouter(dependencies=[Depends(get_db)])
+
+# Jobs API
+@router.get("/",
+            response_model=schemas.ListResponse,
+            tags=["Jobs"],
+            status_code=200
+        )
+async def get_jobs(
+            params: Dict = Depends(get_query_params),
+            _: models.User = Depends(authorize(perm="read_computations"))
+        ) -> schemas.ListResponse:
+    return await crud.paginate(model=models.Job, schema=schemas.JobInDB, **params)
+
+@router.get("/{job_id}",
+            response_model=schemas.JobInDB,
+            tags=["Jobs"],
+            status_code=200
+        )
+async def get_job(
+            job_id: str,
+            _: models.User = Depends(authorize(perm="read_computations"))
+        ):
+    job_db = await get_job_or_404(job_id)
+    return job_db.to_dict()
+
+@router.get("/{job_id}/progress",
+            response_model=schemas.JobProgress,
+            tags=["Jobs"],
+            status_code=200
+        )
+async def get_job_progress(
+            job_id: str,
+            _: models.User = Depends(authorize(perm="read_computations"))
+        ):
+    job_db = await get_job_or_404(job_id)
+    return schemas.JobProgress(
+        id=str(job_db.id),
+        status=job_db.status,
+        processed=job_db.processed,
+        total=job_db.total,
+        percent=job_db.percent
+    )
+
+@router.get("/{job_id}/errors",
+            tags=["Jobs"],
+            status_code=200
+        )
+async def get_job_errors(
+            job_id: str,
+            _: models.User = Depends(authorize(perm="read_computations"))
+        ):
+    """
+        Download the report of every invalid cell of an import job's upload
+    """
+    job_db = await get_job_or_404(job_id)
+    if not job_db.error_report or not os.path.exists(job_db.error_report):
+        raise HTTPException(status_code=404,detail={
+            "message":"The job has no error report"
+        })
+    return FileResponse(job_db.error_report, media_type="text/csv", filename=f"{job_db.kind}-{job_db.id}-errors.csv")
+
+async def get_job_or_404(job_id: str) -> models.Job:
+    job_db = models.Job.objects.filter(id=bson.ObjectId(job_id)).first()
+    if not job_db:
+        raise HTTPException(status_code=404,detail={
+            "message":"Job not found"
+        })
+    return job_db
@@ -4,6 +4,7 @@ from fastapi import Depends
 import crud
 import schemas
 import models
+import engine
 from depends import get_db, authorize, get_query_params
 from config import logger
 
@@ -21,6 +22,7 @@ async def create_band(
         ):
     try:
         band_db = await crud.create_obj(model=models.Band, obj_in=band)
+        engine.invalidate_band_tables()
         return band_db.to_dict()
     except Exception as e:
         logger.error(f"Error creating band: {str(e)}")
@@ -39,6 +41,16 @@ async def get_bands(
         ) -> schemas.ListResponse:
     return await crud.paginate(model=models.Band, schema=schemas.BandInDB, **params)
 
+@router.get("/cache-stats",
+            response_model=schemas.StatutoryCacheStats,
+            tags=["Bands"],
+            status_code=200
+        )
+async def get_statutory_cache_stats(
+            _: models.User = Depends(authorize(perm="read_bands"))
+        ):
+    return engine.statutory_cache.stats()
+
 @router.get("/{band_id}",
             response_model=schemas.BandInDB,
             tags=["Bands"],
@@ -63,6 +75,7 @@ async def update_band(
         ):
     try:
         band_db: models.Band = await crud.update_obj(model=models.Band, id=band_id, obj_in=band)
+        engine.invalidate_band_tables()
         return band_db.to_dict()
     except Exception as e:
         logger.error(f"Error updating band: {str(e)}")
@@ -80,6 +93,7 @@ async def delete_band(
         ):
     try:
         is_deleted = await crud.delete_obj(model=models.Band, id=band_id)
+        engine.invalidate_band_tables()
         if is_deleted:
             return None
         else:
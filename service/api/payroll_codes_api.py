@@ -1,10 +1,12 @@
-from typing import Dict
+from datetime import datetime, timezone
+from typing import Dict, Literal, Optional
 from fastapi import APIRouter, HTTPException
 from fastapi import Depends
 import mongoengine
 import crud
 import schemas
 import models
+import engine
 from depends import get_db, authorize, get_query_params
 from config import logger
 import bson
@@ -25,8 +27,15 @@ async def create_payroll_code(
         ):
     try:
         company_db = await crud.get_obj_or_404(model=models.Company, id=company_id)
+        candidate = models.PayrollCode(company=company_db, **code_create.model_dump())
+        engine.validate_codes(list(models.PayrollCode.objects(company=company_db)) + [candidate])
         code_db = await crud.create_code(code_create=code_create, company=company_db)
         return code_db.to_dict()
+    except engine.PlanError as e:
+        logger.error(f"Error creating payroll code: {str(e)}")
+        raise HTTPException(status_code=400,detail={
+            "message": f"{e}"
+        })
     except mongoengine.errors.NotUniqueError as e:
         logger.error(f"Error creating payroll code: {str(e)}")
         raise HTTPException(status_code=400,detail={
@@ -52,6 +61,34 @@ async def get_payroll_codes(
     params['company'] = company_db
     return await crud.paginate(model=models.PayrollCode, schema=schemas.PayrollCodeInDB, **params)
 
+# the generated payroll program of the company, for audit
+@router.get("/program",
+            response_model=schemas.PayrollProgram,
+            tags=["Payroll Codes"],
+            status_code=200
+        )
+async def get_payroll_program(
+            company_id: str,
+            effective_date: Optional[datetime] = None,
+            arithmetic: Literal["float", "cents"] = "float",
+            _: models.User = Depends(authorize(perm="read_payrollcodes"))
+        ):
+    company_db = await crud.get_obj_or_404(model=models.Company, id=company_id)
+    try:
+        # default to the start of today, so repeated audits share one cached plan
+        plan = engine.get_plan(company_db, effective_date or datetime.now(tz=timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0))
+    except engine.PlanError as e:
+        raise HTTPException(status_code=400,detail={
+            "message": f"{e}"
+        })
+    program = plan.program(arithmetic)
+    return {
+        "arithmetic": program.arithmetic,
+        "inputs": program.inputs,
+        "variables": program.variables,
+        "source": program.source
+    }
+
 @router.get("/{code_id}",
             response_model=schemas.PayrollCodeInDB,
             tags=["Payroll Codes"],
@@ -88,8 +125,17 @@ async def update_payroll_code(
             raise HTTPException(status_code=404,detail={
                 "message":"Payroll code not found in the company"
             })
+        for field, value in code_update.model_dump(exclude_unset=True).items():
+            setattr(code, field, value)
+        engine.validate_codes(list(models.PayrollCode.objects(company=company_db, id__ne=code.id)) + [code])
         code_db: models.PayrollCode = await crud.update_obj(model=models.PayrollCode, id=code_id, obj_in=code_update)
+        engine.evict_formula(code_db.id)
         return code_db.to_dict()
+    except engine.PlanError as e:
+        logger.error(f"Error updating payroll code: {str(e)}")
+        raise HTTPException(status_code=400,detail={
+            "message": f"{e}"
+        })
     except mongoengine.errors.NotUniqueError as e:
         logger.error(f"Error creating payroll code: {str(e)}")
         raise HTTPException(status_code=400,detail={
@@ -118,6 +164,7 @@ async def delete_payroll_code(
                 "message":"Payroll code not found in the company"
             })
         is_deleted = await crud.delete_obj(model=models.PayrollCode, id=code_id)
+        engine.evict_formula(code_id)
         if is_deleted:
             return None
         else:
@@ -1,13 +1,15 @@
-from decimal import ROUND_HALF_UP, Decimal
-import io
 import json
-from typing import Dict, List
-from fastapi import APIRouter, File, HTTPException, Request, UploadFile
+from typing import Dict, List, Literal, Optional
+from fastapi import APIRouter, File, HTTPException, Query, Request, UploadFile
 from fastapi import Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse, StreamingResponse
 import crud
 import schemas
 import models
+import jobs
+import engine
+import utils
 from depends import get_db, authorize, get_query_params
 from config import logger
 import pandas as pd
@@ -171,7 +173,7 @@ async def get_compensations_template(
 @router.post("/{computation_id}/upload-compensation",
             tags=["Computations"],
             status_code=200,
-            response_model=List[schemas.ComputationComponentInDB]
+            response_model=schemas.CompensationUploadResult
         )
 async def upload_compensation(
         company_id: str,
@@ -185,47 +187,58 @@ async def upload_compensation(
         raise HTTPException(status_code=404,detail={
             "message":"Computation not found in the company"
         })
-    contents = await file.read()
-    df = pd.read_excel(io.BytesIO(contents))
-    # ensure that the file has at least 3 rows i.e at least one staff data
-    if len(df) <= 2:
+    # the upload is read a chunk of rows at a time, the first two rows after the header hold the names
+    # and descriptions of the template's columns; every chunk is validated before any is imported so
+    # a rejected sheet leaves nothing behind
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    seen = set()
+    def import_file():
+        for chunk in utils.read_upload_chunks(file.file, file.filename or "", skip_rows=2):
+            # ensure that column headers are either staff_number or the payroll code variable
+            if chunk.columns[0] !='staff_number':
+                raise HTTPException(status_code=400,detail={"message":"Staff Number column is missing or is not the first one"})
+            errors = computation_db.validate_compensation(chunk, seen)
+            if len(errors):
+                raise ValueError(errors.iloc[0]['message'])
+        file.file.seek(0)
+        for chunk in utils.read_upload_chunks(file.file, file.filename or "", skip_rows=2):
+            for key, value in computation_db.import_compensation(chunk).items():
+                counts[key] += value
+    try:
+        # the file is parsed and written off the event loop
+        await run_in_threadpool(import_file)
+    except ValueError as e:
+        raise HTTPException(status_code=400,detail={"message":f"{e}"})
+    # ensure that the file has at least one staff data
+    if not seen:
         raise HTTPException(status_code=400,detail={"message":"No data found in the file"})
-    # ensure that column headers are either staff_number or the payroll code variable
-    if df.columns[0] !='staff_number':
-        raise HTTPException(status_code=400,detail={"message":"Staff Number column is missing or is not the first one"})
-    for col in df.columns[1:]:
-        payroll_code = models.PayrollCode.objects.filter(
-                                                    company=computation_db.company,
-                                                    code_type="input",
-                                                    effective_from__lte=computation_db.payroll_period_start,
-                                                    variable=col).first()
-        if not payroll_code:
-            raise HTTPException(status_code=400,detail={"message":f"Payroll code with variable {col} not found"})
-    # validate all staff numbers in the file
-    for staff_number in df['staff_number'][2:]:
-        staff = models.Staff.objects.filter(staff_number=staff_number,company=computation_db.company).first()
-        if not staff:
-            raise HTTPException(status_code=400,detail={"message":f"Staff with staff number {staff_number} not found in the company {computation_db.company.name}"})
-    # create computation components for each staff
-    for idx in df.index[2:]:
-        row = df.loc[idx]
-        staff = models.Staff.objects.filter(staff_number=row['staff_number'], company=computation_db.company).first()
-        for col in df.columns[1:]:
-            payroll_code = models.PayrollCode.objects.filter(
-                                                    company=computation_db.company,
-                                                    code_type="input",
-                                                    effective_from__lte=computation_db.payroll_period_start,
-                                                    variable=col).first()
-            value = row[col]
-            computation_component = models.ComputationComponent(
-                computation=computation_db,
-                payroll_component=payroll_code,
-                staff=staff,
-                value=value
-            )
-            computation_component.save()
-    computation_components = models.ComputationComponent.objects.filter(computation=computation_db)
-    return [comp.to_dict() for comp in computation_components]
+    return counts
+
+# queue the import of a compensation sheet, the errors of a rejected sheet are reported by the job
+@router.post("/{computation_id}/upload-compensation/jobs",
+            tags=["Computations"],
+            status_code=202,
+            response_model=schemas.JobInDB
+        )
+async def submit_compensation_import(
+        company_id: str,
+        computation_id: str,
+        user: models.User = Depends(authorize(perm="read_computations")),
+        file: UploadFile = File(...)
+    ):
+    company_db = await crud.get_obj_or_404(model=models.Company, id=company_id)
+    computation_db = models.Computation.objects.filter(id=bson.ObjectId(computation_id),company=company_db).first()
+    if not computation_db:
+        raise HTTPException(status_code=404,detail={
+            "message":"Computation not found in the company"
+        })
+    try:
+        job_db = await run_in_threadpool(jobs.submit_import_job, 'import_compensation', company_db, user, file.file, file.filename or "", computation_db)
+    except ValueError as e:
+        raise HTTPException(status_code=409,detail={
+            "message": f"{e}"
+        })
+    return job_db.to_dict()
 
 # run computation
 @router.post("/{computation_id}/run",
@@ -236,6 +249,11 @@ async def upload_compensation(
 async def run_computation(
     company_id: str,
     computation_id: str,
+    mode: Literal["row", "vectorized", "parallel"] = "row",
+    workers: Optional[int] = Query(None, ge=1),
+    incremental: bool = False,
+    arithmetic: Literal["float", "cents"] = "float",
+    profile: bool = False,
     _: models.User = Depends(authorize(perm="read_computations")),
 ):
     company_db = await crud.get_obj_or_404(model=models.Company, id=company_id)
@@ -244,22 +262,17 @@ async def run_computation(
         raise HTTPException(status_code=404,detail={
             "message":"Computation not found in the company"
         })
-    def convert_decimals(obj):
-        """Recursively convert Decimal values to rounded float values in a nested structure."""
-        if isinstance(obj, Decimal):
-            return float(obj.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP))  # Round to 2 decimal places
-        elif isinstance(obj, dict):
-            return {k: convert_decimals(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [convert_decimals(v) for v in obj]
-        return obj  # Return other types unchanged
-    async def run():        
-        for staff,params in computation_db.run():
-            params.pop("__builtins__")
-            params.pop("Decimal")
-            params.pop("calculate_paye")
-            params.pop("calculate_nssf_contribution")
-            params = convert_decimals(params)
+    # a queued or running job writes the same components
+    try:
+        jobs.refuse_active_job(computation_db)
+    except ValueError as e:
+        raise HTTPException(status_code=409,detail={
+            "message":f"{e}"
+        })
+    # a plain generator is iterated in a threadpool by StreamingResponse, keeping the event loop free
+    def run():
+        # params are plain floats in every mode, whole cents divided by 100 in the cents arithmetic
+        for staff,params in computation_db.run(mode=mode, workers=workers, incremental=incremental, arithmetic=arithmetic, profile=profile):
             yield json.dumps({
                 "staff": {
                     "id": str(staff.id),
@@ -268,4 +281,182 @@ async def run_computation(
                 },
                 "payroll": params
                 }).encode() + b"\n"
-    return StreamingResponse(content=run(),media_type="application/x-ndjson")
\ No newline at end of file
+    return StreamingResponse(content=run(),media_type="application/x-ndjson")
+
+# recompute the codes downstream of edited payroll codes
+@router.post("/{computation_id}/recompute",
+            response_model=schemas.ComputationRecomputeResult,
+            tags=["Computations"],
+            status_code=200
+        )
+async def recompute_computation(
+    company_id: str,
+    computation_id: str,
+    recompute: schemas.ComputationRecompute,
+    _: models.User = Depends(authorize(perm="update_computations")),
+):
+    company_db = await crud.get_obj_or_404(model=models.Company, id=company_id)
+    computation_db = models.Computation.objects.filter(id=bson.ObjectId(computation_id),company=company_db).first()
+    if not computation_db:
+        raise HTTPException(status_code=404,detail={
+            "message":"Computation not found in the company"
+        })
+    try:
+        return await run_in_threadpool(computation_db.recompute, recompute.variables)
+    except engine.PlanError as e:
+        raise HTTPException(status_code=400,detail={
+            "message": f"{e}"
+        })
+
+# what-if simulation over the computation's inputs, nothing is persisted
+@router.post("/{computation_id}/simulate",
+            tags=["Computations"],
+            status_code=200
+        )
+async def simulate_computation(
+    company_id: str,
+    computation_id: str,
+    simulation: schemas.ComputationSimulation,
+    _: models.User = Depends(authorize(perm="read_computations")),
+):
+    company_db = await crud.get_obj_or_404(model=models.Company, id=company_id)
+    computation_db = models.Computation.objects.filter(id=bson.ObjectId(computation_id),company=company_db).first()
+    if not computation_db:
+        raise HTTPException(status_code=404,detail={
+            "message":"Computation not found in the company"
+        })
+    bands = {
+        band_type: sorted(
+            ({"lower": band.lower, "upper": float("inf") if band.upper is None else band.upper, "rate": band.rate} for band in band_list),
+            key=lambda band: band["lower"]
+        )
+        for band_type, band_list in simulation.bands.items()
+    }
+    try:
+        staff, baseline, scenario = await run_in_threadpool(
+            computation_db.simulate, bands=bands, values=simulation.values, multipliers=simulation.multipliers, outputs=simulation.outputs
+        )
+    except (engine.PlanError, AssertionError) as e:
+        raise HTTPException(status_code=400,detail={
+            "message": f"{e}"
+        })
+    deltas = (scenario - baseline).round(2)
+    def simulate():
+        # the aggregate comes first, then one line per staff member whose payroll changes
+        changed = (deltas != 0).any(axis=1)
+        yield json.dumps({
+            "summary": {
+                "staff": len(staff),
+                "staff_changed": int(changed.sum()),
+                "baseline": baseline.sum().round(2).to_dict(),
+                "scenario": scenario.sum().round(2).to_dict(),
+                "delta": deltas.sum().round(2).to_dict()
+            }
+        }).encode() + b"\n"
+        staff_by_id = {str(employee.id): employee for employee in staff}
+        scenario_rows = scenario[changed].round(2).to_dict(orient="index")
+        for staff_id, row in deltas[changed].to_dict(orient="index").items():
+            employee = staff_by_id[staff_id]
+            yield json.dumps({
+                "staff": {
+                    "id": staff_id,
+                    "staff_number": employee.staff_number,
+                    "name": employee.full_name
+                },
+                "delta": {variable: value for variable, value in row.items() if value != 0},
+                "scenario": scenario_rows[staff_id]
+            }).encode() + b"\n"
+    return StreamingResponse(content=simulate(),media_type="application/x-ndjson")
+
+# compare the computation with a previous one of the company
+@router.get("/{computation_id}/diff",
+            tags=["Computations"],
+            status_code=200
+        )
+async def diff_computations(
+    company_id: str,
+    computation_id: str,
+    previous_id: str,
+    threshold: float = Query(0.0, ge=0),
+    _: models.User = Depends(authorize(perm="read_computations")),
+):
+    company_db = await crud.get_obj_or_404(model=models.Company, id=company_id)
+    computation_db = models.Computation.objects.filter(id=bson.ObjectId(computation_id),company=company_db).first()
+    previous_db = models.Computation.objects.filter(id=bson.ObjectId(previous_id),company=company_db).first()
+    if not computation_db or not previous_db:
+        raise HTTPException(status_code=404,detail={
+            "message":"Computation not found in the company"
+        })
+    def diff():
+        for line in computation_db.diff(previous_db, threshold):
+            yield json.dumps(line).encode() + b"\n"
+    return StreamingResponse(content=diff(),media_type="application/x-ndjson")
+
+# timings of the last profiled run
+@router.get("/{computation_id}/profile",
+            response_model=schemas.ComputationProfile,
+            tags=["Computations"],
+            status_code=200
+        )
+async def get_computation_profile(
+    company_id: str,
+    computation_id: str,
+    _: models.User = Depends(authorize(perm="read_computations")),
+):
+    company_db = await crud.get_obj_or_404(model=models.Company, id=company_id)
+    computation_db = models.Computation.objects.filter(id=bson.ObjectId(computation_id),company=company_db).first()
+    if not computation_db:
+        raise HTTPException(status_code=404,detail={
+            "message":"Computation not found in the company"
+        })
+    if not computation_db.profile:
+        raise HTTPException(status_code=404,detail={
+            "message":"The last run of the computation was not profiled"
+        })
+    return computation_db.profile
+
+# submit a computation run as a background job
+@router.post("/{computation_id}/jobs",
+            response_model=schemas.JobInDB,
+            tags=["Computations"],
+            status_code=202
+        )
+async def submit_computation_job(
+    company_id: str,
+    computation_id: str,
+    job_create: schemas.ComputationJobCreate = schemas.ComputationJobCreate(),
+    user: models.User = Depends(authorize(perm="read_computations")),
+):
+    company_db = await crud.get_obj_or_404(model=models.Company, id=company_id)
+    computation_db = models.Computation.objects.filter(id=bson.ObjectId(computation_id),company=company_db).first()
+    if not computation_db:
+        raise HTTPException(status_code=404,detail={
+            "message":"Computation not found in the company"
+        })
+    try:
+        job_db = jobs.submit_computation_job(computation_db, user, job_create.model_dump(exclude_none=True))
+    except ValueError as e:
+        raise HTTPException(status_code=409,detail={
+            "message": f"{e}"
+        })
+    return job_db.to_dict()
+
+@router.get("/{computation_id}/jobs",
+            response_model=schemas.ListResponse,
+            tags=["Computations"],
+            status_code=200
+        )
+async def get_computation_jobs(
+    company_id: str,
+    computation_id: str,
+    params: Dict = Depends(get_query_params),
+    _: models.User = Depends(authorize(perm="read_computations")),
+) -> schemas.ListResponse:
+    company_db = await crud.get_obj_or_404(model=models.Company, id=company_id)
+    computation_db = models.Computation.objects.filter(id=bson.ObjectId(computation_id),company=company_db).first()
+    if not computation_db:
+        raise HTTPException(status_code=404,detail={
+            "message":"Computation not found in the company"
+        })
+    params['computation'] = computation_db
+    return await crud.paginate(model=models.Job, schema=schemas.JobInDB, **params)
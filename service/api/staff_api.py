@@ -1,15 +1,15 @@
-import io
-import secrets
 from typing import Dict, List
 from fastapi import APIRouter, File, HTTPException, Request, UploadFile
 from fastapi import Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse
 import crud
 import schemas
 import models
+import jobs
 from depends import get_db, authorize, get_query_params
 from config import logger
-import pandas as pd
+import utils
 import os
 import bson
 
@@ -76,65 +76,42 @@ async def upload_staff(
             file: UploadFile = File(...)
         ):
     company_db = await crud.get_obj_or_404(model=models.Company, id=company_id)
-    contents = await file.read()
-    df = pd.read_excel(io.BytesIO(contents), sheet_name="Staff Template")
+    # the upload is read a chunk of rows at a time, off the event loop since the new users' passwords
+    # are hashed while importing; every chunk is validated before any is imported so a rejected file
+    # leaves nothing behind
+    def import_file() -> List[Dict]:
+        seen = set()
+        for chunk in utils.read_upload_chunks(file.file, file.filename or "", sheet_name="Staff Template"):
+            models.raise_first_error(company_db.validate_staff(chunk, seen))
+        file.file.seek(0)
+        staff_list = []
+        for chunk in utils.read_upload_chunks(file.file, file.filename or "", sheet_name="Staff Template"):
+            staff_list.extend(staff.to_dict() for staff in company_db.import_staff(chunk))
+        return staff_list
+    try:
+        staff_list = await run_in_threadpool(import_file)
+    except ValueError as e:
+        raise HTTPException(status_code=400,detail={"message":f"{e}"})
     # ensure that the file has at least 2 rows i.e at least one staff data
-    if len(df) == 0:
+    if not staff_list:
         raise HTTPException(status_code=400,detail={"message":"No data found in the file"})
-    # ensure no empty rows or columns
-    if not df.isnull().values.any():
-        raise HTTPException(status_code=400,detail={"message":"Empty rows or columns found in the file"})
-    # ensure no users based on the email exist that already have staff accounts
-    for idx in df.index:
-        row = df.loc[idx]
-        user = models.User.objects.filter(email=row['User Email']).first()
-        if user and models.Staff.objects.filter(user=user).first():
-            raise HTTPException(status_code=400,detail={
-                "message":f"{idx} User with email {user.email} already has a staff account"
-            })
-    # loop through the rows and create staff objects where a user with 'User Email' does not exist, create one
-    staff_list = []
-    for idx in df.index:
-        row = df.loc[idx]
-        user = models.User.objects.filter(email=row['User Email']).first()
-        if not user:
-            user = models.User(
-                email=row['User Email'],
-                name=row['First Name'] + " " + row['Last Name'],
-                is_active=False
-            )
-            # generate a random password for the user
-            user.set_password(secrets.token_urlsafe(8))
-            user.save()
-            # TODO: send an email to the user to set their password      
-        staff = models.Staff(
-            user=user,
-            company=company_db,
-            first_name=row['First Name'],
-            last_name=row['Last Name'],
-            job_title=row['Job Title'],
-            department=row['Department'],
-            contact_email=row['Contact Email'],
-            contact_phone=str(row['Contact Phone']),
-            pin_number=row['PIN Number'],
-            staff_number=row['Staff Number'],
-            shif_number=row['SHIF Number'],
-            nssf_number=row['NSSF Number'],
-            nita_number=row['NITA Number'],
-            national_id_number=str(row['National ID Number']),
-            date_of_birth=row['Date of Birth'],
-            is_active=row['Is Active'],
-            joined_on=row['Joined On'],
-            departed_on=row["Departed On"] if isinstance(row.get('Departed On'), str) else None,
-            bank_account_number=str(row['Bank Account Number']),
-            bank_name=row['Bank Name'],
-            bank_swift_code=str(row['Bank Swift Code']),
-            bank_branch=row['Bank Branch'],
-        )
-        staff.save()
-        staff_list.append(staff)
-    return [staff.to_dict() for staff in staff_list]
+    return staff_list
     
+# queue the import of staff data to a given company, the errors of a rejected file are reported by the job
+@router.post("/upload/jobs",
+            tags=["Staff"],
+            status_code=202,
+            response_model=schemas.JobInDB
+        )
+async def submit_staff_import(
+            company_id: str,
+            user: models.User = Depends(authorize(perm="create_staff")),
+            file: UploadFile = File(...)
+        ):
+    company_db = await crud.get_obj_or_404(model=models.Company, id=company_id)
+    job_db = await run_in_threadpool(jobs.submit_import_job, 'import_staff', company_db, user, file.file, file.filename or "")
+    return job_db.to_dict()
+
 @router.get("/",
             response_model=schemas.ListResponse,
             tags=["Staff"],
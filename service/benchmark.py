@@ -0,0 +1,373 @@
+import argparse
+import asyncio
+import collections
+import gc
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+import faker
+import mongomock
+import pandas as pd
+from fastapi import UploadFile
+from mongoengine import connect, get_connection
+from pymongo import monitoring
+from starlette.requests import Request
+import models
+import utils
+from config import settings
+
+STAGES = ("seed", "upload_compensation", "run", "generate_payroll_report", "generate_payslip", "generate_p9as")
+# stages that render a pdf per staff member are timed on a sample of the staff
+SAMPLED_STAGES = ("generate_payslip", "generate_p9as")
+WKHTMLTOPDF = "/usr/bin/wkhtmltopdf"
+PERIOD_START = datetime(2025, 1, 1)
+# monthly PAYE and NSSF bands as (lower, upper, rate)
+BANDS = {
+    "PAYE": [(0, 24_000, 10), (24_000, 32_333, 25), (32_333, 500_000, 30), (500_000, 800_000, 32.5), (800_000, float("inf"), 35)],
+    "NSSF": [(0, 8_000, 6), (8_000, 72_000, 6)],
+}
+# largest company benchmarked on mongomock, whose upserts scan the whole collection so that larger runs time
+# mongomock rather than the pipeline; the 10k and 100k sizes need a mongod given with --uri
+MONGOMOCK_MAX_STAFF = 500
+# mongomock collection methods, each counted as one operation
+MONGOMOCK_OPERATIONS = (
+    "find", "find_one", "aggregate", "count_documents", "distinct",
+    "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+    "delete_one", "delete_many", "bulk_write",
+    "find_one_and_update", "find_one_and_replace", "find_one_and_delete",
+)
+
+class QueryCounter(monitoring.CommandListener):
+    """
+        Count the MongoDB operations issued while a stage is measured, by command name
+        Commands sent to a mongod are seen by the listener, mongomock collections are wrapped instead since they never reach the wire
+    """
+    def __init__(self):
+        self.counts: collections.Counter = collections.Counter()
+        self.active = False
+        self._originals: Dict[str, Callable] = {}
+        self._local = threading.local()
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if self.active:
+            self.counts[event.command_name] += 1
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        pass
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        pass
+
+    def install(self) -> None:
+        """
+            Wrap the mongomock collection methods when the default connection is a mongomock client
+        """
+        if not isinstance(get_connection(), mongomock.MongoClient):
+            return
+        for name in MONGOMOCK_OPERATIONS:
+            original = getattr(mongomock.collection.Collection, name)
+            self._originals[name] = original
+            setattr(mongomock.collection.Collection, name, self._wrap(name, original))
+
+    def uninstall(self) -> None:
+        for name, original in self._originals.items():
+            setattr(mongomock.collection.Collection, name, original)
+        self._originals.clear()
+
+    def _wrap(self, name: str, original: Callable) -> Callable:
+        counter = self
+        def operation(collection, *args, **kwargs):
+            # mongomock implements some operations on top of others, only the outermost call is counted
+            depth = getattr(counter._local, "depth", 0)
+            if depth == 0 and counter.active:
+                counter.counts[name] += 1
+            counter._local.depth = depth + 1
+            try:
+                return original(collection, *args, **kwargs)
+            finally:
+                counter._local.depth = depth
+        return operation
+
+def measure(counter: QueryCounter, stage: Callable[[], Any], memory: bool = True) -> Dict[str, Any]:
+    """
+        Run a stage and return its wall time, MongoDB operations and peak traced memory
+    """
+    gc.collect()
+    counter.counts.clear()
+    if memory:
+        tracemalloc.start()
+    counter.active = True
+    started = time.perf_counter()
+    try:
+        stage()
+        seconds = time.perf_counter() - started
+    finally:
+        counter.active = False
+        peak = tracemalloc.get_traced_memory()[1] if memory else None
+        if memory:
+            tracemalloc.stop()
+    return {
+        "seconds": round(seconds, 6),
+        "queries": sum(counter.counts.values()),
+        "commands": dict(sorted(counter.counts.items())),
+        "peak_memory_bytes": peak,
+    }
+
+def master_company() -> models.Company:
+    """
+        Return the master company, creating it with its default payroll codes when it has none
+    """
+    company = models.Company.objects(name="Master Company").first()
+    if not company or not models.PayrollCode.objects(company=company).count():
+        company = utils.initialize_master_company()
+    return company
+
+def generate_company(staff_count: int, seed: int = 0, period_start: datetime = PERIOD_START) -> models.Computation:
+    """
+        Create a company with the master company's payroll codes, PAYE and NSSF bands, staff_count staff and a draft computation
+        The same seed and size always produce the same staff, so results can be compared across commits
+    """
+    fake = faker.Faker()
+    fake.seed_instance(seed + staff_count)
+    master = master_company()
+    company = models.Company(
+        name=f"Benchmark Company {staff_count}",
+        legal_name=f"Benchmark Company {staff_count} Ltd.",
+        pin_number=f"BENCH{staff_count}",
+        contact_email="benchmark@example.com",
+        address="Benchmark Address"
+    )
+    company.save()
+    shutil.copytree(f"templates/{master.name}", f"templates/{company.name}", dirs_exist_ok=True)
+    for payroll_code in models.PayrollCode.objects(company=master, effective_from__lte=period_start):
+        models.PayrollCode(
+            company=company,
+            name=payroll_code.name,
+            description=payroll_code.description,
+            variable=payroll_code.variable,
+            code_type=payroll_code.code_type,
+            tags=payroll_code.tags,
+            value=payroll_code.value,
+            formula=payroll_code.formula,
+            order=payroll_code.order,
+            effective_from=payroll_code.effective_from
+        ).save()
+    period_end = period_start + timedelta(days=30)
+    for band_type, bands in BANDS.items():
+        for lower, upper, rate in bands:
+            models.Band(period_start=period_start, period_end=period_end, band_type=band_type, lower=lower, upper=upper, rate=rate).save()
+    now = datetime.now(tz=timezone.utc)
+    staff = [
+        models.Staff(
+            company=company,
+            first_name=fake.first_name(),
+            last_name=fake.last_name(),
+            job_title=fake.job(),
+            contact_email=f"staff{index}@benchmark.example.com",
+            contact_phone=fake.msisdn(),
+            pin_number=f"A{index:09d}B",
+            staff_number=f"BEN{index:06d}",
+            date_of_birth=fake.date_of_birth(minimum_age=18, maximum_age=65),
+            created_at=now,
+            updated_at=now
+        )
+        for index in range(staff_count)
+    ]
+    # insert in chunks, saving each staff member would dominate the seed for large companies
+    for start in range(0, staff_count, 5_000):
+        models.Staff.objects.insert(staff[start:start + 5_000], load_bulk=False)
+    computation = models.Computation(
+        company=company,
+        payroll_period_start=period_start,
+        payroll_period_end=period_end,
+        generated_by=models.User.objects.first()
+    )
+    computation.save()
+    return computation
+
+def compensation_workbook(computation: models.Computation, seed: int = 0) -> bytes:
+    """
+        Build a filled compensation template for every staff member of the computation's company
+    """
+    rng = random.Random(seed)
+    payroll_codes = models.PayrollCode.objects(
+        company=computation.company,
+        code_type="input",
+        effective_from__lte=computation.payroll_period_start
+    ).order_by("order")
+    variables = ["staff_number"] + [payroll_code.variable for payroll_code in payroll_codes]
+    rows = [
+        ["Staff Number"] + [payroll_code.name for payroll_code in payroll_codes],
+        ["Contains the staff ID that the employer uses"] + [payroll_code.description for payroll_code in payroll_codes],
+    ]
+    ranges = {"gross_pay": (10_000, 1_000_000), "pension_benefit": (0, 20_000)}
+    for staff_number in models.Staff.objects(company=computation.company).order_by("staff_number").scalar("staff_number"):
+        rows.append([staff_number] + [round(rng.uniform(*ranges.get(variable, (0, 10_000))), 2) for variable in variables[1:]])
+    buffer = io.BytesIO()
+    pd.DataFrame(rows, columns=variables).to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+def benchmark_request() -> Request:
+    """
+        A bare request for the endpoints that build file urls from the base url
+    """
+    return Request({"type": "http", "scheme": "http", "server": ("benchmark", 80), "path": "/", "root_path": "", "headers": [], "query_string": b""})
+
+async def consume(response: Any, limit: Optional[int] = None) -> int:
+    """
+        Read up to limit lines of a streaming response
+    """
+    lines = 0
+    async for _ in response.body_iterator:
+        lines += 1
+        if limit is not None and lines >= limit:
+            break
+    return lines
+
+def run_benchmark(staff_count: int, stages: List[str] = list(STAGES), seed: int = 0, mode: str = "row", workers: Optional[int] = None, sample: int = 20, memory: bool = True, period_start: datetime = PERIOD_START, counter: Optional[QueryCounter] = None) -> Dict[str, Any]:
+    """
+        Seed a company of staff_count staff and measure each pipeline stage against the current connection
+        Stages that need a previous stage's output are skipped when it was not requested
+    """
+    from api.payroll_computations_api import upload_compensation
+    from api.payroll_report_api import generate_payroll_report
+    from api.payslips_api import generate_payslip
+    from api.p9as_api import generate_p9as
+    counter = counter or QueryCounter()
+    counter.install()
+    results: Dict[str, Any] = {}
+    state: Dict[str, Any] = {}
+    try:
+        def seed_stage():
+            state["computation"] = generate_company(staff_count, seed, period_start)
+        results["seed"] = measure(counter, seed_stage, memory)
+        computation: models.Computation = state["computation"]
+        company = computation.company
+        workbook = compensation_workbook(computation, seed)
+        sample_staff = list(models.Staff.objects(company=company).order_by("staff_number").limit(sample))
+        pdf_available = os.path.exists(WKHTMLTOPDF)
+        for stage in stages:
+            if stage == "seed":
+                continue
+            if stage in SAMPLED_STAGES and not pdf_available:
+                results[stage] = {"skipped": f"{WKHTMLTOPDF} is not installed"}
+                continue
+            if stage == "upload_compensation":
+                def stage_function():
+                    asyncio.run(upload_compensation(str(company.id), str(computation.id), None, UploadFile(file=io.BytesIO(workbook), filename="compensation.xlsx")))
+            elif stage == "run":
+                def stage_function():
+                    for _ in computation.run(mode=mode, workers=workers):
+                        pass
+            elif stage == "generate_payroll_report":
+                def stage_function():
+                    asyncio.run(generate_payroll_report(str(company.id), str(computation.id), benchmark_request()))
+            elif stage == "generate_payslip":
+                def stage_function():
+                    for staff_db in sample_staff:
+                        generate_payslip(computation, staff_db)
+            elif stage == "generate_p9as":
+                async def generate():
+                    response = await generate_p9as(str(company.id), period_start, period_start.replace(month=12, day=31), benchmark_request())
+                    return await consume(response, len(sample_staff))
+                def stage_function():
+                    asyncio.run(generate())
+            else:
+                raise ValueError(f"Unknown benchmark stage {stage}")
+            results[stage] = measure(counter, stage_function, memory)
+            if stage in SAMPLED_STAGES:
+                results[stage]["sample"] = len(sample_staff)
+                results[stage]["seconds_per_staff"] = round(results[stage]["seconds"] / max(len(sample_staff), 1), 6)
+    finally:
+        counter.uninstall()
+        if "computation" in state:
+            shutil.rmtree(f"templates/{state['computation'].company.name}", ignore_errors=True)
+            shutil.rmtree(f"reports/{state['computation'].company.name}", ignore_errors=True)
+    return {"staff": staff_count, "mode": mode, "stages": results}
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """
+        Describe the change in seconds and queries of each stage against a previous results file
+        The first line names the backend and commit of both, timings taken on different backends not being comparable
+    """
+    previous = {(run["staff"], run["mode"]): run["stages"] for run in baseline.get("runs", [])}
+    lines = [f"baseline {baseline.get('commit')} on {baseline.get('backend', 'an unknown backend')}, current {results.get('commit')} on {results.get('backend')}"]
+    if baseline.get("backend") != results.get("backend"):
+        lines.append("warning: the baseline was recorded on another backend, compare the queries rather than the seconds")
+    for run in results["runs"]:
+        before = previous.get((run["staff"], run["mode"]), {})
+        for stage, current in run["stages"].items():
+            if "seconds" not in current or "seconds" not in before.get(stage, {}):
+                continue
+            ratio = current["seconds"] / before[stage]["seconds"] if before[stage]["seconds"] else float("inf")
+            lines.append(f"{run['staff']:>7} {stage:<24} {before[stage]['seconds']:>10.3f}s -> {current['seconds']:>10.3f}s ({ratio:.2f}x) queries {before[stage]['queries']} -> {current['queries']}")
+    return lines
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="Benchmark the payroll pipeline on generated companies")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100], help=f"staff counts to generate, e.g. 100 10000 100000, at most {MONGOMOCK_MAX_STAFF} without --uri")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--uri", default=None, help="mongod uri, mongomock is used when omitted and recorded as the backend of the results")
+    parser.add_argument("--database", default="payroll_benchmark", help="database to use, dropped before each size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mode", choices=["row", "vectorized", "parallel"], default="row")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--sample", type=int, default=20, help="staff rendered by the pdf stages")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc, which slows the stages down")
+    parser.add_argument("--output", default=None, help="file to write the json results to, stdout when omitted")
+    parser.add_argument("--baseline", default=None, help="previous results file to compare against")
+    args = parser.parse_args(argv)
+    if not args.uri and max(args.sizes) > MONGOMOCK_MAX_STAFF:
+        parser.error(f"sizes above {MONGOMOCK_MAX_STAFF} staff need a mongod given with --uri, mongomock upserts scan the whole collection so they would time mongomock rather than the pipeline")
+    counter = QueryCounter()
+    if args.uri:
+        # the listener only sees the commands of clients created after it was registered
+        monitoring.register(counter)
+        connect(args.database, host=args.uri, uuidRepresentation="standard")
+    else:
+        connect(args.database, host="mongodb://localhost", mongo_client_class=mongomock.MongoClient, uuidRepresentation="standard")
+    results = {
+        "commit": git_commit(),
+        "created_at": datetime.now(tz=timezone.utc).isoformat(),
+        "backend": "mongod" if args.uri else "mongomock",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "runs": [],
+    }
+    for staff_count in args.sizes:
+        get_connection().drop_database(args.database)
+        utils.initialize_db(settings, is_test=True)
+        print(f"benchmarking {staff_count} staff", file=sys.stderr)
+        run = run_benchmark(staff_count, args.stages, args.seed, args.mode, args.workers, args.sample, not args.no_memory, counter=counter)
+        results["runs"].append(run)
+    output = json.dumps(results, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as results_file:
+            results_file.write(output)
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            for line in compare(results, json.load(baseline_file)):
+                print(line, file=sys.stderr)
+    return results
+
+if __name__ == '__main__':
+    main()
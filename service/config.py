@@ -1,5 +1,6 @@
 from pydantic_settings import BaseSettings
 import logging
+import os
 from honeybadger.contrib.logger import HoneybadgerHandler
 
 class AppSettings(BaseSettings):
@@ -21,6 +22,25 @@ class AppSettings(BaseSettings):
     superuser_email: str = "test@test.com"
     superuser_phone: str = "254700000000"
     superuser_password: str = "password"
+    computation_batch_size: int = 1000
+    computation_workers: int = os.cpu_count() or 1
+    computation_shard_size: int = 1000
+    job_workers: int = 1
+    job_poll_interval_seconds: float = 2.0
+    job_stale_after_seconds: float = 600.0
+    # running computations and jobs beat at least this often, well within job_stale_after_seconds
+    heartbeat_interval_seconds: float = 60.0
+    job_max_attempts: int = 3
+    # concurrency caps on running jobs, 0 for no cap
+    job_max_running: int = 0
+    job_max_running_per_company: int = 1
+    statutory_cache_size: int = 100_000
+    # rows validated and written at a time when importing an upload
+    import_chunk_size: int = 1000
+    # where the uploads of import jobs and their error reports are kept
+    import_dir: str = "imports"
+    # threads hashing the passwords of users created by an import
+    password_hash_workers: int = os.cpu_count() or 1
 
 settings = AppSettings()
 
@@ -1,3 +1,4 @@
+from datetime import datetime, timezone
 import mongoengine
 from requests import get
 import models
@@ -134,7 +135,7 @@ async def update_obj(model: models.BaseDocument, id: str, obj_in: schemas.BaseMo
                     setattr(obj, field, [model._fields[field].field.document_type.objects.get(id=bson.ObjectId(item.id)) for item in getattr(obj_in, field)])
                     obj.save()
                     obj_in.__delattr__(field)
-        obj.update(**obj_in.model_dump(exclude_unset=True))
+        obj.update(**obj_in.model_dump(exclude_unset=True), updated_at=datetime.now(tz=timezone.utc))
         obj.reload()
         return obj
     except Exception as e:
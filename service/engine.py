@@ -0,0 +1,916 @@
+import ast
+import bisect
+import builtins
+import hashlib
+import heapq
+import keyword
+import marshal
+import math
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from collections import OrderedDict
+from decimal import Decimal
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from types import CodeType
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from pymongo import UpdateOne
+import models
+from config import settings
+
+# functions made available to formulas by the engine
+PREDEFINED_FUNCTIONS = ("calculate_paye", "calculate_nssf_contribution")
+KNOWN_NAMES: Set[str] = set(dir(builtins)) | set(PREDEFINED_FUNCTIONS) | {"Decimal"}
+# ways a payroll code's result is rounded to whole cents in the cents arithmetic
+ROUNDING_MODES = ("half_up", "half_even", "down", "up")
+ARITHMETICS = ("float", "cents")
+
+class PlanError(ValueError):
+    """
+        Raised when a set of payroll codes cannot be ordered into an execution plan
+    """
+
+# compiled formula cache keyed by (payroll code id, updated_at, arithmetic)
+_formula_cache: Dict[Tuple[str, datetime, str], CodeType] = {}
+
+def compile_formula(payroll_code: Any, arithmetic: str = "float") -> CodeType:
+    """
+        Compile a payroll code formula once and reuse the code object on every later call
+        For the cents arithmetic the formula is first rewritten by cents_formula
+    """
+    formula = cents_formula(payroll_code.formula) if arithmetic == "cents" else payroll_code.formula
+    if payroll_code.id is None:
+        return compile(formula, f"<payroll_code:{payroll_code.variable}>", "eval")
+    key = (str(payroll_code.id), payroll_code.updated_at, arithmetic)
+    code = _formula_cache.get(key)
+    if code is None:
+        code = compile(formula, f"<payroll_code:{payroll_code.variable}>", "eval")
+        evict_formula(payroll_code.id, stale_before=payroll_code.updated_at)
+        _formula_cache[key] = code
+    return code
+
+def evict_formula(code_id: Any, stale_before: Optional[datetime] = None) -> None:
+    """
+        Drop every cached compilation of a payroll code, or only those older than an update
+    """
+    code_id = str(code_id)
+    for key in [key for key in _formula_cache if key[0] == code_id and (stale_before is None or key[1] != stale_before)]:
+        _formula_cache.pop(key, None)
+
+# builtins formulas may call in the cents arithmetic, whose result is in the unit of their arguments
+CENTS_BUILTINS = ("min", "max", "abs", "float")
+
+def cents_formula(formula: str) -> str:
+    """
+        Rewrite a formula for the cents arithmetic, where every variable holds its amount times 100
+        Each subexpression is tracked with the power of 100 its value is scaled by: literals added to, subtracted from
+        or compared with amounts are scaled to cents, products and quotients of amounts are rescaled and round keeps
+        its precision, so the rewritten formula gives the float formula's result in cents
+        Raises PlanError for formulas whose scale cannot be followed, e.g. calls to other functions
+    """
+    try:
+        tree = ast.parse(formula.strip(), mode="eval")
+    except SyntaxError as e:
+        raise PlanError(f"Invalid formula '{formula}': {e.msg}")
+    node, scale = _cents_node(tree.body, formula)
+    return ast.unparse(_rescale(node, scale, 1))
+
+def _rescale(node: ast.expr, scale: int, target: int) -> ast.expr:
+    if scale == target:
+        return node
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        value = node.value * 100 ** (target - scale) if target > scale else node.value / 100 ** (scale - target)
+        return ast.Constant(value)
+    if target > scale:
+        return ast.BinOp(node, ast.Mult(), ast.Constant(100 ** (target - scale)))
+    return ast.BinOp(node, ast.Div(), ast.Constant(100 ** (scale - target)))
+
+def _common_scale(nodes: List[Tuple[ast.expr, int]]) -> Tuple[List[ast.expr], int]:
+    scale = max(node_scale for _, node_scale in nodes)
+    return [_rescale(node, node_scale, scale) for node, node_scale in nodes], scale
+
+def _cents_node(node: ast.expr, formula: str) -> Tuple[ast.expr, int]:
+    if isinstance(node, ast.Constant):
+        if not isinstance(node.value, (int, float)):
+            raise PlanError(f"Formula '{formula}' cannot use the cents arithmetic: unsupported literal {node.value!r}")
+        return node, 0
+    if isinstance(node, ast.Name):
+        if node.id in KNOWN_NAMES:
+            raise PlanError(f"Formula '{formula}' cannot use the cents arithmetic: unsupported name {node.id}")
+        return node, 1
+    if isinstance(node, ast.UnaryOp):
+        operand, scale = _cents_node(node.operand, formula)
+        return ast.UnaryOp(node.op, operand), 0 if isinstance(node.op, ast.Not) else scale
+    if isinstance(node, ast.BinOp):
+        left, right = _cents_node(node.left, formula), _cents_node(node.right, formula)
+        if isinstance(node.op, (ast.Add, ast.Sub, ast.Mod)):
+            (left, right), scale = _common_scale([left, right])
+            return ast.BinOp(left, node.op, right), scale
+        if isinstance(node.op, ast.FloorDiv):
+            (left, right), _ = _common_scale([left, right])
+            return ast.BinOp(left, node.op, right), 0
+        if isinstance(node.op, ast.Mult):
+            return ast.BinOp(left[0], node.op, right[0]), left[1] + right[1]
+        if isinstance(node.op, ast.Div):
+            return ast.BinOp(left[0], node.op, right[0]), left[1] - right[1]
+        if isinstance(node.op, ast.Pow) and right[1] == 0:
+            if left[1] == 0:
+                return ast.BinOp(left[0], node.op, right[0]), 0
+            if isinstance(right[0], ast.Constant) and isinstance(right[0].value, int):
+                return ast.BinOp(left[0], node.op, right[0]), left[1] * right[0].value
+        raise PlanError(f"Formula '{formula}' cannot use the cents arithmetic: unsupported operator {type(node.op).__name__}")
+    if isinstance(node, ast.Compare):
+        operands, _ = _common_scale([_cents_node(operand, formula) for operand in [node.left] + node.comparators])
+        return ast.Compare(operands[0], node.ops, operands[1:]), 0
+    if isinstance(node, ast.BoolOp):
+        values, scale = _common_scale([_cents_node(value, formula) for value in node.values])
+        return ast.BoolOp(node.op, values), scale
+    if isinstance(node, ast.IfExp):
+        test, _ = _cents_node(node.test, formula)
+        (body, orelse), scale = _common_scale([_cents_node(node.body, formula), _cents_node(node.orelse, formula)])
+        return ast.IfExp(test, body, orelse), scale
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+        name = node.func.id
+        args = [_cents_node(arg, formula) for arg in node.args]
+        if name in PREDEFINED_FUNCTIONS:
+            # the statutory functions take and return amounts, read from band tables in cents
+            return ast.Call(node.func, [_rescale(arg, scale, 1) for arg, scale in args], []), 1
+        if name in CENTS_BUILTINS and args:
+            args, scale = _common_scale(args)
+            return ast.Call(node.func, args, []), scale
+        if name == "round" and len(args) in (1, 2) and (len(args) == 1 or isinstance(args[1][0], ast.Constant) and isinstance(args[1][0].value, int)):
+            # rounding an amount scaled by 100 ** scale to n digits is rounding its scaled value to n - 2 * scale digits
+            (value, scale), digits = args[0], args[1][0].value if len(args) == 2 else 0
+            if scale == 0:
+                return ast.Call(node.func, [value] + [arg for arg, _ in args[1:]], []), 0
+            return ast.Call(node.func, [value, ast.Constant(digits - 2 * scale)], []), scale
+    raise PlanError(f"Formula '{formula}' cannot use the cents arithmetic: unsupported expression {ast.unparse(node)}")
+
+def clear_formula_cache() -> None:
+    _formula_cache.clear()
+
+def formula_variables(formula: str) -> Set[str]:
+    """
+        Return the payroll variables a formula reads, ignoring builtins and predefined functions
+    """
+    try:
+        tree = ast.parse(formula, mode="eval")
+    except SyntaxError as e:
+        raise PlanError(f"Invalid formula '{formula}': {e.msg}")
+    return {node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and node.id not in KNOWN_NAMES}
+
+class Plan:
+    """
+        A topologically sorted list of payroll codes for a company at an effective date
+    """
+    def __init__(self, codes: List[Any], dependencies: Dict[str, Set[str]]):
+        self.codes = codes
+        self.dependencies = dependencies
+        self._programs: Dict[Tuple[str, bool], Program] = {}
+
+    @property
+    def variables(self) -> List[str]:
+        return [code.variable for code in self.codes]
+
+    def inputs(self) -> List[Any]:
+        return [code for code in self.codes if code.code_type == "input"]
+
+    def compiled_steps(self, arithmetic: str = "float") -> List["CompiledStep"]:
+        """
+            The plan as database free steps with compiled formulas, safe to send to worker processes
+            Raises PlanError when a formula cannot be rewritten for the cents arithmetic
+        """
+        return [
+            CompiledStep(
+                variable=code.variable,
+                code_type=code.code_type,
+                value=float(code.value) if code.code_type == "fixed" else None,
+                code=compile_formula(code, arithmetic) if code.code_type == "formula" else None,
+                rounding=code.rounding or "half_up",
+            )
+            for code in self.codes
+        ]
+
+    def program(self, arithmetic: str = "float", profile: bool = False) -> "Program":
+        """
+            The plan generated as one Python function, built once per plan, arithmetic and profiling
+        """
+        key = (arithmetic, profile)
+        if key not in self._programs:
+            self._programs[key] = Program(self, arithmetic, profile)
+        return self._programs[key]
+
+    def __iter__(self):
+        return iter(self.codes)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __repr__(self) -> str:
+        return f"Plan({' -> '.join(self.variables)})"
+
+class CompiledStep:
+    """
+        One step of a compiled plan
+        Code objects cannot be pickled, so they travel to worker processes marshalled
+    """
+    __slots__ = ("variable", "code_type", "value", "code", "rounding")
+
+    def __init__(self, variable: str, code_type: str, value: Optional[float], code: Optional[CodeType], rounding: str = "half_up"):
+        self.variable = variable
+        self.code_type = code_type
+        self.value = value
+        self.code = code
+        self.rounding = rounding
+
+    def __getstate__(self) -> Tuple:
+        return (self.variable, self.code_type, self.value, marshal.dumps(self.code) if self.code is not None else None, self.rounding)
+
+    def __setstate__(self, state: Tuple) -> None:
+        self.variable, self.code_type, self.value, code, self.rounding = state
+        self.code = marshal.loads(code) if code is not None else None
+
+    def __repr__(self) -> str:
+        return f"CompiledStep(variable={self.variable}, code_type={self.code_type})"
+
+class Program:
+    """
+        A plan generated as the source of one Python function taking the input variables and returning every variable
+        Each code is an assignment to a local and the statutory functions are closure variables,
+        so evaluating a row consults no dict and sets up no eval per code
+        The source is kept for audit
+        A profiled program adds the time spent on each computed code to a list of timings given when it is bound
+    """
+    def __init__(self, plan: Plan, arithmetic: str = "float", profile: bool = False):
+        self.arithmetic = arithmetic
+        self.profile = profile
+        self.variables: List[str] = plan.variables
+        self.inputs: List[str] = [code.variable for code in plan.inputs()]
+        self.computed: List[str] = [code.variable for code in plan if code.code_type != "input"]
+        self.source = generate_source(plan, arithmetic, profile)
+        self.code = compile(self.source, f"<payroll program {hashlib.sha1(self.source.encode()).hexdigest()[:12]}>", "exec")
+        self._functions: Dict[Tuple[str, str], Callable[..., Dict[str, Any]]] = {}
+
+    def bind(self, band_tables: "BandTables", timings: Optional[List[float]] = None) -> Callable[..., Dict[str, Any]]:
+        """
+            The program's function with the statutory functions of a period's band tables
+            A profiled program is bound to the timings list of one run, indexed like computed, and is not cached
+        """
+        if self.arithmetic == "cents":
+            band_tables = band_tables.cents
+        if self.profile:
+            namespace = {}
+            exec(self.code, {"__builtins__": builtins}, namespace)
+            return namespace["make_program"](band_tables.paye, band_tables.nssf, Decimal, round_cent, time.perf_counter, timings)
+        key = (band_tables.nssf.version, band_tables.paye.version)
+        function = self._functions.get(key)
+        if function is None:
+            namespace: Dict[str, Any] = {}
+            exec(self.code, {"__builtins__": builtins}, namespace)
+            function = namespace["make_program"](band_tables.paye, band_tables.nssf, Decimal, round_cent)
+            self._functions[key] = function
+        return function
+
+    def __repr__(self) -> str:
+        return f"Program(arithmetic={self.arithmetic}, variables={len(self.variables)})"
+
+class LocalNames(ast.NodeTransformer):
+    """
+        Rename the payroll variables a formula reads to their locals in a generated program
+        Builtins and predefined functions keep their names, as they do when the plan's dependencies are read
+    """
+    def __init__(self, locals_: Dict[str, str]):
+        self.locals_ = locals_
+
+    def visit_Name(self, node: ast.Name) -> ast.Name:
+        if node.id in KNOWN_NAMES or node.id not in self.locals_:
+            return node
+        return ast.copy_location(ast.Name(self.locals_[node.id], node.ctx), node)
+
+def generate_source(plan: Plan, arithmetic: str = "float", profile: bool = False) -> str:
+    """
+        Write the source of a plan's program
+        Variables that are not usable as Python names, or that would shadow a builtin, get a generated local name that the formulas read them by
+        A profiled program reads a clock after each code, one call per code, and adds the elapsed time to its timing
+    """
+    locals_: Dict[str, str] = {}
+    for index, variable in enumerate(plan.variables):
+        usable = variable.isidentifier() and not keyword.iskeyword(variable) and not variable.startswith("_") and variable not in KNOWN_NAMES | {"round_cent"}
+        locals_[variable] = variable if usable else f"_v{index}"
+    cents = arithmetic == "cents"
+    lines = [
+        "def make_program(calculate_paye, calculate_nssf_contribution, Decimal, round_cent, _clock=None, _timings=None):",
+        f"    def program({', '.join(locals_[code.variable] for code in plan.inputs())}):",
+    ]
+    if profile:
+        lines.append("        _t0 = _clock()")
+    computed = 0
+    for code in plan:
+        if code.code_type == "input":
+            continue
+        lines.append(f"        # {' '.join(str(code.name or code.variable).split())} ({code.code_type})")
+        if code.code_type == "fixed":
+            value = to_cents(code.value) if cents else float(code.value)
+            lines.append(f"        {locals_[code.variable]} = {value!r}")
+        else:
+            expression = cents_formula(code.formula) if cents else code.formula.strip()
+            expression = ast.unparse(LocalNames(locals_).visit(ast.parse(expression, mode="eval")))
+            if cents:
+                lines.append(f"        {locals_[code.variable]} = round_cent(float({expression}), {(code.rounding or 'half_up')!r})")
+            else:
+                lines.append(f"        {locals_[code.variable]} = float({expression})")
+        if profile:
+            lines.append(f"        _t1 = _clock(); _timings[{computed}] += _t1 - _t0; _t0 = _t1")
+        computed += 1
+    lines.append("        return {" + ", ".join(f"{variable!r}: {locals_[variable]}" for variable in plan.variables) + "}")
+    lines.append("    return program")
+    return "\n".join(lines) + "\n"
+
+def as_naive_utc(value: datetime) -> datetime:
+    """
+        Normalise a datetime to naive UTC, the form mongoengine returns from the database
+    """
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def effective_codes(payroll_codes: Iterable[Any]) -> Dict[str, Any]:
+    """
+        Keep the latest effective code for each variable, breaking ties by the highest order
+    """
+    latest: Dict[str, Any] = {}
+    for code in payroll_codes:
+        current = latest.get(code.variable)
+        if current is None or (as_naive_utc(code.effective_from), code.order) > (as_naive_utc(current.effective_from), current.order):
+            latest[code.variable] = code
+    return latest
+
+def build_plan(payroll_codes: Iterable[Any], outputs: Optional[Iterable[str]] = None) -> Plan:
+    """
+        Order payroll codes so that every formula runs after the variables it reads
+        Raises PlanError on missing inputs or dependency cycles
+        When outputs are given, codes that none of the outputs depend on are dropped
+    """
+    codes = effective_codes(payroll_codes)
+    dependencies: Dict[str, Set[str]] = {}
+    for variable, code in codes.items():
+        if code.code_type == "formula" and not code.formula:
+            raise PlanError(f"Payroll code {variable} is a formula code without a formula")
+        dependencies[variable] = formula_variables(code.formula) if code.code_type == "formula" else set()
+        missing = dependencies[variable] - codes.keys()
+        if missing:
+            raise PlanError(f"Payroll code {variable} depends on undefined variables: {', '.join(sorted(missing))}")
+    if outputs is not None:
+        required: Set[str] = set()
+        pending = list(outputs)
+        while pending:
+            variable = pending.pop()
+            if variable in required:
+                continue
+            if variable not in codes:
+                raise PlanError(f"Requested output {variable} is not a payroll code variable")
+            required.add(variable)
+            pending.extend(dependencies[variable])
+        codes = {variable: code for variable, code in codes.items() if variable in required}
+        dependencies = {variable: dependencies[variable] for variable in codes}
+    # Kahn's algorithm, keeping the user defined order among independent codes
+    dependants: Dict[str, List[str]] = {variable: [] for variable in codes}
+    remaining = {variable: len(deps) for variable, deps in dependencies.items()}
+    for variable, deps in dependencies.items():
+        for dep in deps:
+            dependants[dep].append(variable)
+    ready = [(codes[variable].order, variable) for variable, count in remaining.items() if count == 0]
+    heapq.heapify(ready)
+    ordered: List[Any] = []
+    while ready:
+        _, variable = heapq.heappop(ready)
+        ordered.append(codes[variable])
+        for dependant in dependants[variable]:
+            remaining[dependant] -= 1
+            if remaining[dependant] == 0:
+                heapq.heappush(ready, (codes[dependant].order, dependant))
+    if len(ordered) < len(codes):
+        cyclic = sorted(variable for variable, count in remaining.items() if count > 0)
+        raise PlanError(f"Payroll codes form a dependency cycle: {', '.join(cyclic)}")
+    return Plan(ordered, dependencies)
+
+# execution plan cache keyed by (company id, effective date)
+_plan_cache: Dict[Tuple[str, Any], Tuple[Tuple, Plan]] = {}
+
+def get_plan(company: Any, effective_date: Any, outputs: Optional[Iterable[str]] = None) -> Plan:
+    """
+        Return the cached execution plan for a company at a date, rebuilding it when its codes changed
+    """
+    key = (str(company.id), effective_date)
+    signature = tuple(sorted(
+        (str(code_id), updated_at)
+        for code_id, updated_at in models.PayrollCode.objects(company=company, effective_from__lte=effective_date).scalar("id", "updated_at")
+    ))
+    cached = _plan_cache.get(key)
+    if cached is None or cached[0] != signature:
+        payroll_codes = models.PayrollCode.objects(company=company, effective_from__lte=effective_date)
+        cached = (signature, build_plan(payroll_codes))
+        _plan_cache[key] = cached
+    plan = cached[1]
+    if outputs is not None:
+        return build_plan(plan.codes, outputs=outputs)
+    return plan
+
+def invalidate_plans(company_id: Any = None) -> None:
+    """
+        Drop cached plans for a company, or for every company when no id is given
+    """
+    for key in [key for key in _plan_cache if company_id is None or key[0] == str(company_id)]:
+        _plan_cache.pop(key, None)
+
+def validate_codes(payroll_codes: Iterable[Any]) -> None:
+    """
+        Check that the codes of a company can be planned at every effective date they define
+    """
+    payroll_codes = list(payroll_codes)
+    for effective_from in sorted({as_naive_utc(code.effective_from) for code in payroll_codes}):
+        build_plan([code for code in payroll_codes if as_naive_utc(code.effective_from) <= effective_from])
+
+def downstream_variables(plan: Plan, variables: Iterable[str]) -> Set[str]:
+    """
+        The given variables and every variable of the plan that reads them, directly or through other codes
+    """
+    dependants: Dict[str, Set[str]] = {variable: set() for variable in plan.variables}
+    for variable, deps in plan.dependencies.items():
+        for dep in deps:
+            dependants[dep].add(variable)
+    affected: Set[str] = set()
+    pending = list(variables)
+    while pending:
+        variable = pending.pop()
+        if variable in affected:
+            continue
+        if variable not in dependants:
+            raise PlanError(f"{variable} is not a payroll code variable of the plan")
+        affected.add(variable)
+        pending.extend(dependants[variable])
+    return affected
+
+def load_inputs(plan: Plan, staff: List[Any], components: Dict[Tuple[str, str], Any]) -> pd.DataFrame:
+    """
+        Arrange the prefetched input components of a computation as one float column per input variable, indexed by staff id
+    """
+    frame = load_components(plan.inputs(), staff, components)
+    assert not (frame.isna() | (frame <= -1)).values.any(), "Invalid value for input payroll component"
+    return frame
+
+def load_components(payroll_codes: Iterable[Any], staff: List[Any], components: Dict[Tuple[str, str], Any]) -> pd.DataFrame:
+    """
+        Arrange prefetched components as one float column per payroll code variable, indexed by staff id
+        Cells without a stored component are NaN
+    """
+    index = [str(employee.id) for employee in staff]
+    columns: Dict[str, List[float]] = {}
+    for payroll_code in payroll_codes:
+        code_id = str(payroll_code.id)
+        column = []
+        for staff_id in index:
+            component = components.get((staff_id, code_id))
+            column.append(np.nan if component is None else float(component.value))
+        columns[payroll_code.variable] = column
+    return pd.DataFrame(columns, index=index, dtype=float)
+
+def plan_version(plan: Plan, band_tables: "BandTables", arithmetic: str = "float") -> str:
+    """
+        A digest of everything a computed row depends on besides its inputs: the plan's codes, the period's band tables and the arithmetic
+    """
+    digest = hashlib.sha1()
+    for code in plan:
+        digest.update(repr((code.variable, code.code_type, str(code.value), code.formula, code.rounding)).encode())
+    digest.update(repr((band_tables.nssf_bands, band_tables.paye_bands, arithmetic)).encode())
+    return digest.hexdigest()
+
+def input_fingerprints(plan: Plan, staff: List[Any], components: Dict[Tuple[str, str], Any]) -> Dict[str, str]:
+    """
+        A digest of the stored input components of each staff member, indexed by staff id
+    """
+    code_ids = [(code.variable, str(code.id)) for code in plan.inputs()]
+    fingerprints: Dict[str, str] = {}
+    for employee in staff:
+        staff_id = str(employee.id)
+        values = []
+        for variable, code_id in code_ids:
+            component = components.get((staff_id, code_id))
+            values.append((variable, None if component is None else str(component.value)))
+        fingerprints[staff_id] = hashlib.sha1(repr(values).encode()).hexdigest()
+    return fingerprints
+
+def to_cents(value: Any) -> int:
+    """
+        Convert an amount of money, e.g. a stored Decimal, to whole cents
+    """
+    return round_cent(float(value) * 100, "half_up")
+
+def from_cents(cents: Any) -> Decimal:
+    return Decimal(int(cents)).scaleb(-2)
+
+def round_cent(value: float, rounding: str) -> int:
+    """
+        Round an amount of cents to a whole cent with a payroll code's rounding rule
+        Amounts are first snapped to a millionth of a cent, so float noise in rate products cannot move a tie
+    """
+    value = round(value, 6)
+    if rounding == "half_even":
+        return round(value)
+    if rounding == "down":
+        return math.trunc(value)
+    if rounding == "up":
+        return int(math.copysign(math.ceil(abs(value)), value))
+    return int(math.copysign(math.floor(abs(value) + 0.5), value))
+
+def round_cents(values: np.ndarray, rounding: str) -> np.ndarray:
+    """
+        Round an array of cents to whole cents as int64, see round_cent
+    """
+    values = np.round(values.astype(float), 6)
+    if rounding == "half_even":
+        rounded = np.rint(values)
+    elif rounding == "down":
+        rounded = np.trunc(values)
+    elif rounding == "up":
+        rounded = np.sign(values) * np.ceil(np.abs(values))
+    else:
+        rounded = np.sign(values) * np.floor(np.abs(values) + 0.5)
+    return rounded.astype(np.int64)
+
+def evaluate_frame(steps: List[CompiledStep], inputs: pd.DataFrame, band_tables: "BandTables", arithmetic: str = "float", timings: Optional[Dict[str, float]] = None) -> pd.DataFrame:
+    """
+        Evaluate every step of a compiled plan as one array expression over all staff
+        Formulas that cannot run on arrays, e.g. ones calling max or min, fall back to a per row evaluation of that step only
+        So do formulas that reduce the columns they read to one value, e.g. sum(gross_pay), which per row is a per staff value
+        With the cents arithmetic every column is int64 cents, each formula result being rounded with its code's rule
+        When timings is given the time spent on each computed step is added to it by variable
+    """
+    size = len(inputs)
+    cents = arithmetic == "cents"
+    if cents:
+        band_tables = band_tables.cents
+    columns: Dict[str, np.ndarray] = {}
+    for step in steps:
+        started = time.perf_counter() if timings is not None else 0.0
+        if step.code_type == "input":
+            column = inputs[step.variable].to_numpy(dtype=float)
+            columns[step.variable] = np.rint(column * 100).astype(np.int64) if cents else column
+        elif step.code_type == "fixed":
+            columns[step.variable] = np.full(size, to_cents(step.value), dtype=np.int64) if cents else np.full(size, step.value)
+        else:
+            try:
+                value = eval(step.code, dict(band_tables.vector_functions), columns)
+                if np.ndim(value) == 0 and any(name in columns for name in step.code.co_names):
+                    raise ValueError(f"{step.variable} reduced its columns to one value")
+                value = np.broadcast_to(np.asarray(value, dtype=float), (size,))
+            except (TypeError, ValueError, ArithmeticError):
+                value = np.array([
+                    float(eval(step.code, band_tables.functions, {variable: column[i].item() for variable, column in columns.items()}))
+                    for i in range(size)
+                ], dtype=float)
+            columns[step.variable] = round_cents(value, step.rounding) if cents else value.copy()
+        if timings is not None and step.code_type != "input":
+            timings[step.variable] = timings.get(step.variable, 0.0) + time.perf_counter() - started
+    return pd.DataFrame(columns, index=inputs.index)
+
+def simulate(plan: Plan, inputs: pd.DataFrame, band_tables: "BandTables", bands: Optional[Dict[str, List[Dict[str, float]]]] = None, values: Optional[Dict[str, float]] = None, multipliers: Optional[Dict[str, float]] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+        Evaluate a plan as it is and under a scenario, entirely in memory
+        A scenario replaces the PAYE or NSSF bands, the values of fixed codes and scales input variables
+        Returns the baseline and scenario results
+    """
+    steps = plan.compiled_steps()
+    codes = {step.variable: step for step in steps}
+    values = values or {}
+    multipliers = multipliers or {}
+    for variable in values:
+        if variable not in codes or codes[variable].code_type != "fixed":
+            raise PlanError(f"{variable} is not a fixed payroll code of the plan")
+    for variable in multipliers:
+        if variable not in codes or codes[variable].code_type != "input":
+            raise PlanError(f"{variable} is not an input payroll code of the plan")
+    bands = bands or {}
+    scenario_band_tables = BandTables(
+        bands.get("NSSF", band_tables.nssf_bands),
+        bands.get("PAYE", band_tables.paye_bands)
+    ) if bands else band_tables
+    scenario_steps = [
+        CompiledStep(step.variable, step.code_type, float(values[step.variable]), step.code, step.rounding) if step.variable in values else step
+        for step in steps
+    ]
+    scenario_inputs = inputs.copy()
+    for variable, multiplier in multipliers.items():
+        scenario_inputs[variable] = scenario_inputs[variable] * multiplier
+    return evaluate_frame(steps, inputs, band_tables), evaluate_frame(scenario_steps, scenario_inputs, scenario_band_tables)
+
+# state of a computation worker process, set once by init_worker
+_worker_steps: List[CompiledStep] = []
+_worker_band_tables: List["BandTables"] = []
+_worker_arithmetic: List[str] = []
+_worker_profile: List[bool] = []
+
+def init_worker(steps: List[CompiledStep], band_tables: "BandTables", arithmetic: str = "float", profile: bool = False) -> None:
+    """
+        Receive the compiled plan and band tables once per worker process
+    """
+    _worker_steps[:] = steps
+    _worker_band_tables[:] = [band_tables]
+    _worker_arithmetic[:] = [arithmetic]
+    _worker_profile[:] = [profile]
+
+def evaluate_shard(shard: int, inputs: pd.DataFrame) -> Tuple[int, pd.DataFrame, Optional[Dict[str, float]]]:
+    """
+        Evaluate one shard of staff inside a worker process, with the time spent on each step when profiling
+    """
+    timings: Optional[Dict[str, float]] = {} if _worker_profile and _worker_profile[0] else None
+    return shard, evaluate_frame(_worker_steps, inputs, _worker_band_tables[0], _worker_arithmetic[0], timings), timings
+
+def evaluate_sharded(steps: List[CompiledStep], inputs: pd.DataFrame, band_tables: "BandTables", workers: int, shard_size: int, arithmetic: str = "float", profile: bool = False):
+    """
+        Split the staff into shards and evaluate them in a pool of worker processes
+        Yields (shard number, shard count, results, step timings) as each shard completes, the timings being None unless profiling
+    """
+    shards = [inputs.iloc[start:start + shard_size] for start in range(0, len(inputs), shard_size)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(steps, band_tables, arithmetic, profile)) as pool:
+        futures = [pool.submit(evaluate_shard, shard, frame) for shard, frame in enumerate(shards)]
+        for future in as_completed(futures):
+            shard, results, timings = future.result()
+            yield shard, len(shards), results, timings
+
+class ComponentWriter:
+    """
+        Buffer computed component values and persist them as unordered bulk upserts
+        Rows are flushed whole, once the buffer holds at least batch_size components
+        Each row's input fingerprint is recorded with the plan version after its components, so reruns can skip it
+    """
+    def __init__(self, computation: Any, batch_size: int, on_flush: Optional[Callable[[int], None]] = None, plan_version: Optional[str] = None, profiler: Optional["Profiler"] = None):
+        self.computation = computation
+        self.profiler = profiler or Profiler(enabled=False)
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.plan_version = plan_version
+        self.operations: List[UpdateOne] = []
+        self.row_operations: List[UpdateOne] = []
+        self.buffered_rows = 0
+        self.flushed_rows = 0
+        self.value_field = models.ComputationComponent._fields['value']
+
+    def add_row(self, staff_id: Any, values: Iterable[Tuple[Any, Any]], fingerprint: Optional[str] = None) -> None:
+        """
+            Buffer the (payroll code id, value) pairs computed for one staff member
+        """
+        now = datetime.now(tz=timezone.utc)
+        for code_id, value in values:
+            self.operations.append(UpdateOne(
+                {"computation": self.computation.id, "payroll_component": code_id, "staff": staff_id},
+                {"$set": {"value": self.value_field.to_mongo(value), "updated_at": now}, "$setOnInsert": {"created_at": now}},
+                upsert=True
+            ))
+        if fingerprint is not None:
+            self.row_operations.append(UpdateOne(
+                {"computation": self.computation.id, "staff": staff_id},
+                {"$set": {"fingerprint": fingerprint, "plan_version": self.plan_version, "updated_at": now}, "$setOnInsert": {"created_at": now}},
+                upsert=True
+            ))
+        self.buffered_rows += 1
+        if len(self.operations) >= self.batch_size:
+            self.flush()
+
+    def skip_row(self) -> None:
+        """
+            Count a staff member whose stored components are still current as processed without writing anything
+        """
+        self.buffered_rows += 1
+
+    def flush(self) -> None:
+        if self.operations:
+            with self.profiler.query("computation_components.bulk_write"):
+                models.ComputationComponent._get_collection().bulk_write(self.operations, ordered=False)
+            self.operations = []
+        if self.row_operations:
+            with self.profiler.query("computation_rows.bulk_write"):
+                models.ComputationRow._get_collection().bulk_write(self.row_operations, ordered=False)
+            self.row_operations = []
+        if self.buffered_rows != self.flushed_rows:
+            self.flushed_rows = self.buffered_rows
+            if self.on_flush:
+                with self.profiler.query("computations.update_one"):
+                    self.on_flush(self.flushed_rows)
+
+class Profiler:
+    """
+        Cumulative wall time and call counts of a run, per stage, per payroll code and per query
+        A disabled profiler hands out a shared no-op context, so instrumented code costs one call per stage or query
+        and nothing per row or per code
+    """
+    SECTIONS = ("stages", "codes", "queries")
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.timings: Dict[str, Dict[str, List[float]]] = {section: {} for section in self.SECTIONS}
+
+    def add(self, section: str, name: str, seconds: float, calls: int = 1) -> None:
+        entry = self.timings[section].setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += calls
+
+    def stage(self, name: str):
+        return self._timer("stages", name) if self.enabled else _no_profile
+
+    def query(self, name: str):
+        return self._timer("queries", name) if self.enabled else _no_profile
+
+    @contextmanager
+    def _timer(self, section: str, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(section, name, time.perf_counter() - started)
+
+    def to_dict(self) -> Dict[str, List[Dict[str, Any]]]:
+        """
+            The timings of each section as a list of {name, seconds, calls}, most expensive first
+            Lists rather than mappings, since a payroll variable is not always a valid document key
+        """
+        return {
+            section: [
+                {"name": name, "seconds": round(seconds, 6), "calls": calls}
+                for name, (seconds, calls) in sorted(entries.items(), key=lambda item: -item[1][0])
+            ]
+            for section, entries in self.timings.items()
+        }
+
+_no_profile = nullcontext()
+
+class StatutoryCache:
+    """
+        A bounded LRU memo of statutory function results, keyed by (band table version, value)
+        Shared by the threads of a process, so lookups hold a lock
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[Tuple[str, Any], Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, version: str, value: Any, compute: Callable[[Any], Any]) -> Any:
+        key = (version, value)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+        result = compute(value)
+        with self.lock:
+            self.entries[key] = result
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return result
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            calls = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hit_rate": round(self.hits / calls, 4) if calls else 0.0,
+            }
+
+statutory_cache = StatutoryCache(settings.statutory_cache_size)
+
+class BandTable:
+    """
+        A banded statutory function with the amount due at each band boundary precomputed
+        A value is placed with a binary search over the upper limits, so each call costs O(log n) instead of a walk over the bands
+        The running totals are summed band by band, as the original loop did, so results are unchanged
+        Scalar calls are memoized in the statutory cache under a version derived from the function and its bands
+    """
+    def __init__(self, bands: List[Dict[str, float]], contribution: Callable[[Any, Any], Any]):
+        self.contribution = contribution
+        self.version = hashlib.sha1(repr((contribution.__name__, bands)).encode()).hexdigest()
+        self.lowers: List[float] = [band["lower"] for band in bands]
+        self.uppers: List[float] = [band["upper"] for band in bands]
+        self.rates: List[float] = [band["rate"] for band in bands]
+        # cumulative[i] is the amount due on every band below band i
+        self.cumulative: List[float] = []
+        total = 0.0
+        for lower, upper, rate in zip(self.lowers, self.uppers, self.rates):
+            self.cumulative.append(total)
+            if not math.isinf(upper):
+                total += contribution(upper - lower, rate)
+        self.total = total
+        self._lowers = np.array(self.lowers, dtype=float)
+        self._uppers = np.array(self.uppers, dtype=float)
+        self._rates = np.array(self.rates, dtype=float)
+        self._cumulative = np.array(self.cumulative + [total], dtype=float)
+
+    def __call__(self, value: float) -> float:
+        return statutory_cache.get(self.version, value, self.compute)
+
+    def compute(self, value: float) -> float:
+        index = bisect.bisect_left(self.uppers, value)
+        if index == len(self.uppers):
+            return self.total
+        return self.cumulative[index] + self.contribution(value - self.lowers[index], self.rates[index])
+
+    def evaluate(self, values: Any) -> np.ndarray:
+        """
+            Array form of the band function
+        """
+        values = np.asarray(values, dtype=float)
+        if not len(self.uppers):
+            return np.zeros(values.shape)
+        index = np.searchsorted(self._uppers, values, side="left")
+        band = np.minimum(index, len(self.uppers) - 1)
+        partial = self._cumulative[band] + self.contribution(values - self._lowers[band], self._rates[band])
+        return np.where(index == len(self.uppers), self.total, partial)
+
+    def __repr__(self) -> str:
+        return f"BandTable(bands={len(self.uppers)}, total={self.total})"
+
+def paye_contribution(amount: Any, rate: Any) -> Any:
+    return amount * (rate / 100)
+
+def nssf_contribution(amount: Any, rate: Any) -> Any:
+    return amount * rate / 100
+
+class BandTables:
+    """
+        The PAYE and NSSF band tables valid for a payroll period, with the predefined formulae bound to them
+        Instances are shared read-only by every employee of every run in the period
+    """
+    def __init__(self, nssf_bands: List[Dict[str, float]], paye_bands: List[Dict[str, float]]):
+        self.nssf_bands = nssf_bands
+        self.paye_bands = paye_bands
+        self.nssf = BandTable(nssf_bands, nssf_contribution)
+        self.paye = BandTable(paye_bands, paye_contribution)
+        self.functions: Dict[str, Any] = {
+            "calculate_paye": self.paye,
+            "calculate_nssf_contribution": self.nssf,
+            "Decimal": Decimal,
+        }
+        self.vector_functions: Dict[str, Any] = {
+            "calculate_paye": self.paye.evaluate,
+            "calculate_nssf_contribution": self.nssf.evaluate,
+            "Decimal": Decimal,
+        }
+        self._cents: Optional[BandTables] = None
+
+    @property
+    def cents(self) -> "BandTables":
+        """
+            The same band tables with their limits in cents, for the cents arithmetic
+        """
+        if self._cents is None:
+            def scale(bands: List[Dict[str, float]]) -> List[Dict[str, float]]:
+                return [{"lower": band["lower"] * 100, "upper": band["upper"] * 100, "rate": band["rate"]} for band in bands]
+            self._cents = BandTables(scale(self.nssf_bands), scale(self.paye_bands))
+        return self._cents
+
+    def __repr__(self) -> str:
+        return f"BandTables(nssf={len(self.nssf_bands)}, paye={len(self.paye_bands)})"
+
+def load_bands(band_type: str, period_start: Any) -> List[Dict[str, float]]:
+    """
+        Get the bands of a type valid at the start of a payroll period as monthly floats, lowest first
+        Annual bands are used, scaled down to a month, when the period has no monthly bands of that type
+    """
+    bands = list(models.Band.objects(band_type=band_type, period_start__lte=period_start, period_end__gte=period_start).order_by('lower'))
+    monthly = [band for band in bands if band.band_frequency == 'monthly']
+    if monthly:
+        return [{"lower": float(band.lower), "upper": float(band.upper), "rate": float(band.rate)} for band in monthly]
+    return [{"lower": float(band.lower) / 12, "upper": float(band.upper) / 12, "rate": float(band.rate)} for band in bands]
+
+# band tables keyed by payroll period start
+_band_tables_cache: Dict[Any, Tuple[Tuple, BandTables]] = {}
+
+def get_band_tables(period_start: Any) -> BandTables:
+    """
+        Return the cached band tables for a payroll period, reloading them when a valid band was added, changed or removed
+    """
+    signature = tuple(sorted(
+        (str(band_id), updated_at)
+        for band_id, updated_at in models.Band.objects(period_start__lte=period_start, period_end__gte=period_start).scalar("id", "updated_at")
+    ))
+    cached = _band_tables_cache.get(period_start)
+    if cached is None or cached[0] != signature:
+        cached = (signature, BandTables(load_bands('NSSF', period_start), load_bands('PAYE', period_start)))
+        _band_tables_cache[period_start] = cached
+    return cached[1]
+
+def invalidate_band_tables() -> None:
+    _band_tables_cache.clear()
+    statutory_cache.clear()
@@ -0,0 +1,427 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+import traceback
+from datetime import datetime, timedelta, timezone
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+from bson import ObjectId
+from mongoengine.errors import NotUniqueError
+import pandas as pd
+import models
+import utils
+from config import logger, settings
+
+def active_job(computation: models.Computation) -> Optional[models.Job]:
+    return models.Job.objects(computation=computation, status__in=['queued', 'running']).first()
+
+def refuse_active_job(computation: models.Computation) -> None:
+    """
+        Raise ValueError when a computation already has a queued or running job
+    """
+    job = active_job(computation)
+    if job:
+        raise ValueError(f"Computation already has a {job.status} job {job.id}")
+
+def save_job(job: models.Job) -> None:
+    """
+        Insert a job, raising ValueError when a concurrent submission queued a job for its computation first
+        The unique index on the active jobs of a computation decides between concurrent submissions
+    """
+    try:
+        job.save()
+    except NotUniqueError:
+        refuse_active_job(job.computation)
+        raise ValueError("Computation already has a queued or running job")
+
+def submit_computation_job(computation: models.Computation, user: models.User, params: Dict[str, Any], batch: Optional[models.Batch] = None, deadline: Optional[datetime] = None) -> models.Job:
+    """
+        Queue a payroll run for a computation, refusing a second one while a run is queued or running
+    """
+    refuse_active_job(computation)
+    job = models.Job(
+        kind='computation',
+        company=computation.company,
+        computation=computation,
+        submitted_by=user,
+        batch=batch,
+        deadline=deadline,
+        size=models.Staff.objects(company=computation.company).count(),
+        params=params
+    )
+    save_job(job)
+    return job
+
+def submit_batch(name: str, user: models.User, computations: List[Tuple[models.Computation, Optional[datetime]]], params: Dict[str, Any]) -> models.Batch:
+    """
+        Queue a run for each (computation, deadline) of a batch, refusing the whole batch if any computation is already queued or running
+    """
+    job = models.Job.objects(computation__in=[computation for computation, _ in computations], status__in=['queued', 'running']).first()
+    if job:
+        raise ValueError(f"Computation {job.computation.id} already has a {job.status} job {job.id}")
+    batch = models.Batch(name=name, submitted_by=user)
+    batch.save()
+    try:
+        for computation, deadline in computations:
+            submit_computation_job(computation, user, params, batch=batch, deadline=deadline)
+    except ValueError:
+        # a concurrent submission took one of the computations, the jobs queued so far go with the batch
+        batch.delete()
+        raise
+    return batch
+
+def submit_import_job(kind: str, company: models.Company, user: models.User, file: BinaryIO, filename: str, computation: Optional[models.Computation] = None) -> models.Job:
+    """
+        Queue the import of an uploaded staff template or compensation sheet, keeping the upload on disk until it is processed
+        Compensation imports are refused while the computation has a queued or running job
+    """
+    if computation is not None:
+        refuse_active_job(computation)
+    # the upload is written before the job is queued so a worker never claims a job without its file
+    job_id = ObjectId()
+    path = os.path.join(settings.import_dir, str(job_id), os.path.basename(filename) or "upload")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as upload:
+        shutil.copyfileobj(file, upload)
+    job = models.Job(
+        id=job_id,
+        kind=kind,
+        company=company,
+        computation=computation,
+        submitted_by=user,
+        size=os.path.getsize(path),
+        upload_path=path,
+        params={"filename": filename}
+    )
+    try:
+        save_job(job)
+    except ValueError:
+        remove_upload(job)
+        raise
+    return job
+
+def running_jobs_by_company() -> Dict[Optional[str], int]:
+    return {
+        str(group["_id"]) if group["_id"] else None: group["count"]
+        for group in models.Job.objects(status='running').aggregate([{"$group": {"_id": "$company", "count": {"$sum": 1}}}])
+    }
+
+def claim_next_job(worker: str) -> Optional[models.Job]:
+    """
+        Atomically move the next queued job to running and assign it to a worker
+        Jobs are taken by earliest deadline, then largest company first so long runs start early;
+        jobs without a deadline are interactive submissions and come first
+        Companies already running job_max_running_per_company jobs are skipped and nothing is claimed
+        while job_max_running jobs run
+    """
+    running = running_jobs_by_company()
+    if settings.job_max_running and sum(running.values()) >= settings.job_max_running:
+        return None
+    for candidate in models.Job.objects(status='queued').order_by('deadline', '-size', 'created_at').only('id', 'company').no_dereference():
+        company_id = str(candidate.company.id) if candidate.company else None
+        if company_id and settings.job_max_running_per_company and running.get(company_id, 0) >= settings.job_max_running_per_company:
+            continue
+        now = datetime.now(tz=timezone.utc)
+        job = models.Job.objects(id=candidate.id, status='queued').modify(
+            set__status='running',
+            set__worker=worker,
+            set__started_at=now,
+            set__heartbeat_at=now,
+            set__updated_at=now,
+            inc__attempts=1,
+            new=True
+        )
+        if job is None:
+            # claimed by another worker meanwhile
+            continue
+        if within_caps(job):
+            return job
+        release_job(job)
+        return None
+    return None
+
+def within_caps(job: models.Job) -> bool:
+    """
+        Check a freshly claimed job against the caps, in case workers claimed concurrently
+        The jobs claimed first keep their slots
+    """
+    def holds_slot(jobs: Any, cap: int) -> bool:
+        return not cap or job.id in [running.id for running in jobs.order_by('started_at', 'id').only('id')[:cap]]
+    running = models.Job.objects(status='running')
+    if not holds_slot(running, settings.job_max_running):
+        return False
+    return not job.company or holds_slot(running.filter(company=job.company), settings.job_max_running_per_company)
+
+def release_job(job: models.Job) -> None:
+    """
+        Put a claimed job back in the queue without counting the attempt
+    """
+    models.Job.objects(id=job.id, status='running', worker=job.worker).update_one(
+        set__status='queued',
+        set__worker=None,
+        unset__started_at=True,
+        inc__attempts=-1,
+        set__updated_at=datetime.now(tz=timezone.utc)
+    )
+
+def recover_orphaned_runs(stale_after: float = settings.job_stale_after_seconds) -> List[models.Job]:
+    """
+        Requeue running jobs whose worker stopped sending heartbeats, resuming from their last checkpoint,
+        and queue a resume job for computations left processing by a run that was not a job
+        Jobs that were already abandoned job_max_attempts times are failed instead
+    """
+    now = datetime.now(tz=timezone.utc)
+    cutoff = now - timedelta(seconds=stale_after)
+    recovered: List[models.Job] = []
+    for stale_job in models.Job.objects(status='running', heartbeat_at__lt=cutoff).only('id', 'attempts', 'worker'):
+        if stale_job.attempts >= settings.job_max_attempts:
+            job = models.Job.objects(id=stale_job.id, status='running', heartbeat_at__lt=cutoff).modify(
+                set__status='failed',
+                set__error=f"Abandoned by worker {stale_job.worker} after {stale_job.attempts} attempts",
+                set__finished_at=now,
+                set__updated_at=now,
+                new=True
+            )
+            if job and job.kind == 'computation' and job.computation:
+                models.Computation.objects(id=job.computation.id).update_one(set__status='failed')
+            elif job:
+                remove_upload(job)
+            continue
+        job = models.Job.objects(id=stale_job.id, status='running', heartbeat_at__lt=cutoff).modify(
+            set__status='queued',
+            set__worker=None,
+            set__params__resume=True,
+            set__updated_at=now,
+            new=True
+        )
+        if job:
+            logger.warning(f"Job {job.id} abandoned by worker {stale_job.worker}, requeued to resume")
+            recovered.append(job)
+    for computation in models.Computation.objects(status='processing', heartbeat_at__lt=cutoff):
+        if models.Job.objects(computation=computation, status__in=['queued', 'running']).first():
+            continue
+        # claim the orphan by touching its heartbeat so concurrent workers do not queue it twice
+        if not models.Computation.objects(id=computation.id, status='processing', heartbeat_at__lt=cutoff).modify(set__heartbeat_at=now):
+            continue
+        job = submit_computation_job(computation, computation.generated_by, dict(computation.run_params, resume=True))
+        logger.warning(f"Computation {computation.id} was left processing, queued job {job.id} to resume it")
+        recovered.append(job)
+    return recovered
+
+def report_progress(job: models.Job, processed: int, total: int) -> None:
+    job.processed = processed
+    job.total = total
+    models.Job.objects(id=job.id).update_one(
+        set__processed=processed,
+        set__total=total,
+        set__heartbeat_at=datetime.now(tz=timezone.utc)
+    )
+
+def finish_job(job: models.Job, status: str, error: Optional[str] = None) -> None:
+    job.status = status
+    job.error = error
+    job.finished_at = datetime.now(tz=timezone.utc)
+    job.save()
+
+def run_computation_job(job: models.Job) -> None:
+    """
+        Drive a computation run to completion, mirroring its progress on the job
+    """
+    computation: models.Computation = job.computation
+    processed = -1
+    for _ in computation.run(**job.params):
+        if computation.staff_processed != processed:
+            processed = computation.staff_processed
+            report_progress(job, processed, computation.staff_total)
+    report_progress(job, computation.staff_processed, computation.staff_total)
+
+def remove_upload(job: models.Job) -> None:
+    if job.upload_path and os.path.exists(job.upload_path):
+        os.remove(job.upload_path)
+
+def requeue_job(job: models.Job) -> None:
+    """
+        Put a job that failed on a transient error back in the queue to resume, counting the attempt
+    """
+    job.status = 'queued'
+    models.Job.objects(id=job.id, status='running').update_one(
+        set__status='queued',
+        set__worker=None,
+        set__params__resume=True,
+        set__updated_at=datetime.now(tz=timezone.utc)
+    )
+
+def upload_chunks(job: models.Job) -> Iterator[pd.DataFrame]:
+    with open(job.upload_path, "rb") as upload:
+        if job.kind == 'import_staff':
+            yield from utils.read_upload_chunks(upload, job.params["filename"], sheet_name="Staff Template")
+        else:
+            # the first two rows after the header hold the names and descriptions of the template's columns
+            yield from utils.read_upload_chunks(upload, job.params["filename"], skip_rows=2)
+
+def write_error_report(job: models.Job, errors: pd.DataFrame) -> str:
+    """
+        Write the errors of an upload as a CSV file next to it, ordered by row, the errors of whole columns first
+    """
+    path = os.path.join(settings.import_dir, str(job.id), "errors.csv")
+    errors = errors.astype({'row': 'Int64'}).sort_values('row', kind='stable', na_position='first')
+    errors.to_csv(path, index=False)
+    return path
+
+def run_import_job(job: models.Job) -> None:
+    """
+        Import an upload in two passes over its chunks
+        The first validates every chunk, collecting all the errors of the file into one report so they can be fixed
+        in one round, and the upload is rejected as a whole when there is any; the second imports the chunks,
+        checkpointing the rows imported so a retried job resumes after them
+        Rows before the checkpoint are validated only to catch later rows repeating them, their own errors,
+        e.g. staff that now have an account, being the outcome of their import
+        The upload is removed once the job completes
+        A staff import counts the staff it created for its checkpoint, as a crash may come after a chunk is inserted
+        and before the checkpoint is written; compensation imports upsert their cells, so a chunk imported again changes nothing
+    """
+    if job.kind == 'import_staff':
+        # each row creates one staff member, in the order of the rows, so the staff carrying the job are the rows imported
+        created = models.Staff.objects(import_job=job).count()
+        if created != job.checkpoint:
+            job.result, job.checkpoint = {**(job.result or {}), "created": created}, created
+            models.Job.objects(id=job.id).update_one(set__result=job.result, set__checkpoint=created)
+        validate: Callable[..., pd.DataFrame] = job.company.validate_staff
+        def import_chunk(chunk: pd.DataFrame) -> Dict[str, int]:
+            return {"created": len(job.company.import_staff(chunk, import_job=job))}
+    else:
+        validate = job.computation.validate_compensation
+        def import_chunk(chunk: pd.DataFrame) -> Dict[str, int]:
+            return job.computation.import_compensation(chunk)
+    def pending_chunks() -> Iterator[Tuple[pd.DataFrame, pd.DataFrame, int]]:
+        # split each chunk into its rows imported before the checkpoint and those left to import
+        rows = 0
+        for chunk in upload_chunks(job):
+            done = max(0, min(job.checkpoint - rows, len(chunk)))
+            rows += len(chunk)
+            yield chunk.iloc[:done], chunk.iloc[done:], rows
+    seen = set()
+    errors = []
+    total = 0
+    for imported, pending, total in pending_chunks():
+        if len(imported):
+            validate(imported, seen)
+        if len(pending):
+            chunk_errors = validate(pending, seen)
+            if len(chunk_errors):
+                errors.append(chunk_errors)
+        report_progress(job, job.checkpoint, total)
+    if errors:
+        errors = pd.concat(errors, ignore_index=True)
+        job.error_count = len(errors)
+        job.error_report = write_error_report(job, errors)
+        rows = errors['row'].dropna().nunique()
+        raise ValueError(f"Found {job.error_count} errors in {rows} rows of the file, see the error report")
+    if not total:
+        raise ValueError("No data found in the file")
+    result = dict(job.result or {})
+    for _, pending, rows in pending_chunks():
+        if not len(pending):
+            continue
+        for key, value in import_chunk(pending).items():
+            result[key] = result.get(key, 0) + value
+        job.result, job.checkpoint = result, rows
+        models.Job.objects(id=job.id).update_one(set__result=result, set__checkpoint=rows)
+        report_progress(job, rows, total)
+    remove_upload(job)
+
+JOB_HANDLERS = {
+    'computation': run_computation_job,
+    'import_staff': run_import_job,
+    'import_compensation': run_import_job,
+}
+
+def execute_job(job: models.Job) -> models.Job:
+    """
+        Run a claimed job and record whether it completed or failed
+    """
+    def beat() -> None:
+        models.Job.objects(id=job.id, status='running').update_one(set__heartbeat_at=datetime.now(tz=timezone.utc))
+    try:
+        # the job beats from a timer too, progress being reported only between batches or chunks
+        with utils.Heartbeat(beat, settings.heartbeat_interval_seconds):
+            JOB_HANDLERS[job.kind](job)
+        finish_job(job, 'completed')
+    except Exception as e:
+        if job.kind != 'computation' and not isinstance(e, ValueError) and job.attempts < settings.job_max_attempts:
+            # imports are retried from their checkpoint, with their upload kept
+            logger.warning(f"Job {job.id} failed on attempt {job.attempts}, requeued to resume: {e}")
+            requeue_job(job)
+            return job
+        if isinstance(e, ValueError) and job.kind != 'computation':
+            # a rejected upload is for the client to fix
+            logger.warning(f"Job {job.id} failed: {e}")
+        else:
+            logger.error(f"Job {job.id} failed: {e}\n{traceback.format_exc()}")
+        finish_job(job, 'failed', error=str(e))
+        if job.kind == 'computation' and job.computation:
+            models.Computation.objects(id=job.computation.id).update_one(set__status='failed')
+        else:
+            remove_upload(job)
+    return job
+
+def process_next_job(worker: str = "inline") -> Optional[models.Job]:
+    """
+        Claim and execute one queued job, returning it, or None when the queue is empty
+    """
+    job = claim_next_job(worker)
+    if job is None:
+        return None
+    return execute_job(job)
+
+class JobWorker(threading.Thread):
+    """
+        A background thread that keeps claiming and executing queued jobs
+    """
+    def __init__(self, poll_interval: float):
+        super().__init__(daemon=True)
+        self.worker_id = f"{uuid.uuid4().hex[:8]}-{self.name}"
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        logger.info(f"Job worker {self.worker_id} started")
+        while not self.stopped.is_set():
+            try:
+                recover_orphaned_runs()
+                job = process_next_job(self.worker_id)
+            except Exception as e:
+                logger.error(f"Job worker {self.worker_id} error: {e}")
+                job = None
+            if job is None:
+                self.stopped.wait(self.poll_interval)
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+_workers: List[JobWorker] = []
+
+def start_workers(count: int = settings.job_workers, poll_interval: float = settings.job_poll_interval_seconds) -> List[JobWorker]:
+    for _ in range(count):
+        worker = JobWorker(poll_interval)
+        worker.start()
+        _workers.append(worker)
+    return _workers
+
+def stop_workers() -> None:
+    for worker in _workers:
+        worker.stop()
+    for worker in _workers:
+        worker.join()
+    _workers.clear()
+
+if __name__ == '__main__':
+    import depends
+    depends.get_db()
+    start_workers()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_workers()
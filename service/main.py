@@ -1,6 +1,9 @@
+from contextlib import asynccontextmanager
 from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from depends import get_db
+from config import settings
+import jobs
 from api import auth_api
 from api import permissions_api
 from api import roles_api
@@ -15,12 +18,25 @@ from api import files_api
 from api import payslips_api
 from api import p9as_api
 from api import payroll_report_api
+from api import jobs_api
+from api import batches_api
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # background workers for queued jobs, e.g. payroll runs
+    # compose runs them in the hummingworker service only, with JOB_WORKERS=0 here, so runs do not compete with requests
+    if settings.job_workers > 0:
+        get_db()
+        jobs.start_workers(settings.job_workers)
+    yield
+    jobs.stop_workers()
+
 fastapi_config = {
     "title":"Hummingbird Service",
     "debug":True,
     "root_path": "/api",
+    "lifespan": lifespan,
 }
 
 app = FastAPI(**fastapi_config)
@@ -38,6 +54,8 @@ app.include_router(payroll_computations_api.router,prefix="/companies/{company_i
 app.include_router(payslips_api.router,prefix="/companies/{company_id}/computations/{computation_id}/payslips")
 app.include_router(payroll_report_api.router,prefix="/companies/{company_id}/computations/{computation_id}/report")
 app.include_router(files_api.router,prefix="/files")
+app.include_router(jobs_api.router,prefix="/jobs")
+app.include_router(batches_api.router,prefix="/batches")
 
 app.add_middleware(
     CORSMiddleware,
@@ -1,41 +1,23 @@
 from email.policy import default
 from enum import unique
 from pprint import pprint
+import secrets
 import shutil
+import time
 from fastapi import HTTPException
 from mongoengine import *
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Any, List, Dict, Tuple
+from typing import Callable, Optional, Any, List, Dict, Set, Tuple
 from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
 from bson import ObjectId
 import utils
+import engine
 from passlib.context import CryptContext
-from config import logger
+from config import logger, settings
 import jwt
-
-# predefined formulae  
-predefined_formulae = """
-from decimal import Decimal
-def calculate_paye(taxable_income: float) -> Decimal:
-    paye: Decimal = Decimal(0.00)
-    for band in paye_bands_monthly:
-        if taxable_income > band["upper"]:
-            paye += (band["upper"] - band["lower"]) * (band["rate"] / 100)
-        else:
-            paye += (taxable_income - band["lower"]) * (band["rate"] / 100)
-            break
-    return paye
-
-def calculate_nssf_contribution(gross_pay: float) -> Decimal:
-    nssf_contribution: Decimal = Decimal(0.00)
-    for band in nssf_bands_monthly:
-        if gross_pay > band["upper"]:
-            nssf_contribution += (band["upper"] - band["lower"]) * band["rate"] / 100
-        else:
-            nssf_contribution += (gross_pay - band["lower"]) * band["rate"] / 100
-            break
-    return nssf_contribution
-"""
+import pandas as pd
+from pymongo import UpdateOne
 
 class BaseDocument(Document):
     meta = {'abstract': True}
@@ -172,6 +154,18 @@ class Role(BaseDocument):
         self.updated_at = datetime.now(tz=timezone.utc)
         return super(Role, self).save(*args, **kwargs)
 
+# one bcrypt context for the process, building one costs about as much as a hash
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+def hash_passwords(passwords: List[str]) -> List[str]:
+    """
+    Hash passwords with bcrypt in a pool of threads, bcrypt releasing the GIL while it hashes
+    """
+    if len(passwords) <= 1:
+        return [pwd_context.hash(password) for password in passwords]
+    with ThreadPoolExecutor(max_workers=settings.password_hash_workers) as pool:
+        return list(pool.map(pwd_context.hash, passwords))
+
 class User(BaseDocument):
     """
     User model
@@ -182,7 +176,7 @@ class User(BaseDocument):
     is_email_verified: bool = BooleanField(default=False)
     email_verification_code: Optional[str] = StringField(max_length=50, required=False)
     email_verification_code_expiry: Optional[datetime] = DateTimeField(required=False)
-    phone: str = StringField(max_length=50, unique=True)  # Using mediumtext equivalent
+    phone: str = StringField(max_length=50, unique=True, sparse=True)  # Using mediumtext equivalent
     is_phone_verified: bool = BooleanField(default=False)
     phone_verification_code: Optional[str] = StringField(max_length=50, required=False)
     phone_verification_code_expiry: Optional[datetime] = DateTimeField(required=False)
@@ -267,13 +261,25 @@ class User(BaseDocument):
         return False
     
     def set_password(self, password):
-        pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
         self.password = pwd_context.hash(password)
         self.save()
 
     def check_password(self, password):
-        pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
         return pwd_context.verify(password, self.password)
+
+    @classmethod
+    def make_phone_index_sparse(cls) -> bool:
+        """
+        Drop a unique phone index that also covers users without a phone, e.g. those created by staff imports,
+        so it is rebuilt sparse the next time the collection is used
+        Works on the raw collection, since getting the document's collection builds its indexes
+        """
+        collection = get_db()[cls._meta['collection']]
+        index = collection.index_information().get('phone_1')
+        if index and index.get('unique') and not index.get('sparse'):
+            collection.drop_index('phone_1')
+            return True
+        return False
     
     def create_jwt_token(self, clientapp: "ClientApp", secret: str, algorithm: str, expiry_minutes: int) -> str:
         """
@@ -350,6 +356,20 @@ class ClientApp(BaseDocument):
         self.updated_at = datetime.now(tz=timezone.utc)
         return super(ClientApp, self).save(*args, **kwargs)
 
+class BandLimitField(DecimalField):
+    """
+    A DecimalField that also stores an infinite limit, used for the open ended top band
+    """
+    def to_python(self, value: Any) -> Any:
+        if isinstance(value, (float, Decimal)) and Decimal(value).is_infinite():
+            return Decimal(value)
+        return super(BandLimitField, self).to_python(value)
+
+    def to_mongo(self, value: Any) -> Any:
+        if isinstance(value, (float, Decimal)) and Decimal(value).is_infinite():
+            return float(value)
+        return super(BandLimitField, self).to_mongo(value)
+
 # PAYE and NSSF bands
 class Band(BaseDocument):
     """
@@ -362,7 +382,7 @@ class Band(BaseDocument):
     band_type: str = StringField(required=True, choices=['PAYE', 'NSSF'])
     band_frequency: str = StringField(required=True, choices=['monthly', 'annual'], default='monthly')
     lower: float = DecimalField(required=True)
-    upper: float = DecimalField(required=True, default=float("inf"))
+    upper: float = BandLimitField(required=True, default=float("inf"))
     rate: float = DecimalField(required=True)
     created_at: datetime = DateTimeField(default=datetime.now(tz=timezone.utc))
     updated_at: datetime = DateTimeField()
@@ -384,6 +404,55 @@ class Band(BaseDocument):
         self.updated_at = datetime.now(tz=timezone.utc)
         return super(Band, self).save(*args, **kwargs)
 
+# columns of the error reports of imports, row being the line number in the uploaded file
+IMPORT_ERROR_COLUMNS = ['row', 'column', 'value', 'message']
+STAFF_REQUIRED_COLUMNS = ['User Email', 'First Name', 'Last Name', 'Contact Email', 'PIN Number', 'Staff Number']
+STAFF_EMAIL_COLUMNS = ['User Email', 'Contact Email']
+STAFF_DATE_COLUMNS = ['Date of Birth', 'Joined On', 'Departed On']
+EMAIL_PATTERN = r"^[^@\s]+@[^@\s]+\.[^@\s]+$"
+
+def cell_errors(frame: pd.DataFrame, mask: pd.DataFrame, message: Callable[[pd.DataFrame], pd.Series]) -> pd.DataFrame:
+    """
+    Report the cells of frame flagged in mask, message building the messages from the errors' rows, columns and values
+    """
+    cells = mask.stack()
+    cells = cells[cells].index
+    errors = pd.DataFrame({
+        'row': cells.get_level_values(0),
+        'column': cells.get_level_values(1),
+        'value': frame.stack(future_stack=True).reindex(cells).to_numpy() if len(cells) else []
+    }, dtype=object)
+    errors['message'] = message(errors) if len(errors) else []
+    return errors
+
+def column_errors(columns: List[str], message: str) -> pd.DataFrame:
+    """
+    Report whole columns of a file, message being formatted with each column
+    """
+    return pd.DataFrame({
+        'row': [None] * len(columns),
+        'column': columns,
+        'value': [None] * len(columns),
+        'message': [message.format(column=column) for column in columns]
+    }, dtype=object)
+
+def collect_errors(errors: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenate the errors of an import's checks, in the order of the checks
+    """
+    errors = [check for check in errors if len(check)]
+    if not errors:
+        return pd.DataFrame(columns=IMPORT_ERROR_COLUMNS)
+    return pd.concat(errors, ignore_index=True)[IMPORT_ERROR_COLUMNS]
+
+def raise_first_error(errors: pd.DataFrame) -> None:
+    """
+    Raise ValueError with the message of the first error, prefixed by its row when it has one
+    """
+    if len(errors):
+        row, message = errors.iloc[0]['row'], errors.iloc[0]['message']
+        raise ValueError(message if row is None else f"{row} {message}")
+
 class Company(BaseDocument):
     """
     Represents a company entity in the payroll system.
@@ -443,6 +512,109 @@ class Company(BaseDocument):
         shutil.copytree(f"templates/{master_company.name}", f"templates/{self.name}", dirs_exist_ok=True)
         return True
     
+    def _check_staff(self, frame: pd.DataFrame, seen: Optional[Set[str]] = None) -> Tuple[pd.DataFrame, pd.DataFrame, Optional[pd.Series], Dict[str, 'User']]:
+        """
+        Collect every invalid cell of a chunk of the staff template in one pass of vectorized checks, resolving the users
+        of its emails with one $in query and those having a staff account with another
+        Returns the errors, the chunk with None for missing values, its stripped user emails and their existing users
+        """
+        frame = frame.astype(object).where(frame.notna(), None)
+        missing = [column for column in STAFF_REQUIRED_COLUMNS if column not in frame.columns]
+        if missing:
+            return column_errors(missing, "Column {column} is missing from the file"), frame, None, {}
+        emails = frame['User Email'].where(frame['User Email'].isna(), frame['User Email'].astype(str).str.strip())
+        users: Dict[str, User] = {user.email: user for user in User.objects(email__in=emails.dropna().unique().tolist()).only('id', 'email')}
+        with_staff = {str(user.id) for user in Staff.objects(user__in=list(users.values())).no_dereference().scalar('user')}
+        errors = [cell_errors(frame, frame[STAFF_REQUIRED_COLUMNS].isnull(), lambda e: "Missing value for " + e['column'])]
+        addresses = frame[STAFF_EMAIL_COLUMNS].apply(lambda column: column.astype(str).str.strip().str.match(EMAIL_PATTERN))
+        errors.append(cell_errors(frame, frame[STAFF_EMAIL_COLUMNS].notna() & ~addresses, lambda e: "Invalid email address " + e['value'].astype(str)))
+        repeated = emails.notna() & (emails.duplicated() | emails.isin(list(seen or ())))
+        errors.append(cell_errors(frame, repeated.to_frame('User Email'), lambda e: "User with email " + e['value'].astype(str) + " appears more than once in the file"))
+        has_staff = emails.map(lambda email: email in users and str(users[email].id) in with_staff)
+        errors.append(cell_errors(frame, has_staff.to_frame('User Email'), lambda e: "User with email " + e['value'].astype(str) + " already has a staff account"))
+        dates = [column for column in STAFF_DATE_COLUMNS if column in frame.columns]
+        invalid_dates = frame[dates].notna() & frame[dates].apply(lambda column: pd.to_datetime(column, errors='coerce', format='mixed')).isna()
+        errors.append(cell_errors(frame, invalid_dates, lambda e: "Invalid date " + e['value'].astype(str) + " for " + e['column']))
+        return collect_errors(errors), frame, emails, users
+
+    def validate_staff(self, frame: pd.DataFrame, seen: Optional[Set[str]] = None) -> pd.DataFrame:
+        """
+        Collect every invalid cell of a chunk of the staff template, as a DataFrame of IMPORT_ERROR_COLUMNS
+        in the order of the checks, empty when the chunk can be imported
+        A file validated in chunks passes the same seen set with every chunk, so emails repeated across chunks are caught too
+        """
+        errors, _, emails, _ = self._check_staff(frame, seen)
+        if seen is not None and emails is not None:
+            seen.update(emails.dropna())
+        return errors
+
+    # import a chunk of the staff template
+    def import_staff(self, frame: pd.DataFrame, import_job: Optional['Job'] = None) -> List['Staff']:
+        """
+        Create the staff of a chunk of the staff template, creating an inactive user for each unknown 'User Email'
+        Existing users are resolved with one $in query on the emails and their staff accounts with another,
+        the new users' random passwords are hashed in a thread pool and users and staff are inserted in bulk
+        Staff imported by a job are marked with it, the ordered insert creating them in the order of the rows
+        Raises ValueError on the first error validate_staff finds or when a row is not a valid staff member
+        """
+        errors, frame, emails, users = self._check_staff(frame)
+        raise_first_error(errors)
+        now = datetime.now(tz=timezone.utc)
+        new_users = [
+            User(email=email, name=frame.at[idx, 'First Name'] + " " + frame.at[idx, 'Last Name'], is_active=False, created_at=now, updated_at=now)
+            for idx, email in emails.items() if email not in users
+        ]
+        # generate a random password for each new user
+        # TODO: send an email to the users to set their password
+        for user, password in zip(new_users, hash_passwords([secrets.token_urlsafe(8) for _ in new_users])):
+            user.password = password
+        created = {user.email: user for user in new_users}
+        staff_list = []
+        for idx, row in frame.iterrows():
+            staff = Staff(
+                company=self,
+                first_name=row['First Name'],
+                last_name=row['Last Name'],
+                job_title=row.get('Job Title'),
+                department=row.get('Department'),
+                contact_email=row['Contact Email'],
+                contact_phone=str(row['Contact Phone']) if row.get('Contact Phone') is not None else None,
+                pin_number=row['PIN Number'],
+                staff_number=str(row['Staff Number']),
+                shif_number=row.get('SHIF Number'),
+                nssf_number=row.get('NSSF Number'),
+                nita_number=row.get('NITA Number'),
+                national_id_number=str(row['National ID Number']) if row.get('National ID Number') is not None else None,
+                date_of_birth=row.get('Date of Birth'),
+                is_active=bool(row['Is Active']) if row.get('Is Active') is not None else True,
+                joined_on=row.get('Joined On'),
+                departed_on=row['Departed On'] if isinstance(row.get('Departed On'), (str, datetime)) else None,
+                bank_account_number=str(row['Bank Account Number']) if row.get('Bank Account Number') is not None else None,
+                bank_name=row.get('Bank Name'),
+                bank_swift_code=str(row['Bank Swift Code']) if row.get('Bank Swift Code') is not None else None,
+                bank_branch=row.get('Bank Branch'),
+                import_job=import_job,
+                created_at=now,
+                updated_at=now
+            )
+            # bulk inserts skip validation, so rows are validated before anything is written, the staff
+            # referencing their users once these are inserted
+            for document in [staff, created.get(emails[idx])]:
+                if document is None:
+                    continue
+                try:
+                    document.validate()
+                except ValidationError as e:
+                    raise ValueError(f"{idx} Invalid {type(document).__name__.lower()}: {e}")
+            staff_list.append(staff)
+        if new_users:
+            for user, user_id in zip(new_users, User.objects.insert(new_users, load_bulk=False)):
+                user.id = user_id
+                users[user.email] = user
+        for staff, email in zip(staff_list, emails):
+            staff.user = users[email]
+        return Staff.objects.insert(staff_list) if staff_list else []
+
     # roll forward the company's payroll codes
     def roll_forward(self, effective_from: datetime = datetime.now(tz=timezone.utc)):
         """
@@ -495,13 +667,16 @@ class Staff(BaseDocument):
     updated_at: datetime = DateTimeField()
     company: 'Company' = ReferenceField('Company', required=True)
     user: Optional['User'] = ReferenceField('User')
+    # the import job that created the staff member, so a retried job knows the rows it already imported
+    import_job: Optional['Job'] = ReferenceField('Job')
 
     meta = {
         'collection': 'staff',
         'indexes': [
             'company',
             'national_id_number',
-            ('first_name', 'last_name')
+            ('first_name', 'last_name'),
+            {'fields': ['import_job'], 'sparse': True}
         ]
     }
 
@@ -534,6 +709,7 @@ class PayrollCode(BaseDocument):
     tags: List[str] = ListField(StringField(), required=False)
     value: Optional[float] = DecimalField(default=-1)
     formula: Optional[str] = StringField(default="")
+    rounding: str = StringField(choices=engine.ROUNDING_MODES, default='half_up')
     effective_from: datetime = DateTimeField(default=datetime.now(tz=timezone.utc))
     order: int = IntField(default=0, unique_with=['company', 'effective_from'])
     created_at: datetime = DateTimeField(default=datetime.now(tz=timezone.utc))
@@ -577,7 +753,15 @@ class Computation(BaseDocument):
     notes: Optional[str] = StringField()
     payroll_period_start: datetime = DateField(required=True)
     payroll_period_end: datetime = DateField(required=True)
-    status: str = StringField(required=True, choices=['draft', 'processing', 'completed'], default='draft')
+    status: str = StringField(required=True, choices=['draft', 'processing', 'completed', 'failed'], default='draft')
+    staff_total: int = IntField(default=0)
+    staff_processed: int = IntField(default=0)
+    shards_total: int = IntField(default=0)
+    shards_completed: int = IntField(default=0)
+    run_params: Dict[str, Any] = DictField()
+    profile: Dict[str, Any] = DictField()
+    run_started_at: Optional[datetime] = DateTimeField()
+    heartbeat_at: Optional[datetime] = DateTimeField()
     generated_by: 'User' = ReferenceField('User', required=True)
     created_at: datetime = DateTimeField(default=datetime.now(tz=timezone.utc))
     updated_at: datetime = DateTimeField()
@@ -586,7 +770,8 @@ class Computation(BaseDocument):
         'collection': 'computations',
         'indexes': [
             'company',
-            ('company', 'payroll_period_start', 'payroll_period_end')
+            ('company', 'payroll_period_start', 'payroll_period_end'),
+            ('status', 'heartbeat_at')
         ]
     }
 
@@ -605,36 +790,435 @@ class Computation(BaseDocument):
         """Returns a formatted string of the payroll period."""
         return f"{self.payroll_period_start.strftime('%Y-%m-%d')} to {self.payroll_period_end.strftime('%Y-%m-%d')}"
     
-    def run(self):
+    def run(self, outputs: Optional[List[str]] = None, mode: str = "row", batch_size: Optional[int] = None, workers: Optional[int] = None, incremental: bool = False, resume: bool = False, arithmetic: str = "float", profile: bool = False):
         """
         Run the payroll computation for all staff members in the company
         Get all staff members in the company
-        Get each staff member's computation components in order ascending
-        Calculate the value of each component passing the dict of the previous components
-        Save the value of the computed component
+        Get the execution plan of the company's payroll codes, dependencies first
+        Calculate the components of each staff member with the plan generated as one Python function
+        Buffer the computed values and save them in bulk every batch_size components
+        When outputs are given only the codes they depend on are computed
+        The vectorized mode evaluates each code once over all staff as a column
+        The parallel mode evaluates shards of staff as columns in a pool of worker processes
+        An incremental run only recomputes staff whose inputs, codes or bands changed since their last run
+        and yields the stored values of the others
+        Every flushed batch is a checkpoint: resuming an interrupted run skips the staff committed since it started
+        The cents arithmetic holds every amount as whole cents, rounding each code's result with its rounding rule,
+        formulas being rewritten by engine.cents_formula so their literals and products stay in cents
+        A profiled run stores the time and calls spent per stage, payroll code and query in profile;
+        the run stage also counts the time the caller spends consuming the yielded rows
         """
+        assert mode in ["row", "vectorized", "parallel"], "Invalid computation mode"
+        assert arithmetic in engine.ARITHMETICS, "Invalid computation arithmetic"
+        profiler = engine.Profiler(enabled=profile)
+        started = time.perf_counter()
+        with profiler.stage("plan"):
+            plan: engine.Plan = engine.get_plan(self.company, self.payroll_period_start, outputs=outputs)
+        with profiler.stage("band_tables"):
+            band_tables: engine.BandTables = engine.get_band_tables(self.payroll_period_start)
+        with profiler.query("staff.find"):
+            staff: List[Staff] = list(Staff.objects(company=self.company))
+        with profiler.query("computation_components.find"):
+            components = self.prefetch_components()
+        with profiler.stage("fingerprints"):
+            plan_version = engine.plan_version(plan, band_tables, arithmetic)
+            fingerprints = engine.input_fingerprints(plan, staff, components)
+        now = datetime.now(tz=timezone.utc)
+        checkpoint = self.run_started_at if resume and not incremental else None
+        with profiler.query("computation_rows.find"):
+            current = self.current_rows(fingerprints, plan_version, since=checkpoint) if incremental or checkpoint else set()
+        if not (resume and self.run_started_at):
+            self.run_started_at = now
+        self.run_params = {
+            key: value for key, value in dict(outputs=outputs, mode=mode, batch_size=batch_size, workers=workers, incremental=incremental, arithmetic=arithmetic, profile=profile or None).items()
+            if value is not None
+        }
+        self.profile = {}
+        self.heartbeat_at = now
         self.status = 'processing'
-        self.save()
-        staff: List[Staff] = Staff.objects(company=self.company)
+        self.staff_total = len(staff)
+        self.staff_processed = 0
+        self.shards_total = 0
+        self.shards_completed = 0
+        with profiler.query("computations.save"):
+            self.save()
+        # heartbeats are sent from a timer as well as on every flush, since evaluating all staff as columns
+        # or a slow consumer of the rows can go longer than job_stale_after_seconds without one
+        with utils.Heartbeat(self.beat, settings.heartbeat_interval_seconds):
+            writer = engine.ComponentWriter(self, batch_size or settings.computation_batch_size, on_flush=self.record_progress, plan_version=plan_version, profiler=profiler)
+            for employee in staff:
+                if str(employee.id) in current:
+                    writer.skip_row()
+                    yield employee, self.stored_params(plan, employee, components)
+            staff = [employee for employee in staff if str(employee.id) not in current]
+            if current:
+                logger.info(f"Computation {self.id} skipped {len(current)} unchanged staff, recomputing {len(staff)}")
+            if mode == "parallel":
+                yield from self._run_parallel(plan, staff, components, band_tables, fingerprints, writer, workers or settings.computation_workers, arithmetic, profiler)
+            elif mode == "vectorized":
+                yield from self._run_vectorized(plan, staff, components, band_tables, fingerprints, writer, arithmetic, profiler)
+            else:
+                yield from self._run_rows(plan, staff, components, band_tables, fingerprints, writer, arithmetic, profiler)
+            writer.flush()
+            self.status = 'completed'
+            if profiler.enabled:
+                profiler.add("stages", "run", time.perf_counter() - started)
+                self.profile = profiler.to_dict()
+            self.save()
+
+    def current_rows(self, fingerprints: Dict[str, str], plan_version: str, since: Optional[datetime] = None) -> Set[str]:
+        """
+        Get the ids of the staff members whose stored row was computed from their current inputs with the current plan
+        When since is given only rows committed after it count
+        """
+        current: Set[str] = set()
+        rows = ComputationRow.objects(computation=self, plan_version=plan_version)
+        if since is not None:
+            rows = rows.filter(updated_at__gte=since)
+        for row in rows.only('staff', 'fingerprint').no_dereference():
+            staff_id = str(row.staff.id)
+            if fingerprints.get(staff_id) == row.fingerprint:
+                current.add(staff_id)
+        return current
+
+    def simulate(self, bands: Optional[Dict[str, List[Dict[str, float]]]] = None, values: Optional[Dict[str, float]] = None, multipliers: Optional[Dict[str, float]] = None, outputs: Optional[List[str]] = None) -> Tuple[List[Staff], Any, Any]:
+        """
+        Evaluate the computation's inputs as they are and under a what-if scenario, without persisting anything
+        Returns the staff members with the baseline and scenario results, indexed by staff id
+        """
+        plan: engine.Plan = engine.get_plan(self.company, self.payroll_period_start, outputs=outputs)
+        band_tables: engine.BandTables = engine.get_band_tables(self.payroll_period_start)
+        staff: List[Staff] = list(Staff.objects(company=self.company))
+        inputs = engine.load_inputs(plan, staff, self.prefetch_components())
+        baseline, scenario = engine.simulate(plan, inputs, band_tables, bands=bands, values=values, multipliers=multipliers)
+        return staff, baseline, scenario
+
+    def diff(self, previous: "Computation", threshold: float = 0.0):
+        """
+        Compare the computation with a previous one of the company inside MongoDB
+        Components are matched by staff member and variable, so codes re-issued under a new effective date still line up
+        Yields the totals per variable, then each staff member who is new, departed,
+        or has a variable whose value moved by more than the threshold
+        """
+        variable_of = {"$switch": {
+            "branches": [
+                {"case": {"$eq": ["$payroll_component", code_id]}, "then": variable}
+                for code_id, variable in PayrollCode.objects(company=self.company).scalar("id", "variable")
+            ],
+            "default": "unknown"
+        }}
+        cells = [
+            {"$match": {"computation": {"$in": [previous.id, self.id]}}},
+            {"$project": {
+                "staff": 1,
+                "variable": variable_of,
+                "current": {"$cond": [{"$eq": ["$computation", self.id]}, "$value", None]},
+                "previous": {"$cond": [{"$eq": ["$computation", previous.id]}, "$value", None]}
+            }},
+        ]
+        totals = {
+            group["_id"]: group
+            for group in ComputationComponent.objects.aggregate(cells + [
+                {"$group": {"_id": "$variable", "current": {"$sum": "$current"}, "previous": {"$sum": "$previous"}}}
+            ], allowDiskUse=True)
+        }
+        yield {"summary": {
+            variable: {"previous": round(group["previous"], 2), "current": round(group["current"], 2), "delta": round(group["current"] - group["previous"], 2)}
+            for variable, group in sorted(totals.items())
+        }}
+        changed = {"$or": [
+            {"$eq": ["$$cell.current", None]},
+            {"$eq": ["$$cell.previous", None]},
+            {"$gt": [{"$abs": {"$subtract": ["$$cell.current", "$$cell.previous"]}}, threshold]}
+        ]}
+        staff_rows = ComputationComponent.objects.aggregate(cells + [
+            {"$group": {"_id": {"staff": "$staff", "variable": "$variable"}, "current": {"$max": "$current"}, "previous": {"$max": "$previous"}}},
+            {"$group": {
+                "_id": "$_id.staff",
+                "cells": {"$push": {"variable": "$_id.variable", "current": "$current", "previous": "$previous"}},
+                "in_current": {"$max": {"$cond": [{"$ne": ["$current", None]}, 1, 0]}},
+                "in_previous": {"$max": {"$cond": [{"$ne": ["$previous", None]}, 1, 0]}}
+            }},
+            {"$project": {"in_current": 1, "in_previous": 1, "cells": {"$filter": {"input": "$cells", "as": "cell", "cond": changed}}}},
+            {"$match": {"cells.0": {"$exists": True}}},
+            {"$lookup": {"from": Staff._get_collection_name(), "localField": "_id", "foreignField": "_id", "as": "staff"}}
+        ], allowDiskUse=True)
+        for row in staff_rows:
+            employee = row["staff"][0] if row["staff"] else {}
+            yield {
+                "staff": {
+                    "id": str(row["_id"]),
+                    "staff_number": employee.get("staff_number"),
+                    "name": f"{employee.get('first_name', '')} {employee.get('last_name', '')}".strip()
+                },
+                "status": "changed" if row["in_current"] and row["in_previous"] else "new" if row["in_current"] else "departed",
+                "changes": {
+                    cell["variable"]: {
+                        "previous": cell["previous"],
+                        "current": cell["current"],
+                        "delta": None if cell["previous"] is None or cell["current"] is None else round(cell["current"] - cell["previous"], 2)
+                    }
+                    for cell in sorted(row["cells"], key=lambda cell: cell["variable"])
+                }
+            }
+
+    def stored_params(self, plan: engine.Plan, employee: Staff, components: Dict[Tuple[str, str], "ComputationComponent"]) -> Dict[str, float]:
+        """
+        Read a staff member's stored component values as the params a run would have computed
+        """
+        params: Dict[str, float] = {}
+        for payroll_code in plan:
+            component = components.get((str(employee.id), str(payroll_code.id)))
+            if component is not None:
+                params[payroll_code.variable] = float(component.value)
+        return params
+
+    def recompute(self, variables: List[str], batch_size: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Re-evaluate only the payroll codes downstream of the given variables, e.g. after a formula or fixed value was edited
+        The codes they read are taken from the stored components instead of being computed again,
+        so results are consistent with the stored, rounded upstream values
+        Only cells whose value changed are written; staff missing a stored upstream value are skipped
+        Codes are evaluated with the arithmetic of the last run, so its values and plan version stay comparable
+        Raises PlanError when a variable is not a computed payroll code of the plan
+        """
+        plan: engine.Plan = engine.get_plan(self.company, self.payroll_period_start)
+        inputs = [code.variable for code in plan.inputs() if code.variable in variables]
+        if inputs:
+            raise engine.PlanError(f"{', '.join(inputs)} are input payroll codes, which are uploaded rather than computed")
+        arithmetic = (self.run_params or {}).get("arithmetic", "float")
+        affected = engine.downstream_variables(plan, variables)
+        upstream = set().union(*(plan.dependencies[variable] for variable in affected)) - affected
+        band_tables: engine.BandTables = engine.get_band_tables(self.payroll_period_start)
+        staff: List[Staff] = list(Staff.objects(company=self.company))
+        components = self.prefetch_components()
+        stored = engine.load_components([code for code in plan if code.variable in upstream], staff, components)
+        complete = stored.notna().all(axis=1)
+        steps = [engine.CompiledStep(variable, "input", None, None) for variable in stored.columns]
+        steps += [step for step in plan.compiled_steps(arithmetic) if step.variable in affected]
+        results = engine.evaluate_frame(steps, stored[complete], band_tables, arithmetic)
+        fingerprints = engine.input_fingerprints(plan, staff, components)
+        rows = {str(row.staff.id): row.fingerprint for row in ComputationRow.objects(computation=self).only('staff', 'fingerprint').no_dereference()}
+        writer = engine.ComponentWriter(self, batch_size or settings.computation_batch_size, plan_version=engine.plan_version(plan, band_tables, arithmetic))
+        value_field = ComputationComponent._fields['value']
+        affected_codes = [code for code in plan if code.variable in affected and code.code_type != "input"]
+        updated = 0
         for employee in staff:
-            params: Dict[str, float] = {}
-            nssf_bands_monthly: List[Dict[str, Decimal]] = Band.objects(band_type='NSSF', band_frequency='monthly', period_start__lte=self.payroll_period_start, period_end__gte=self.payroll_period_start).order_by('lower')
-            paye_bands_monthly: List[Dict[str, Decimal]] = Band.objects(band_type='PAYE', band_frequency='monthly', period_start__lte=self.payroll_period_start, period_end__gte=self.payroll_period_start).order_by('lower')
-            params['nssf_bands_monthly'] = [{"lower": band.lower, "upper": band.upper, "rate": band.rate} for band in nssf_bands_monthly]
-            params['paye_bands_monthly'] = [{"lower": band.lower, "upper": band.upper, "rate": band.rate} for band in paye_bands_monthly]
-            exec(predefined_formulae, params)
-            payroll_codes: List[PayrollCode] = PayrollCode.objects(company=self.company, effective_from__lte=self.payroll_period_start).order_by('order')
-            for payroll_code in payroll_codes:
-                computation_component = ComputationComponent.objects(computation=self, payroll_component=payroll_code, staff=employee).first()
-                if computation_component is None:
-                    computation_component = ComputationComponent(computation=self, payroll_component=payroll_code, staff=employee)
-                params[payroll_code.variable] = float(computation_component.calculate(params))
-                computation_component.save()
-            yield employee, params
-        self.status = 'completed'
-        self.save()
+            staff_id = str(employee.id)
+            if not complete[staff_id]:
+                continue
+            changed: List[Tuple[ObjectId, float]] = []
+            for payroll_code in affected_codes:
+                value = results.at[staff_id, payroll_code.variable]
+                if arithmetic == "cents":
+                    value = engine.from_cents(value)
+                component = components.get((staff_id, str(payroll_code.id)))
+                if component is None or value_field.to_python(value_field.to_mongo(value)) != component.value:
+                    changed.append((payroll_code.id, value))
+            updated += len(changed)
+            # the row is current for the new plan only when it was computed from the staff member's current inputs
+            writer.add_row(employee.id, changed, fingerprints[staff_id] if rows.get(staff_id) == fingerprints[staff_id] else None)
+        writer.flush()
+        recomputed = [variable for variable in plan.variables if variable in affected]
+        logger.info(f"Computation {self.id} recomputed {', '.join(recomputed)}, {updated} components updated")
+        return {
+            "variables": recomputed,
+            "staff": int(complete.sum()),
+            "skipped": int((~complete).sum()),
+            "updated": updated,
+        }
+
+    def beat(self) -> None:
+        """
+        Mark a processing run as alive without recording progress, from the heartbeat thread
+        """
+        Computation.objects(id=self.id, status='processing').update_one(set__heartbeat_at=datetime.now(tz=timezone.utc))
+
+    def record_progress(self, staff_processed: int) -> None:
+        """
+        Record how many staff members have had their components persisted, as a heartbeat of the run
+        """
+        self.staff_processed = staff_processed
+        self.heartbeat_at = datetime.now(tz=timezone.utc)
+        Computation.objects(id=self.id).update_one(set__staff_processed=staff_processed, set__heartbeat_at=self.heartbeat_at)
+
+    def _check_compensation(self, frame: pd.DataFrame, seen: Optional[Set[str]] = None) -> Tuple[pd.DataFrame, Optional[pd.Series], Dict[str, "PayrollCode"], Dict[str, ObjectId]]:
+        """
+        Collect every invalid cell of a compensation sheet in one pass of vectorized checks, resolving its codes
+        with one query and its staff numbers with one $in query
+        Returns the errors, the stripped staff numbers and the codes and staff ids they resolved to
+        """
+        if 'staff_number' not in frame.columns:
+            return column_errors(['staff_number'], "Column {column} is missing from the file"), None, {}, {}
+        variables = [str(column) for column in frame.columns if column != 'staff_number']
+        codes = engine.effective_codes(PayrollCode.objects(
+            company=self.company,
+            code_type="input",
+            effective_from__lte=self.payroll_period_start,
+            variable__in=variables
+        ))
+        errors = [column_errors([variable for variable in variables if variable not in codes], "Payroll code with variable {column} not found")]
+        staff_numbers = frame['staff_number'].astype(str).str.strip()
+        staff_ids = {
+            staff_number: staff_id
+            for staff_id, staff_number in Staff.objects(company=self.company, staff_number__in=staff_numbers.unique().tolist()).scalar('id', 'staff_number')
+        }
+        unknown = ~staff_numbers.isin(list(staff_ids))
+        errors.append(cell_errors(frame, unknown.to_frame('staff_number'), lambda e: "Staff with staff number " + e['value'].astype(str) + f" not found in the company {self.company.name}"))
+        repeated = staff_numbers.duplicated() | staff_numbers.isin(list(seen or ()))
+        errors.append(cell_errors(frame, repeated.to_frame('staff_number'), lambda e: "Staff with staff number " + e['value'].astype(str) + " appears more than once in the file"))
+        known = [variable for variable in variables if variable in codes]
+        invalid = frame[known].apply(pd.to_numeric, errors='coerce').isna()
+        errors.append(cell_errors(frame, invalid, lambda e: "Invalid value for " + e['column'] + " of staff " + staff_numbers.reindex(e['row']).to_numpy()))
+        return collect_errors(errors), staff_numbers, codes, staff_ids
+
+    def validate_compensation(self, frame: pd.DataFrame, seen: Optional[Set[str]] = None) -> pd.DataFrame:
+        """
+        Collect every invalid cell of a compensation sheet, as a DataFrame of IMPORT_ERROR_COLUMNS
+        in the order of the checks, empty when the sheet can be imported
+        A sheet validated in chunks passes the same seen set with every chunk, so staff repeated across chunks are caught too
+        """
+        errors, staff_numbers, _, _ = self._check_compensation(frame, seen)
+        if seen is not None and staff_numbers is not None:
+            seen.update(staff_numbers)
+        return errors
+
+    def import_compensation(self, frame: pd.DataFrame, seen: Optional[Set[str]] = None) -> Dict[str, int]:
+        """
+        Upsert the input components of a compensation sheet, one row per staff member keyed by staff_number
+        and one column per input payroll code variable
+        The codes are resolved in one query and the staff numbers in one $in query, the sheet is validated as a whole,
+        the stored values of its cells are read in one query and only new or changed cells are written, in one bulk write,
+        so uploading a corrected sheet again costs in proportion to its changes
+        Raises ValueError on the first error validate_compensation finds
+        A sheet imported in chunks passes the same seen set with every chunk, so staff repeated across chunks are caught too
+        Returns the number of components inserted, updated and left unchanged
+        """
+        errors, staff_numbers, codes, staff_ids = self._check_compensation(frame, seen)
+        if len(errors):
+            raise ValueError(errors.iloc[0]['message'])
+        variables = [str(column) for column in frame.columns if column != 'staff_number']
+        values = frame[variables].apply(pd.to_numeric, errors='coerce')
+        collection = ComputationComponent._get_collection()
+        stored = {
+            (document["staff"], document["payroll_component"]): document["value"]
+            for document in collection.find(
+                {"computation": self.id, "payroll_component": {"$in": [code.id for code in codes.values()]}, "staff": {"$in": list(staff_ids.values())}},
+                {"staff": 1, "payroll_component": 1, "value": 1}
+            )
+        }
+        if seen is not None:
+            seen.update(staff_numbers)
+        now = datetime.now(tz=timezone.utc)
+        value_field = ComputationComponent._fields['value']
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+        operations: List[UpdateOne] = []
+        for staff_number, row in zip(staff_numbers, values.itertuples(index=False, name=None)):
+            for variable, value in zip(variables, row):
+                key = (staff_ids[staff_number], codes[variable].id)
+                value = value_field.to_mongo(value)
+                if key not in stored:
+                    counts["inserted"] += 1
+                elif value_field.to_python(stored[key]) != value_field.to_python(value):
+                    counts["updated"] += 1
+                else:
+                    counts["unchanged"] += 1
+                    continue
+                operations.append(UpdateOne(
+                    {"computation": self.id, "payroll_component": key[1], "staff": key[0]},
+                    {"$set": {"value": value, "updated_at": now}, "$setOnInsert": {"created_at": now}},
+                    upsert=True
+                ))
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+        return counts
+
+    def prefetch_components(self) -> Dict[Tuple[str, str], "ComputationComponent"]:
+        """
+        Load every component of the computation in one streamed query, indexed by (staff id, payroll code id)
+        The first stored component of a cell wins, as with ComputationComponent.objects(...).first()
+        """
+        components: Dict[Tuple[str, str], ComputationComponent] = {}
+        for component in ComputationComponent.objects(computation=self).no_dereference().batch_size(1000):
+            components.setdefault((str(component.staff.id), str(component.payroll_component.id)), component)
+        return components
+
+    def _run_rows(self, plan: engine.Plan, staff: List[Staff], components: Dict[Tuple[str, str], "ComputationComponent"], band_tables: engine.BandTables, fingerprints: Dict[str, str], writer: engine.ComponentWriter, arithmetic: str = "float", profiler: Optional[engine.Profiler] = None):
+        profiling = profiler is not None and profiler.enabled
+        generated = plan.program(arithmetic, profile=profiling)
+        timings = [0.0] * len(generated.computed)
+        program = generated.bind(band_tables, timings)
+        input_ids = [str(payroll_code.id) for payroll_code in plan.inputs()]
+        computed_codes = [payroll_code for payroll_code in plan if payroll_code.code_type != "input"]
+        to_value = engine.to_cents if arithmetic == "cents" else float
+        for employee in staff:
+            staff_id = str(employee.id)
+            inputs = []
+            for code_id in input_ids:
+                component = components.get((staff_id, code_id))
+                assert component is not None and component.value > -1, "Invalid value for input payroll component"
+                inputs.append(to_value(component.value))
+            if profiling:
+                started = time.perf_counter()
+                params = program(*inputs)
+                profiler.add("stages", "evaluate", time.perf_counter() - started)
+            else:
+                params = program(*inputs)
+            yield employee, self._write_row(employee, params, computed_codes, fingerprints, writer, arithmetic)
+        if profiling:
+            for variable, seconds in zip(generated.computed, timings):
+                profiler.add("codes", variable, seconds, len(staff))
+
+    def _run_vectorized(self, plan: engine.Plan, staff: List[Staff], components: Dict[Tuple[str, str], "ComputationComponent"], band_tables: engine.BandTables, fingerprints: Dict[str, str], writer: engine.ComponentWriter, arithmetic: str = "float", profiler: Optional[engine.Profiler] = None):
+        if not staff:
+            return
+        profiler = profiler or engine.Profiler(enabled=False)
+        with profiler.stage("load_inputs"):
+            inputs = engine.load_inputs(plan, staff, components)
+        timings: Optional[Dict[str, float]] = {} if profiler.enabled else None
+        with profiler.stage("evaluate"):
+            results = engine.evaluate_frame(plan.compiled_steps(arithmetic), inputs, band_tables, arithmetic, timings)
+        for variable, seconds in (timings or {}).items():
+            profiler.add("codes", variable, seconds)
+        yield from self._collect_results(plan, staff, results, fingerprints, writer, arithmetic)
+
+    def _run_parallel(self, plan: engine.Plan, staff: List[Staff], components: Dict[Tuple[str, str], "ComputationComponent"], band_tables: engine.BandTables, fingerprints: Dict[str, str], writer: engine.ComponentWriter, workers: int, arithmetic: str = "float", profiler: Optional[engine.Profiler] = None):
+        if not staff:
+            return
+        profiler = profiler or engine.Profiler(enabled=False)
+        with profiler.stage("load_inputs"):
+            inputs = engine.load_inputs(plan, staff, components)
+        staff_by_id: Dict[str, Staff] = {str(employee.id): employee for employee in staff}
+        for shard, shards_total, results, timings in engine.evaluate_sharded(plan.compiled_steps(arithmetic), inputs, band_tables, workers, settings.computation_shard_size, arithmetic, profiler.enabled):
+            # the evaluate stage sums the time the workers spent on the shards, not the wall time of the pool
+            for variable, seconds in (timings or {}).items():
+                profiler.add("codes", variable, seconds)
+            if timings is not None:
+                profiler.add("stages", "evaluate", sum(timings.values()))
+            yield from self._collect_results(plan, [staff_by_id[staff_id] for staff_id in results.index], results, fingerprints, writer, arithmetic)
+            writer.flush()
+            self.shards_total = shards_total
+            self.shards_completed += 1
+            with profiler.query("computations.update_one"):
+                Computation.objects(id=self.id).update_one(set__shards_total=shards_total, set__shards_completed=self.shards_completed)
+            logger.info(f"Computation {self.id} shard {shard + 1} of {shards_total} completed")
+
+    def _collect_results(self, plan: engine.Plan, staff: List[Staff], results: Any, fingerprints: Dict[str, str], writer: engine.ComponentWriter, arithmetic: str = "float"):
+        rows: Dict[str, Dict[str, Any]] = results.to_dict(orient="index")
+        computed_codes = [payroll_code for payroll_code in plan if payroll_code.code_type != "input"]
+        for employee in staff:
+            yield employee, self._write_row(employee, rows[str(employee.id)], computed_codes, fingerprints, writer, arithmetic)
+
+    def _write_row(self, employee: Staff, params: Dict[str, Any], computed_codes: List["PayrollCode"], fingerprints: Dict[str, str], writer: engine.ComponentWriter, arithmetic: str) -> Dict[str, float]:
+        """
+        Buffer the computed components of a staff member and return their values as floats
+        """
+        if arithmetic == "cents":
+            writer.add_row(employee.id, [(payroll_code.id, engine.from_cents(params[payroll_code.variable])) for payroll_code in computed_codes], fingerprints[str(employee.id)])
+            return {variable: value / 100 for variable, value in params.items()}
+        writer.add_row(employee.id, [(payroll_code.id, params[payroll_code.variable]) for payroll_code in computed_codes], fingerprints[str(employee.id)])
+        return params
 
-    
 class ComputationComponent(BaseDocument):
     """
     Represents the intersection between Computation, PayrollComponent, and Staff.
@@ -651,7 +1235,7 @@ class ComputationComponent(BaseDocument):
     meta = {
         'collection': 'computation_components',
         'indexes': [
-            ('computation', 'payroll_component', 'staff'),
+            {'fields': ('computation', 'payroll_component', 'staff'), 'unique': True},
             'computation',
             'staff'
         ]
@@ -663,18 +1247,196 @@ class ComputationComponent(BaseDocument):
     def __repr__(self) -> str:
         return f"ComputationComponent(component='{self.payroll_component.name}', staff='{self.staff.full_name}' value={self.value})"
         
-    def calculate(self, params: Dict[str, float] = {}):
+    @classmethod
+    def has_unique_cells(cls) -> bool:
+        """
+        Whether the unique index on the (computation, payroll code, staff) cell exists, read from the raw collection
+        """
+        indexes = get_db()[cls._meta['collection']].index_information()
+        return any(index.get('unique') and [field for field, _ in index['key']] == ['computation', 'payroll_component', 'staff'] for index in indexes.values())
+
+    @classmethod
+    def remove_duplicates(cls) -> int:
+        """
+        Delete all but the first stored component of each (computation, payroll code, staff) cell,
+        the one runs have always read, so the unique index on the cell can be built
+        Works on the raw collection, since getting the document's collection builds its indexes
+        Returns the number of components deleted
+        """
+        collection = get_db()[cls._meta['collection']]
+        duplicates = collection.aggregate([
+            {"$sort": {"_id": 1}},
+            {"$group": {"_id": {"computation": "$computation", "payroll_component": "$payroll_component", "staff": "$staff"}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ], allowDiskUse=True)
+        removed = 0
+        for duplicate in duplicates:
+            removed += collection.delete_many({"_id": {"$in": duplicate["ids"][1:]}}).deleted_count
+        return removed
+
+    def calculate(self, params: Dict[str, float] = {}, functions: Optional[Dict[str, Any]] = None, profiler: Optional[engine.Profiler] = None):
         """
             Calculate the value of the payroll component
+            Formulas read the previous components from params and the predefined formulae from functions
+            With an enabled profiler the time spent on the formula is added to the payroll code's timing
         """
         if self.payroll_component.code_type == "input":
             assert self.value > -1, "Invalid value for input payroll component"
         if self.payroll_component.code_type == "fixed":
             self.value: float = self.payroll_component.value
         if self.payroll_component.code_type == "formula":
-            self.value: float = eval(self.payroll_component.formula, globals(), params)
+            started = time.perf_counter() if profiler is not None and profiler.enabled else None
+            self.value: float = eval(engine.compile_formula(self.payroll_component), globals() if functions is None else functions, params)
+            if started is not None:
+                profiler.add("codes", self.payroll_component.variable, time.perf_counter() - started)
         return self.value
     
     def save(self, *args: Any, **kwargs: Any) -> Any:
         self.updated_at = datetime.now(tz=timezone.utc)
-        return super(ComputationComponent, self).save(*args, **kwargs)
\ No newline at end of file
+        return super(ComputationComponent, self).save(*args, **kwargs)
+
+class ComputationRow(BaseDocument):
+    """
+    Records what a staff member's computed components were derived from:
+    a fingerprint of their input components and the version of the plan and bands.
+    A rerun skips staff whose fingerprint and plan version are unchanged.
+    """
+    computation: 'Computation' = ReferenceField('Computation', required=True, reverse_delete_rule=CASCADE)
+    staff: 'Staff' = ReferenceField('Staff', required=True)
+    fingerprint: str = StringField(required=True)
+    plan_version: str = StringField(required=True)
+    created_at: datetime = DateTimeField(default=lambda: datetime.now(tz=timezone.utc))
+    updated_at: datetime = DateTimeField()
+
+    meta = {
+        'collection': 'computation_rows',
+        'indexes': [
+            {'fields': ('computation', 'staff'), 'unique': True}
+        ]
+    }
+
+    def __str__(self) -> str:
+        return f"{self.staff.full_name} in {self.computation}"
+
+    def __repr__(self) -> str:
+        return f"ComputationRow(staff='{self.staff.full_name}', fingerprint='{self.fingerprint}', plan_version='{self.plan_version}')"
+
+    def save(self, *args: Any, **kwargs: Any) -> Any:
+        self.updated_at = datetime.now(tz=timezone.utc)
+        return super(ComputationRow, self).save(*args, **kwargs)
+
+class Batch(BaseDocument):
+    """
+    Represents a scheduled group of payroll runs across companies.
+    Each computation of the batch is a job, claimed by deadline and size
+    within the global and per company concurrency caps.
+    """
+    name: str = StringField(required=True)
+    submitted_by: 'User' = ReferenceField('User')
+    created_at: datetime = DateTimeField(default=lambda: datetime.now(tz=timezone.utc))
+    updated_at: datetime = DateTimeField()
+
+    meta = {
+        'collection': 'batches',
+    }
+
+    def __str__(self) -> str:
+        return self.name
+
+    def __repr__(self) -> str:
+        return f"Batch(name='{self.name}')"
+
+    def save(self, *args: Any, **kwargs: Any) -> Any:
+        self.updated_at = datetime.now(tz=timezone.utc)
+        return super(Batch, self).save(*args, **kwargs)
+
+    def progress(self) -> Dict[str, Any]:
+        """
+        Aggregate the status and progress of the batch's jobs in one query
+        A job that has not reported its total yet counts its size, so queued work keeps the batch below 100%
+        """
+        jobs: Dict[str, int] = {status: 0 for status in ['queued', 'running', 'completed', 'failed']}
+        processed = total = 0
+        for group in Job.objects(batch=self).aggregate([
+            {"$group": {"_id": "$status", "count": {"$sum": 1}, "processed": {"$sum": "$processed"}, "total": {"$sum": {"$max": ["$total", "$size"]}}}}
+        ]):
+            jobs[group["_id"]] = group["count"]
+            processed += group["processed"]
+            total += group["total"]
+        if jobs['queued'] or jobs['running']:
+            status = 'running' if jobs['running'] or jobs['completed'] or jobs['failed'] else 'queued'
+        else:
+            status = 'failed' if jobs['failed'] else 'completed'
+        return {
+            "id": str(self.id),
+            "name": self.name,
+            "status": status,
+            "jobs": jobs,
+            "processed": processed,
+            "total": total,
+            "percent": 100.0 if status == 'completed' else round(100 * processed / total, 2) if total else 0.0,
+        }
+
+class Job(BaseDocument):
+    """
+    Represents a unit of background work in the Mongo backed job queue.
+    Workers claim queued jobs atomically, report progress while they run
+    and record the outcome so clients can poll instead of holding a request open.
+    """
+    kind: str = StringField(required=True, choices=['computation', 'import_staff', 'import_compensation'])
+    status: str = StringField(required=True, choices=['queued', 'running', 'completed', 'failed'], default='queued')
+    company: 'Company' = ReferenceField('Company')
+    computation: 'Computation' = ReferenceField('Computation', reverse_delete_rule=CASCADE)
+    submitted_by: 'User' = ReferenceField('User')
+    batch: Optional['Batch'] = ReferenceField('Batch', reverse_delete_rule=CASCADE)
+    deadline: Optional[datetime] = DateTimeField()
+    size: int = IntField(default=0)
+    params: Dict[str, Any] = DictField()
+    processed: int = IntField(default=0)
+    total: int = IntField(default=0)
+    attempts: int = IntField(default=0)
+    error: Optional[str] = StringField()
+    # uploads of import jobs are kept on disk until the job completes or finally fails,
+    # checkpoint counting the rows already imported so a retried job resumes after them
+    upload_path: Optional[str] = StringField()
+    checkpoint: int = IntField(default=0)
+    # outcome of import jobs, the report listing every invalid cell of a rejected upload
+    result: Dict[str, int] = DictField()
+    error_count: int = IntField(default=0)
+    error_report: Optional[str] = StringField()
+    worker: Optional[str] = StringField()
+    started_at: Optional[datetime] = DateTimeField()
+    finished_at: Optional[datetime] = DateTimeField()
+    heartbeat_at: Optional[datetime] = DateTimeField()
+    created_at: datetime = DateTimeField(default=lambda: datetime.now(tz=timezone.utc))
+    updated_at: datetime = DateTimeField()
+
+    meta = {
+        'collection': 'jobs',
+        'indexes': [
+            ('status', 'deadline', '-size', 'created_at'),
+            ('status', 'company'),
+            'computation',
+            # one queued or running job per computation, enforced by the database for concurrent submissions
+            {'fields': ['computation'], 'name': 'active_computation', 'unique': True, 'partialFilterExpression': {'computation': {'$exists': True}, 'status': {'$in': ['queued', 'running']}}},
+            'company',
+            'batch'
+        ]
+    }
+
+    def __str__(self) -> str:
+        return f"{self.kind} job ({self.status})"
+
+    def __repr__(self) -> str:
+        return f"Job(kind='{self.kind}', status='{self.status}', processed={self.processed}, total={self.total})"
+
+    def save(self, *args: Any, **kwargs: Any) -> Any:
+        self.updated_at = datetime.now(tz=timezone.utc)
+        return super(Job, self).save(*args, **kwargs)
+
+    @property
+    def percent(self) -> float:
+        """Returns the share of the job's work that is done."""
+        if self.status == 'completed':
+            return 100.0
+        return round(100 * self.processed / self.total, 2) if self.total else 0.0
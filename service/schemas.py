@@ -1,7 +1,7 @@
 from decimal import Decimal
 from openpyxl import formula
-from pydantic import BaseModel,UUID4
-from typing import Any, List,Optional
+from pydantic import BaseModel,Field,UUID4
+from typing import Any, Dict, List, Literal, Optional
 from datetime import datetime
 from bson import ObjectId
 from decimal import Decimal
@@ -123,7 +123,7 @@ class BandCreate(BaseModel):
     band_type: str
     band_frequency: str
     lower: float
-    upper: float
+    upper: float = float("inf")
     rate: float
 
 class BandUpdate(BaseModel):
@@ -144,6 +144,13 @@ class BandInDB(ModelInDBBase):
     upper: Decimal
     rate: Decimal
 
+class StatutoryCacheStats(BaseModel):
+    hits: int
+    misses: int
+    size: int
+    maxsize: int
+    hit_rate: float
+
 class CompanyCreate(BaseModel):
     name: str
     legal_name: Optional[str] = None
@@ -257,6 +264,7 @@ class PayrollCodeCreate(BaseModel):
     tags: Optional[List[str]] = []
     value: Optional[float] = None
     formula: Optional[str] = None
+    rounding: Literal["half_up", "half_even", "down", "up"] = "half_up"
     order: int
     effective_from: datetime
 
@@ -268,6 +276,7 @@ class PayrollCodeUpdate(BaseModel):
     tags: Optional[List[str]] = []
     value: Optional[float] = None
     formula: Optional[str] = None
+    rounding: Optional[Literal["half_up", "half_even", "down", "up"]] = None
     order: Optional[int] = None
     effective_from: Optional[datetime] = None
 
@@ -280,9 +289,16 @@ class PayrollCodeInDB(ModelInDBBase):
     tags: List[str]
     value: float
     formula: str
+    rounding: str = "half_up"
     order: int
     effective_from: datetime
 
+class PayrollProgram(BaseModel):
+    arithmetic: str
+    inputs: List[str]
+    variables: List[str]
+    source: str
+
 class ComputationCreate(BaseModel):
     payroll_period_start: datetime
     payroll_period_end: datetime
@@ -302,6 +318,12 @@ class ComputationInDB(ModelInDBBase):
     payroll_period_end: datetime
     notes: str
     status: str
+    staff_total: int = 0
+    staff_processed: int = 0
+    shards_total: int = 0
+    shards_completed: int = 0
+    run_started_at: Optional[datetime] = None
+    heartbeat_at: Optional[datetime] = None
     generated_by: ModelInDBBase
 
 class ComputationComponentCreate(BaseModel):
@@ -315,3 +337,96 @@ class ComputationComponentInDB(ModelInDBBase):
     payroll_component: ModelBase
     staff: ModelBase
     value: Decimal
+
+class CompensationUploadResult(BaseModel):
+    inserted: int
+    updated: int
+    unchanged: int
+
+class ComputationJobCreate(BaseModel):
+    mode: Literal["row", "vectorized", "parallel"] = "vectorized"
+    workers: Optional[int] = Field(None, ge=1)
+    batch_size: Optional[int] = Field(None, ge=1)
+    incremental: bool = True
+    arithmetic: Literal["float", "cents"] = "float"
+    profile: bool = False
+
+class ComputationRecompute(BaseModel):
+    variables: List[str]
+
+class ComputationRecomputeResult(BaseModel):
+    variables: List[str]
+    staff: int
+    skipped: int
+    updated: int
+
+class ProfileTiming(BaseModel):
+    name: str
+    seconds: float
+    calls: int
+
+class ComputationProfile(BaseModel):
+    stages: List[ProfileTiming] = []
+    codes: List[ProfileTiming] = []
+    queries: List[ProfileTiming] = []
+
+class SimulationBand(BaseModel):
+    lower: float
+    upper: Optional[float] = None
+    rate: float
+
+class ComputationSimulation(BaseModel):
+    bands: Dict[Literal["PAYE", "NSSF"], List[SimulationBand]] = {}
+    values: Dict[str, float] = {}
+    multipliers: Dict[str, float] = {}
+    outputs: Optional[List[str]] = None
+
+class JobInDB(ModelInDBBase):
+    kind: str
+    status: str
+    company: Optional[ModelBase] = None
+    computation: Optional[ModelBase] = None
+    submitted_by: Optional[ModelBase] = None
+    batch: Optional[ModelBase] = None
+    deadline: Optional[datetime] = None
+    size: int = 0
+    params: Dict[str, Any] = {}
+    processed: int
+    total: int
+    attempts: int = 0
+    error: Optional[str] = None
+    result: Dict[str, int] = {}
+    error_count: int = 0
+    worker: Optional[str] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    heartbeat_at: Optional[datetime] = None
+
+class JobProgress(BaseModel):
+    id: str
+    status: str
+    processed: int
+    total: int
+    percent: float
+
+class BatchComputation(BaseModel):
+    company_id: str
+    computation_id: str
+    deadline: Optional[datetime] = None
+
+class BatchCreate(ComputationJobCreate):
+    name: str
+    computations: List[BatchComputation]
+
+class BatchInDB(ModelInDBBase):
+    name: str
+    submitted_by: Optional[ModelBase] = None
+
+class BatchProgress(BaseModel):
+    id: str
+    name: str
+    status: str
+    jobs: Dict[str, int]
+    processed: int
+    total: int
+    percent: float
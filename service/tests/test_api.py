@@ -3,11 +3,13 @@ import json
 from unittest.mock import patch
 import pytest
 import models
+import jobs
 from .conftest import settings as test_settings
 import faker
 import pandas as pd
 import os
 import io
+import shutil
 
 pytest_plugins = ('pytest_asyncio',)
 fake = faker.Faker()
@@ -317,6 +319,74 @@ async def test_staff_api(mock_send_sms, mock_send_email,client,db):
     assert response.status_code == 204
     with pytest.raises(models.Staff.DoesNotExist):
         models.Staff.objects.get(id=staff_id)
+    # upload staff from the sample workbook and a CSV export of it
+    company = models.Company(name=fake.company(), legal_name=fake.company(), pin_number="upload", contact_email=fake.company_email())
+    company.save()
+    with open("SampleStaffData.xlsx", "rb") as sample:
+        response = client.post(f"/companies/{str(company.id)}/staff/upload",files={"file": ("SampleStaffData.xlsx", sample, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")},headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    assert [staff["staff_number"] for staff in response.json()] == ["OIDFOSAS99FD"]
+    df = pd.read_excel("SampleStaffData.xlsx", sheet_name="Staff Template")
+    df = pd.concat([df] * 3, ignore_index=True)
+    df["User Email"] = [user.email, "csv.upload.1@example.com", "csv.upload.2@example.com"]
+    df["Contact Email"] = "csv.upload@example.com"
+    df["Staff Number"] = ["CSV001", "CSV002", "CSV003"]
+    repeated = df.assign(**{"User Email": "csv.upload.3@example.com"})
+    response = client.post(f"/companies/{str(company.id)}/staff/upload",files={"file": ("staff.csv", repeated.to_csv(index=False).encode(), "text/csv")},headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 400
+    assert "appears more than once" in response.json()["detail"]["message"]
+    response = client.post(f"/companies/{str(company.id)}/staff/upload",files={"file": ("staff.csv", df.to_csv(index=False).encode(), "text/csv")},headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    assert [staff["staff_number"] for staff in response.json()] == ["CSV001", "CSV002", "CSV003"]
+    assert response.json()[0]["date_of_birth"].startswith("1999-10-22")
+    # new users are created inactive, without a phone and with a hashed random password
+    new_users = models.User.objects(email__in=["csv.upload.1@example.com", "csv.upload.2@example.com"])
+    assert new_users.count() == 2
+    assert all(not new_user.is_active and new_user.phone is None and new_user.password.startswith("$2") for new_user in new_users)
+    # users that already have a staff account are refused
+    with open("SampleStaffData.xlsx", "rb") as sample:
+        response = client.post(f"/companies/{str(company.id)}/staff/upload",files={"file": ("SampleStaffData.xlsx", sample, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")},headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 400
+    assert "already has a staff account" in response.json()["detail"]["message"]
+    assert models.Staff.objects(company=company).count() == 4
+    # queued imports report every error of a rejected file at once
+    rejected = df.assign(**{"User Email": ["csv.job.1@example.com", "not-an-email", "csv.job.1@example.com"], "Staff Number": ["JOB001", "JOB002", None]})
+    response = client.post(f"/companies/{str(company.id)}/staff/upload/jobs",files={"file": ("staff.csv", rejected.to_csv(index=False).encode(), "text/csv")},headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 202
+    assert response.json()["kind"] == "import_staff" and response.json()["status"] == "queued"
+    job_id = response.json()["id"]
+    assert str(jobs.process_next_job().id) == job_id
+    response = client.get(f"/jobs/{job_id}",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.json()["status"] == "failed"
+    assert response.json()["error_count"] == 3
+    response = client.get(f"/jobs/{job_id}/errors",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    report = pd.read_csv(io.BytesIO(response.content))
+    assert report[["row", "column"]].values.tolist() == [[3, "User Email"], [4, "Staff Number"], [4, "User Email"]]
+    assert report["message"].tolist() == ["Invalid email address not-an-email", "Missing value for Staff Number", "User with email csv.job.1@example.com appears more than once in the file"]
+    assert models.Staff.objects(company=company).count() == 4
+    accepted = rejected.assign(**{"User Email": ["csv.job.1@example.com", "csv.job.2@example.com", "csv.job.3@example.com"], "Staff Number": ["JOB001", "JOB002", "JOB003"]})
+    response = client.post(f"/companies/{str(company.id)}/staff/upload/jobs",files={"file": ("staff.csv", accepted.to_csv(index=False).encode(), "text/csv")},headers={"Authorization": f"Bearer {access_token}"})
+    job_id = response.json()["id"]
+    assert str(jobs.process_next_job().id) == job_id
+    response = client.get(f"/jobs/{job_id}",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.json()["status"] == "completed"
+    assert response.json()["result"] == {"created": 3}
+    response = client.get(f"/jobs/{job_id}/errors",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 404
+    assert models.Staff.objects(company=company).count() == 7
+    shutil.rmtree(jobs.settings.import_dir)
+    # a rejected upload leaves nothing behind, whichever chunk holds its error
+    late_error = accepted.assign(**{"User Email": ["sync.1@example.com", "sync.2@example.com", "sync.3@example.com"], "Staff Number": ["SYNC1", "SYNC2", None]})
+    jobs.settings.import_chunk_size, chunk_size = 1, jobs.settings.import_chunk_size
+    try:
+        response = client.post(f"/companies/{str(company.id)}/staff/upload",files={"file": ("staff.csv", late_error.to_csv(index=False).encode(), "text/csv")},headers={"Authorization": f"Bearer {access_token}"})
+    finally:
+        jobs.settings.import_chunk_size = chunk_size
+    assert response.status_code == 400
+    assert response.json()["detail"]["message"] == "4 Missing value for Staff Number"
+    assert models.Staff.objects(company=company).count() == 7
+    assert not models.User.objects(email="sync.1@example.com").first()
 
 # test bands api calls
 @pytest.mark.asyncio
@@ -350,6 +420,10 @@ async def test_bands_api(mock_send_sms, mock_send_email,client,db):
     assert response.status_code == 200
     assert response.json()["lower"] == str(band_db.lower)
     assert response.json()["upper"] == str(band_db.upper)
+    # statutory cache stats
+    response = client.get("/bands/cache-stats",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    assert set(response.json()) == {"hits", "misses", "size", "maxsize", "hit_rate"}
     # update band
     band_update = {
         "period_start": fake.date_time_this_year().isoformat(),
@@ -404,6 +478,11 @@ async def test_payrollcodes_api(mock_send_sms, mock_send_email,client,db):
     response = client.get(f"/companies/{str(company.id)}/codes/{str(payrollcode_id)}",headers={"Authorization": f"Bearer {access_token}"})
     assert response.status_code == 200
     assert response.json()["name"] == payrollcode_db.name
+    # get the generated payroll program
+    response = client.get(f"/companies/{str(company.id)}/codes/program",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    assert "base_salary" in response.json()["inputs"]
+    assert response.json()["source"].startswith("def make_program(")
     # update payrollcode
     payrollcode_update = {
         "name": "BASE2",
@@ -500,10 +579,24 @@ async def test_computations_api(mock_send_sms, mock_send_email,client,db):
         headers={"Authorization": f"Bearer {access_token}"}
     )
     assert response.status_code == 200
-    assert len(response.json()) > 0
-    assert response.json()[0]["computation"]["id"] == str(computation_id)
-    assert response.json()[0]["staff"]["id"] == str(staff_db.id)
-    assert response.json()[0]["value"] == "500000.00"
+    assert response.json() == {"inserted": 1, "updated": 0, "unchanged": 0}
+    basic_salary = models.PayrollCode.objects.filter(company=company_db, variable="basic_salary").first()
+    component = models.ComputationComponent.objects.filter(computation=computation_db, staff=staff_db, payroll_component=basic_salary).first()
+    assert str(component.value) == "500000.00"
+    # re-uploads only rewrite the cells that changed
+    for salary, result in [(500_000, {"inserted": 0, "updated": 0, "unchanged": 1}), (600_000, {"inserted": 0, "updated": 1, "unchanged": 0}), (500_000, {"inserted": 0, "updated": 1, "unchanged": 0})]:
+        df.loc[len(df) - 1] = [staff_number, salary]
+        output = io.BytesIO()
+        df.to_excel(output, index=False)
+        output.seek(0)
+        response = client.post(
+            url=f"/companies/{str(company_db.id)}/computations/{str(computation_id)}/upload-compensation",
+            files={"file": ("test_file.xlsx", output, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")},
+            headers={"Authorization": f"Bearer {access_token}"}
+        )
+        assert response.status_code == 200
+        assert response.json() == result
+    assert models.ComputationComponent.objects.filter(computation=computation_db, staff=staff_db, payroll_component=basic_salary).count() == 1
     # run computation getting streaming response
     response = client.post(f"/companies/{str(company_db.id)}/computations/{str(computation_id)}/run",headers={"Authorization": f"Bearer {access_token}"})
     assert response.status_code == 200
@@ -563,4 +656,111 @@ async def test_computations_api(mock_send_sms, mock_send_email,client,db):
     response = client.delete(f"/companies/{str(company_db.id)}/computations/{str(computation_id)}",headers={"Authorization": f"Bearer {access_token}"})
     assert response.status_code == 204
     with pytest.raises(models.Computation.DoesNotExist):
-        models.Computation.objects.get(id=computation_id)    
\ No newline at end of file
+        models.Computation.objects.get(id=computation_id)    
+# test computation jobs api calls
+@pytest.mark.asyncio
+@patch("utils.smsleopard_send_sms")
+@patch("utils.mailtrap_send_email")
+async def test_computation_jobs_api(mock_send_sms, mock_send_email,client,db):
+    mock_send_sms.return_value = True
+    mock_send_email.return_value = True
+    access_token: str = await authenticate(client,db)
+    company_db = models.Company.objects.filter(name="Test Company1").first()
+    staff_db = models.Staff.objects.filter(company=company_db).first()
+    basic_salary = models.PayrollCode.objects.filter(company=company_db, variable="basic_salary").first()
+    computation_db = models.Computation(
+        company=company_db,
+        notes="Test Computation Job",
+        payroll_period_start=datetime.datetime(2025,4,1),
+        payroll_period_end=datetime.datetime(2025,4,30),
+        generated_by=models.User.objects.first()
+    )
+    computation_db.save()
+    models.ComputationComponent(computation=computation_db, payroll_component=basic_salary, staff=staff_db, value=100_000).save()
+    # submit job
+    response = client.post(f"/companies/{str(company_db.id)}/computations/{str(computation_db.id)}/jobs",json={"mode": "parallel", "workers": 0},headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 422
+    response = client.post(f"/companies/{str(company_db.id)}/computations/{str(computation_db.id)}/jobs",json={"mode": "vectorized"},headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 202
+    assert response.json()["status"] == "queued"
+    job_id = response.json()["id"]
+    # a second submission is refused while the first is queued
+    response = client.post(f"/companies/{str(company_db.id)}/computations/{str(computation_db.id)}/jobs",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 409
+    response = client.post(f"/companies/{str(company_db.id)}/computations/{str(computation_db.id)}/run",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 409
+    # a concurrent submission that passed the check is refused by the unique index on active jobs
+    with pytest.raises(ValueError):
+        jobs.save_job(models.Job(kind='computation', company=company_db, computation=computation_db, submitted_by=models.User.objects.first()))
+    imports = [models.Job(kind='import_staff', company=company_db, submitted_by=models.User.objects.first()) for _ in range(2)]
+    for job in imports:
+        jobs.save_job(job)
+    for job in imports:
+        job.delete()
+    computation_db.reload()
+    assert computation_db.status == "draft"
+    # process the job as a worker would
+    job = jobs.process_next_job()
+    assert str(job.id) == job_id
+    response = client.get(f"/jobs/{job_id}",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    assert response.json()["status"] == "completed"
+    response = client.get(f"/jobs/{job_id}/progress",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    assert response.json()["processed"] == response.json()["total"] == 1
+    assert response.json()["percent"] == 100.0
+    response = client.get(f"/companies/{str(company_db.id)}/computations/{str(computation_db.id)}/jobs",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    assert response.json()["total"] == 1
+    computation_db.reload()
+    assert computation_db.status == "completed"
+    tax = models.PayrollCode.objects.filter(company=company_db, variable="tax").first()
+    assert models.ComputationComponent.objects.filter(computation=computation_db, payroll_component=tax).first().value == 10_000
+    # recompute the codes downstream of an edited rate
+    tax.formula = "0.2 * basic_salary"
+    tax.save()
+    response = client.post(f"/companies/{str(company_db.id)}/computations/{str(computation_db.id)}/recompute",json={"variables": ["tax"]},headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    assert response.json()["updated"] >= 1
+    assert models.ComputationComponent.objects.filter(computation=computation_db, payroll_component=tax).first().value == 20_000
+    response = client.post(f"/companies/{str(company_db.id)}/computations/{str(computation_db.id)}/recompute",json={"variables": ["overtime"]},headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 400
+    tax.formula = "0.1 * basic_salary"
+    tax.save()
+    # simulate a raise without persisting it
+    components = models.ComputationComponent.objects.filter(computation=computation_db).count()
+    response = client.post(f"/companies/{str(company_db.id)}/computations/{str(computation_db.id)}/simulate",json={"multipliers": {"basic_salary": 1.1}},headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.iter_lines() if line]
+    assert lines[0]["summary"]["staff_changed"] >= 1
+    assert lines[0]["summary"]["delta"]["basic_salary"] > 0
+    assert any(line.get("staff", {}).get("id") == str(staff_db.id) and line["delta"]["tax"] == 1_000 for line in lines[1:])
+    assert models.ComputationComponent.objects.filter(computation=computation_db).count() == components
+    # a computation compared with itself has no changes
+    response = client.get(f"/companies/{str(company_db.id)}/computations/{str(computation_db.id)}/diff?previous_id={str(computation_db.id)}",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.iter_lines() if line]
+    assert len(lines) == 1
+    assert lines[0]["summary"]["tax"]["delta"] == 0
+    # the job's run was not profiled
+    response = client.get(f"/companies/{str(company_db.id)}/computations/{str(computation_db.id)}/profile",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 404
+    # schedule the computation in a batch
+    response = client.post("/batches/",json={"name": "April", "mode": "vectorized", "profile": True, "computations": [{"company_id": str(company_db.id), "computation_id": str(computation_db.id), "deadline": "2025-04-28T00:00:00"}]},headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 202
+    batch_id = response.json()["id"]
+    response = client.get(f"/batches/{batch_id}/progress",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    assert response.json()["status"] == "queued"
+    jobs.process_next_job()
+    response = client.get(f"/batches/{batch_id}/progress",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.json()["status"] == "completed"
+    assert response.json()["jobs"]["completed"] == 1
+    response = client.get(f"/batches/{batch_id}/jobs",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    assert response.json()["total"] == 1
+    # the batch's run was profiled
+    response = client.get(f"/companies/{str(company_db.id)}/computations/{str(computation_db.id)}/profile",headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200
+    assert "tax" in [code["name"] for code in response.json()["codes"]]
+    assert "computation_components.find" in [query["name"] for query in response.json()["queries"]]
@@ -0,0 +1,727 @@
+from datetime import datetime, timedelta
+import io
+import math
+import os
+import shutil
+import time
+import random
+from decimal import Decimal
+import numpy as np
+import pandas as pd
+import pytest
+import faker
+import openpyxl
+import models
+import engine
+import jobs
+import utils
+from config import settings
+
+pytest_plugins = ('pytest_asyncio',)
+fake = faker.Faker()
+
+def test_formula_cache(db):
+    payroll_code = models.PayrollCode.objects.filter(code_type="formula", variable="tax").first()
+    code = engine.compile_formula(payroll_code)
+    assert engine.compile_formula(payroll_code) is code
+    assert eval(code, {}, {"basic_salary": 1000.0}) == 100.0
+    engine.evict_formula(payroll_code.id)
+    assert engine.compile_formula(payroll_code) is not code
+
+def test_build_plan():
+    def code(variable, order, code_type="formula", formula=""):
+        return models.PayrollCode(variable=variable, order=order, code_type=code_type, formula=formula, effective_from=datetime(2025, 1, 1))
+    codes = [
+        code("net_pay", 1, formula="gross_pay - tax"),
+        code("tax", 2, formula="calculate_paye(gross_pay) + max(levy, 0)"),
+        code("gross_pay", 3, code_type="input"),
+        code("levy", 4, formula="0.015 * gross_pay"),
+        code("unused", 5, formula="0.5 * gross_pay"),
+    ]
+    plan = engine.build_plan(codes)
+    assert plan.variables == ["gross_pay", "levy", "tax", "net_pay", "unused"]
+    assert engine.build_plan(codes, outputs=["tax"]).variables == ["gross_pay", "levy", "tax"]
+    with pytest.raises(engine.PlanError):
+        engine.build_plan(codes + [code("bonus", 6, formula="overtime * 2")])
+    with pytest.raises(engine.PlanError):
+        engine.build_plan(codes + [code("a", 6, formula="b + 1"), code("b", 7, formula="a + 1")])
+
+def test_generated_program():
+    def code(variable, order, code_type="formula", formula="", value=-1, rounding="half_up"):
+        return models.PayrollCode(name=variable.title(), variable=variable, order=order, code_type=code_type, formula=formula, value=value, rounding=rounding, effective_from=datetime(2025, 1, 1))
+    plan = engine.build_plan([
+        code("gross_pay", 1, code_type="input"),
+        code("relief", 2, code_type="fixed", value=2_400),
+        code("tax", 3, formula="(calculate_paye(gross_pay) -\n relief)  # after relief", rounding="down"),
+        code("max", 4, formula="max(gross_pay - tax, 0)"),
+    ])
+    program = plan.program()
+    assert plan.program() is program
+    assert "        tax = float(calculate_paye(gross_pay) - relief)\n" in program.source
+    assert "        _v3 = float(max(gross_pay - tax, 0))\n" in program.source
+    band_tables = engine.BandTables([], [{"lower": 0.0, "upper": float("inf"), "rate": 10.0}])
+    assert program.bind(band_tables)(50_000.0) == {"gross_pay": 50_000.0, "relief": 2_400.0, "tax": 2_600.0, "max": 47_400.0}
+    assert program.bind(band_tables) is program.bind(band_tables)
+    cents = plan.program("cents")
+    assert "        relief = 240000\n" in cents.source
+    assert "        tax = round_cent(float(calculate_paye(gross_pay) - relief), 'down')\n" in cents.source
+    assert cents.bind(band_tables)(5_000_001) == {"gross_pay": 5_000_001, "relief": 240_000, "tax": 260_000, "max": 4_740_001}
+
+def test_generated_program_renames_variables():
+    def code(variable, order, code_type="formula", formula=""):
+        return models.PayrollCode(name=variable.title(), variable=variable, order=order, code_type=code_type, formula=formula, effective_from=datetime(2025, 1, 1))
+    plan = engine.build_plan([
+        code("_basic", 1, code_type="input"),
+        code("lambda", 2, code_type="input"),
+        code("round_cent", 3, formula="_basic * 0.1"),
+        code("_net", 4, formula="_basic - round_cent if _basic > 1000 else _basic"),
+    ])
+    assert "        _v3 = float(_v0 - _v2 if _v0 > 1000 else _v0)\n" in plan.program().source
+    band_tables = engine.BandTables([], [{"lower": 0.0, "upper": float("inf"), "rate": 10.0}])
+    assert plan.program().bind(band_tables)(5_000.0, 1.0) == {"_basic": 5_000.0, "lambda": 1.0, "round_cent": 500.0, "_net": 4_500.0}
+    assert plan.program("cents").bind(band_tables)(500_000, 100) == {"_basic": 500_000, "lambda": 100, "round_cent": 50_000, "_net": 450_000}
+
+def test_cents_formulas():
+    assert engine.cents_formula("gross_pay - 5000") == "gross_pay - 500000"
+    assert engine.cents_formula("0.1 * gross_pay") == "0.1 * gross_pay"
+    assert engine.cents_formula("days * daily_rate") == "days * daily_rate / 100"
+    assert engine.cents_formula("gross_pay / days") == "gross_pay / days * 100"
+    assert engine.cents_formula("max(gross_pay - 24000, 0) if gross_pay > 24000 else 0") == "max(gross_pay - 2400000, 0) if gross_pay > 2400000 else 0"
+    def code(variable, order, code_type="formula", formula=""):
+        return models.PayrollCode(name=variable.title(), variable=variable, order=order, code_type=code_type, formula=formula, effective_from=datetime(2025, 1, 1))
+    formulas = {
+        "after_relief": "gross_pay - 2400",
+        "allowance": "days * daily_rate",
+        "share": "gross_pay / days",
+        "ratio": "gross_pay / (days * daily_rate)",
+        "capped": "min(gross_pay, 100000) + 0.5",
+        "bonus": "1000 if gross_pay > 50000 else daily_rate * 2",
+        "rounded": "round(gross_pay * 0.0325, 1)",
+        "squared": "daily_rate ** 2 / 1000",
+        "tax": "calculate_paye(gross_pay - 1000)",
+    }
+    codes = [code("gross_pay", 1, "input"), code("days", 2, "input"), code("daily_rate", 3, "input")]
+    codes += [code(variable, 4 + index, formula=formula) for index, (variable, formula) in enumerate(formulas.items())]
+    plan = engine.build_plan(codes)
+    band_tables = engine.BandTables([], [{"lower": 0.0, "upper": 24_000.0, "rate": 10.0}, {"lower": 24_000.0, "upper": float("inf"), "rate": 25.0}])
+    floats, cents = plan.program().bind(band_tables), plan.program("cents").bind(band_tables)
+    rows = [(12_345.67, 22, 1_234.5), (60_000, 21.5, 2_000.01), (24_000, 1, 0.01)]
+    inputs = pd.DataFrame(rows, columns=["gross_pay", "days", "daily_rate"])
+    vectorized = engine.evaluate_frame(plan.compiled_steps("cents"), inputs, band_tables, "cents")
+    for index, row in enumerate(rows):
+        expected = floats(*row)
+        result = cents(*(engine.to_cents(value) for value in row))
+        for variable in formulas:
+            assert result[variable] == engine.round_cent(expected[variable] * 100, "half_up"), variable
+            assert vectorized.loc[index, variable] == result[variable], variable
+    with pytest.raises(engine.PlanError, match="cannot use the cents arithmetic"):
+        engine.build_plan(codes + [code("whole", 20, formula="int(gross_pay)")]).program("cents")
+    assert engine.build_plan(codes + [code("whole", 20, formula="int(gross_pay)")]).program().bind(band_tables)(1.5, 1, 1)["whole"] == 1.0
+
+def test_vectorized_fallbacks():
+    def code(variable, order, code_type="formula", formula=""):
+        return models.PayrollCode(name=variable.title(), variable=variable, order=order, code_type=code_type, formula=formula, effective_from=datetime(2025, 1, 1))
+    band_tables = engine.BandTables([], [{"lower": 0.0, "upper": float("inf"), "rate": 10.0}])
+    inputs = pd.DataFrame([(12_345.67,), (60_000.0,), (0.5,)], columns=["gross_pay"])
+    plan = engine.build_plan([
+        code("gross_pay", 1, "input"),
+        code("levy", 2, formula="float(Decimal(gross_pay) * Decimal('0.015'))"),
+        code("rounded", 3, formula="float(Decimal(str(gross_pay)).quantize(Decimal('1')))"),
+        code("flag", 4, formula="1 if gross_pay is None else 0"),
+    ])
+    row = plan.program().bind(band_tables)
+    vectorized = engine.evaluate_frame(plan.compiled_steps(), inputs, band_tables)
+    for index, (gross_pay,) in enumerate(inputs.itertuples(index=False)):
+        assert vectorized.loc[index].to_dict() == row(gross_pay)
+    # a column reduced to one value is not a per staff value, the row evaluation decides
+    for formula in ["sum(gross_pay)", "max(gross_pay)"]:
+        plan = engine.build_plan([code("gross_pay", 1, "input"), code("total", 2, formula=formula)])
+        with pytest.raises(TypeError):
+            plan.program().bind(band_tables)(1.0)
+        with pytest.raises(TypeError):
+            engine.evaluate_frame(plan.compiled_steps(), inputs, band_tables)
+
+def create_payroll_company(staff_count: int, period_start: datetime) -> models.Computation:
+    """
+        Create a company with the master company's payroll codes, PAYE and NSSF bands and random inputs
+    """
+    company = models.Company(name=fake.company(), legal_name=fake.company(), pin_number="engine", contact_email=fake.company_email())
+    company.save()
+    master_company = models.Company.objects(name="Master Company").first()
+    for payroll_code in models.PayrollCode.objects(company=master_company, effective_from__lte=datetime(2020, 1, 1)):
+        models.PayrollCode(
+            company=company,
+            name=payroll_code.name,
+            variable=payroll_code.variable,
+            code_type=payroll_code.code_type,
+            value=payroll_code.value,
+            formula=payroll_code.formula,
+            order=payroll_code.order,
+            effective_from=payroll_code.effective_from
+        ).save()
+    for band_type, bands in [("PAYE", [(0, 24_000, 10), (24_000, 32_333, 25), (32_333, 500_000, 30), (500_000, 800_000, 32.5), (800_000, 1e12, 35)]), ("NSSF", [(0, 8_000, 6), (8_000, 72_000, 6)])]:
+        for lower, upper, rate in bands:
+            models.Band(period_start=period_start, period_end=period_start + timedelta(days=30), band_type=band_type, lower=lower, upper=upper, rate=rate).save()
+    computation = models.Computation(company=company, payroll_period_start=period_start, payroll_period_end=period_start + timedelta(days=30), generated_by=models.User.objects.first())
+    computation.save()
+    input_codes = {code.variable: code for code in models.PayrollCode.objects(company=company, code_type="input")}
+    for i in range(staff_count):
+        staff = models.Staff(company=company, first_name=fake.first_name(), last_name=fake.last_name(), contact_email=fake.email(), pin_number="engine", staff_number=f"ENG{i}")
+        staff.save()
+        models.ComputationComponent(computation=computation, payroll_component=input_codes["gross_pay"], staff=staff, value=round(random.uniform(10_000, 1_000_000), 2)).save()
+        models.ComputationComponent(computation=computation, payroll_component=input_codes["pension_benefit"], staff=staff, value=round(random.uniform(0, 20_000), 2)).save()
+    return computation
+
+def test_vectorized_run_matches_row_run(db):
+    computation = create_payroll_company(25, datetime(2030, 1, 1))
+    rows = {str(staff.id): params for staff, params in computation.run()}
+    vectorized = {str(staff.id): params for staff, params in computation.run(mode="vectorized")}
+    assert len(vectorized) == 25
+    for staff_id, params in vectorized.items():
+        for variable, value in params.items():
+            assert rows[staff_id][variable] == value
+    assert computation.status == "completed"
+    assert len(computation.prefetch_components()) == 25 * 16
+
+def test_run_persists_in_batches(db):
+    computation = create_payroll_company(10, datetime(2030, 2, 1))
+    flushed = []
+    record_progress = computation.record_progress
+    computation.record_progress = lambda staff_processed: (flushed.append(staff_processed), record_progress(staff_processed))
+    results = {str(staff.id): params for staff, params in computation.run(batch_size=40)}
+    # 14 computed components per staff member, flushed every 3 staff
+    assert flushed == [3, 6, 9, 10]
+    computation.reload()
+    assert computation.staff_processed == computation.staff_total == 10
+    net_pay = models.PayrollCode.objects(company=computation.company, variable="net_pay").first()
+    assert models.ComputationComponent.objects(computation=computation).count() == 10 * 16
+    for component in models.ComputationComponent.objects(computation=computation, payroll_component=net_pay):
+        assert float(component.value) == round(results[str(component.staff.id)]["net_pay"], 2)
+
+def test_band_tables_cache(db):
+    period_start = datetime(2032, 1, 1)
+    band = models.Band(period_start=period_start, period_end=period_start + timedelta(days=30), band_type="PAYE", lower=0, upper=10_000, rate=10)
+    band.save()
+    band_tables = engine.get_band_tables(period_start)
+    assert engine.get_band_tables(period_start) is band_tables
+    assert band_tables.functions["calculate_paye"](5_000.0) == 500.0
+    models.Band(period_start=period_start, period_end=period_start + timedelta(days=30), band_type="PAYE", lower=10_000, upper=20_000, rate=20).save()
+    band_tables = engine.get_band_tables(period_start)
+    assert band_tables.functions["calculate_paye"](15_000.0) == 2_000.0
+    engine.invalidate_band_tables()
+    assert engine.get_band_tables(period_start) is not band_tables
+
+def test_band_table():
+    bands = [{"lower": 0.0, "upper": 24_000.0, "rate": 10.0}, {"lower": 24_000.0, "upper": 32_333.0, "rate": 25.0}, {"lower": 32_333.0, "upper": float("inf"), "rate": 30.0}]
+    def loop(value):
+        paye = 0.0
+        for band in bands:
+            if value > band["upper"]:
+                paye += (band["upper"] - band["lower"]) * (band["rate"] / 100)
+            else:
+                paye += (value - band["lower"]) * (band["rate"] / 100)
+                break
+        return paye
+    table = engine.BandTable(bands, engine.paye_contribution)
+    values = [0.0, 100.0, 24_000.0, 24_000.01, 30_000.0, 32_333.0, 1_234_567.89]
+    assert [table(value) for value in values] == [loop(value) for value in values]
+    assert table.evaluate(values).tolist() == [loop(value) for value in values]
+    assert engine.BandTable([], engine.paye_contribution)(50_000.0) == 0.0
+
+def test_statutory_cache():
+    cache = engine.StatutoryCache(maxsize=2)
+    calls = []
+    def compute(value):
+        calls.append(value)
+        return value * 2
+    assert [cache.get("v1", value, compute) for value in [1.0, 1.0, 2.0, 1.0, 3.0, 2.0]] == [2.0, 2.0, 4.0, 2.0, 6.0, 4.0]
+    # 2.0 was the least recently used entry when 3.0 was added
+    assert calls == [1.0, 2.0, 3.0, 2.0]
+    assert cache.get("v2", 1.0, compute) == 2.0 and calls[-1] == 1.0
+    assert cache.stats() == {"hits": 2, "misses": 5, "size": 2, "maxsize": 2, "hit_rate": 0.2857}
+    table = engine.BandTable([{"lower": 0.0, "upper": 24_000.0, "rate": 10.0}], engine.paye_contribution)
+    hits = engine.statutory_cache.hits
+    assert table(1_000.0) == table(1_000.0) == 100.0
+    assert engine.statutory_cache.hits == hits + 1
+    assert engine.BandTable([{"lower": 0.0, "upper": 24_000.0, "rate": 20.0}], engine.paye_contribution)(1_000.0) == 200.0
+
+def test_annual_and_open_ended_bands(db):
+    period_start = datetime(2033, 1, 1)
+    models.Band(period_start=period_start, period_end=period_start + timedelta(days=365), band_type="PAYE", band_frequency="annual", lower=0, upper=120_000, rate=10).save()
+    models.Band(period_start=period_start, period_end=period_start + timedelta(days=365), band_type="PAYE", band_frequency="annual", lower=120_000, rate=20).save()
+    band_tables = engine.get_band_tables(period_start)
+    assert band_tables.paye_bands[-1]["upper"] == float("inf")
+    assert band_tables.functions["calculate_paye"](20_000.0) == 1_000.0 + 2_000.0
+
+def test_parallel_run_matches_row_run(db):
+    computation = create_payroll_company(12, datetime(2030, 3, 1))
+    rows = {str(staff.id): params for staff, params in computation.run()}
+    settings.computation_shard_size, shard_size = 5, settings.computation_shard_size
+    try:
+        parallel = {str(staff.id): params for staff, params in computation.run(mode="parallel", workers=2)}
+    finally:
+        settings.computation_shard_size = shard_size
+    assert parallel == rows
+    computation.reload()
+    assert computation.shards_completed == computation.shards_total == 3
+    assert computation.staff_processed == 12
+
+def test_incremental_run_recomputes_changed_staff(db, monkeypatch):
+    computation = create_payroll_company(6, datetime(2030, 4, 1))
+    recomputed = []
+    add_row = engine.ComponentWriter.add_row
+    monkeypatch.setattr(engine.ComponentWriter, "add_row", lambda writer, staff_id, *args: (recomputed.append(str(staff_id)), add_row(writer, staff_id, *args)))
+    full = {str(staff.id): params for staff, params in computation.run(mode="vectorized", incremental=True)}
+    assert len(recomputed) == 6
+    assert models.ComputationRow.objects(computation=computation).count() == 6
+    recomputed.clear()
+    rerun = {str(staff.id): params for staff, params in computation.run(mode="vectorized", incremental=True)}
+    assert recomputed == []
+    assert rerun.keys() == full.keys()
+    assert all(rerun[staff_id]["net_pay"] == round(full[staff_id]["net_pay"], 2) for staff_id in full)
+    computation.reload()
+    assert computation.staff_processed == 6
+    gross_pay = models.PayrollCode.objects(company=computation.company, variable="gross_pay").first()
+    component = models.ComputationComponent.objects(computation=computation, payroll_component=gross_pay).first()
+    component.value = float(component.value) + 1_000
+    component.save()
+    component.reload()
+    rerun = {str(staff.id): params for staff, params in computation.run(mode="row", incremental=True)}
+    assert recomputed == [str(component.staff.id)]
+    assert rerun[str(component.staff.id)]["gross_pay"] == float(component.value)
+    recomputed.clear()
+    period_start = computation.payroll_period_start
+    models.Band(period_start=period_start, period_end=period_start + timedelta(days=30), band_type="NSSF", lower=72_000, upper=100_000, rate=1).save()
+    list(computation.run(mode="vectorized", incremental=True))
+    assert len(recomputed) == 6
+
+def test_recompute_downstream_codes(db):
+    computation = create_payroll_company(8, datetime(2030, 5, 1))
+    list(computation.run(mode="vectorized"))
+    plan = engine.get_plan(computation.company, computation.payroll_period_start)
+    downstream = engine.downstream_variables(plan, ["gross_pay"])
+    assert "net_pay" in downstream and "pension_benefit" not in downstream
+    with pytest.raises(engine.PlanError):
+        engine.downstream_variables(plan, ["overtime"])
+    housing_levy = models.PayrollCode.objects(company=computation.company, variable="affordable_housing_levy").first()
+    housing_levy.formula = "0.02 * gross_pay"
+    housing_levy.save()
+    result = computation.recompute(["affordable_housing_levy"])
+    assert result["variables"][:2] == ["affordable_housing_levy", "affordable_housing_relief"]
+    assert "pension_benefit" not in result["variables"]
+    assert result["staff"] == 8 and result["skipped"] == 0 and result["updated"] > 0
+    # nothing changed since, nothing is written
+    assert computation.recompute(["affordable_housing_levy"])["updated"] == 0
+    recomputed = {(str(component.staff.id), str(component.payroll_component.id)): float(component.value) for component in models.ComputationComponent.objects(computation=computation).no_dereference()}
+    full = {str(staff.id): params for staff, params in computation.run(mode="vectorized")}
+    codes = {str(code.id): code.variable for code in plan}
+    for (staff_id, code_id), value in recomputed.items():
+        # upstream values are read back rounded to cents
+        assert abs(value - full[staff_id][codes[code_id]]) < 0.05
+
+def test_recompute_after_cents_run(db, monkeypatch):
+    computation = create_payroll_company(6, datetime(2041, 6, 1))
+    list(computation.run(mode="vectorized", arithmetic="cents"))
+    with pytest.raises(engine.PlanError, match="gross_pay are input payroll codes"):
+        computation.recompute(["gross_pay", "affordable_housing_levy"])
+    housing_levy = models.PayrollCode.objects(company=computation.company, variable="affordable_housing_levy").first()
+    housing_levy.formula = "0.02 * gross_pay + 10"
+    housing_levy.save()
+    assert computation.recompute(["affordable_housing_levy"])["updated"] > 0
+    recomputed = {(str(component.staff.id), str(component.payroll_component.id)): component.value for component in models.ComputationComponent.objects(computation=computation).no_dereference()}
+    # the recompute kept the run's arithmetic, so an incremental run finds every row current
+    rows = []
+    add_row = engine.ComponentWriter.add_row
+    monkeypatch.setattr(engine.ComponentWriter, "add_row", lambda writer, staff_id, *args: (rows.append(staff_id), add_row(writer, staff_id, *args)))
+    list(computation.run(mode="vectorized", arithmetic="cents", incremental=True))
+    assert rows == []
+    full = {str(staff.id): params for staff, params in computation.run(mode="vectorized", arithmetic="cents")}
+    codes = {str(code.id): code.variable for code in models.PayrollCode.objects(company=computation.company)}
+    for (staff_id, code_id), value in recomputed.items():
+        assert value == Decimal(str(full[staff_id][codes[code_id]])).quantize(Decimal("0.01"))
+
+def test_run_beats_between_flushes(db, monkeypatch):
+    computation = create_payroll_company(3, datetime(2041, 7, 1))
+    evaluate_frame = engine.evaluate_frame
+    monkeypatch.setattr(engine, "evaluate_frame", lambda *args, **kwargs: (time.sleep(0.2), evaluate_frame(*args, **kwargs))[1])
+    beats = []
+    beat = models.Computation.beat
+    monkeypatch.setattr(models.Computation, "beat", lambda self: (beats.append(models.Computation.objects(id=self.id).first().staff_processed), beat(self)))
+    settings.heartbeat_interval_seconds, interval = 0.02, settings.heartbeat_interval_seconds
+    try:
+        list(computation.run(mode="vectorized"))
+    finally:
+        settings.heartbeat_interval_seconds = interval
+    # the evaluation flushed nothing for 0.2 seconds, yet the run kept beating
+    assert beats.count(0) >= 3
+    count = len(beats)
+    time.sleep(0.1)
+    assert len(beats) == count
+
+def test_interrupted_run_resumes_from_checkpoint(db, monkeypatch):
+    computation = create_payroll_company(10, datetime(2030, 6, 1))
+    run = computation.run(batch_size=14 * 4)
+    for _ in range(6):
+        next(run)
+    # the worker dies: staff 1-4 were committed, 5-6 were still buffered
+    run.close()
+    computation.reload()
+    assert computation.status == "processing"
+    assert computation.staff_processed == 4
+    assert jobs.recover_orphaned_runs() == []
+    models.Computation.objects(id=computation.id).update_one(set__heartbeat_at=datetime.now() - timedelta(hours=1))
+    recovered = jobs.recover_orphaned_runs()
+    assert len(recovered) == 1 and recovered[0].params == {"mode": "row", "batch_size": 56, "incremental": False, "arithmetic": "float", "resume": True}
+    assert jobs.recover_orphaned_runs() == []
+    recomputed = []
+    add_row = engine.ComponentWriter.add_row
+    monkeypatch.setattr(engine.ComponentWriter, "add_row", lambda writer, staff_id, *args: (recomputed.append(str(staff_id)), add_row(writer, staff_id, *args)))
+    job = jobs.process_next_job()
+    assert job.status == "completed"
+    assert len(recomputed) == 6
+    computation.reload()
+    assert computation.status == "completed"
+    assert computation.staff_processed == 10
+    assert models.ComputationComponent.objects(computation=computation).count() == 10 * 16
+    # a worker that stopped sending heartbeats loses its job to the next worker
+    models.Job.objects(id=job.id).update_one(set__status="running", set__heartbeat_at=datetime.now() - timedelta(hours=1))
+    assert [str(recovered.id) for recovered in jobs.recover_orphaned_runs()] == [str(job.id)]
+    job.reload()
+    assert job.status == "queued" and job.worker is None
+    models.Job.objects(id=job.id).update_one(set__status="running", set__attempts=settings.job_max_attempts, set__heartbeat_at=datetime.now() - timedelta(hours=1))
+    assert jobs.recover_orphaned_runs() == []
+    job.reload()
+    assert job.status == "failed"
+
+def test_rounding_to_cents():
+    assert [engine.round_cent(value, "half_up") for value in [0.5, 1.5, -0.5, 2.49999]] == [1, 2, -1, 2]
+    assert [engine.round_cent(value, "half_even") for value in [0.5, 1.5, 2.5, -0.5]] == [0, 2, 2, 0]
+    assert [engine.round_cent(value, "down") for value in [1.99, -1.99]] == [1, -1]
+    assert [engine.round_cent(value, "up") for value in [1.01, -1.01, 2.0]] == [2, -2, 2]
+    # 0.015 * 300 is 4.499999999999999 in floats, snapped to the 4.5 tie
+    for rounding, expected in [("half_up", 5), ("half_even", 4), ("down", 4), ("up", 5)]:
+        assert engine.round_cent(0.015 * 300, rounding) == expected
+        assert engine.round_cents(np.array([0.015 * 300]), rounding).tolist() == [expected]
+    assert engine.from_cents(engine.to_cents(Decimal("1234.56"))) == Decimal("1234.56")
+
+def test_cents_arithmetic(db):
+    computation = create_payroll_company(10, datetime(2030, 7, 1))
+    shif = models.PayrollCode.objects(company=computation.company, variable="shif_contribution").first()
+    shif.rounding = "down"
+    shif.save()
+    floats = {str(staff.id): params for staff, params in computation.run(mode="vectorized")}
+    rows = {str(staff.id): params for staff, params in computation.run(arithmetic="cents")}
+    vectorized = {str(staff.id): params for staff, params in computation.run(mode="vectorized", arithmetic="cents")}
+    assert vectorized == rows
+    for staff_id, params in rows.items():
+        assert params["shif_contribution"] == math.floor(round(floats[staff_id]["gross_pay"] * 2.75, 6)) / 100
+        for variable, value in params.items():
+            assert Decimal(str(value)).as_tuple().exponent >= -2
+            assert abs(value - floats[staff_id][variable]) < 0.05
+    codes = {str(code.id): code.variable for code in models.PayrollCode.objects(company=computation.company)}
+    for component in models.ComputationComponent.objects(computation=computation).no_dereference():
+        assert component.value == Decimal(str(rows[str(component.staff.id)][codes[str(component.payroll_component.id)]])).quantize(Decimal("0.01"))
+
+def test_simulation(db):
+    computation = create_payroll_company(10, datetime(2030, 8, 1))
+    components = models.ComputationComponent.objects(computation=computation).count()
+    staff, baseline, scenario = computation.simulate()
+    assert len(staff) == 10
+    assert (baseline == scenario).all().all()
+    rows = {str(employee.id): params for employee, params in computation.run(mode="vectorized")}
+    assert all(baseline.loc[staff_id, "net_pay"] == params["net_pay"] for staff_id, params in rows.items())
+    _, baseline, scenario = computation.simulate(
+        bands={"PAYE": [{"lower": 0.0, "upper": float("inf"), "rate": 10.0}]},
+        values={"personal_relief_monthly": 0.0},
+        multipliers={"gross_pay": 1.05},
+    )
+    assert (scenario["gross_pay"] == baseline["gross_pay"] * 1.05).all()
+    assert (scenario["personal_relief_monthly"] == 0).all()
+    assert (scenario["gross_paye"] == scenario["taxable_income"] * 0.1).all()
+    # the simulation persists nothing
+    assert models.ComputationComponent.objects(computation=computation).count() == components + 10 * 14
+    with pytest.raises(engine.PlanError):
+        computation.simulate(values={"gross_pay": 1.0})
+    with pytest.raises(engine.PlanError):
+        computation.simulate(multipliers={"net_pay": 2.0})
+
+def test_batch_scheduling(db):
+    late = create_payroll_company(5, datetime(2030, 9, 1))
+    early = create_payroll_company(8, datetime(2030, 9, 1))
+    same_company = models.Computation(company=early.company, payroll_period_start=datetime(2030, 10, 1), payroll_period_end=datetime(2030, 10, 31), generated_by=models.User.objects.first())
+    same_company.save()
+    batch = jobs.submit_batch("September", models.User.objects.first(), [(late, datetime(2030, 9, 30)), (early, datetime(2030, 9, 25)), (same_company, datetime(2030, 9, 25))], {"mode": "vectorized"})
+    with pytest.raises(ValueError):
+        jobs.submit_batch("Again", models.User.objects.first(), [(late, None)], {})
+    # a batch losing one of its computations to another submission queues none of them
+    twice = models.Computation(company=late.company, payroll_period_start=datetime(2030, 10, 1), payroll_period_end=datetime(2030, 10, 31), generated_by=models.User.objects.first())
+    twice.save()
+    with pytest.raises(ValueError):
+        jobs.submit_batch("Twice", models.User.objects.first(), [(twice, None), (twice, None)], {})
+    assert models.Batch.objects(name="Twice").count() == 0
+    assert models.Job.objects(computation=twice).count() == 0
+    assert batch.progress()["status"] == "queued"
+    # earliest deadline first, the larger company first among equal deadlines, one run per company at a time
+    first = jobs.claim_next_job("worker-1")
+    second = jobs.claim_next_job("worker-2")
+    assert (first.computation.id, second.computation.id) == (early.id, late.id)
+    assert jobs.claim_next_job("worker-3") is None
+    jobs.execute_job(first)
+    settings.job_max_running, max_running = 1, settings.job_max_running
+    try:
+        assert jobs.claim_next_job("worker-3") is None
+    finally:
+        settings.job_max_running = max_running
+    third = jobs.claim_next_job("worker-3")
+    assert third.computation.id == same_company.id
+    progress = batch.progress()
+    assert progress["status"] == "running"
+    assert progress["jobs"] == {"queued": 0, "running": 2, "completed": 1, "failed": 0}
+    assert (progress["processed"], progress["total"]) == (8, 21)
+    assert progress["percent"] < 100
+    jobs.execute_job(second)
+    # the second computation of the company has no inputs
+    jobs.execute_job(third)
+    progress = batch.progress()
+    assert progress["status"] == "failed"
+    assert progress["jobs"] == {"queued": 0, "running": 0, "completed": 2, "failed": 1}
+    assert progress["processed"] == 13
+
+def test_computation_diff(db):
+    previous = create_payroll_company(6, datetime(2030, 11, 1))
+    list(previous.run(mode="vectorized"))
+    current = models.Computation(company=previous.company, payroll_period_start=datetime(2030, 12, 1), payroll_period_end=datetime(2030, 12, 31), generated_by=models.User.objects.first())
+    current.save()
+    staff = list(models.Staff.objects(company=previous.company))
+    codes = {code.variable: code for code in models.PayrollCode.objects(company=previous.company)}
+    components = previous.prefetch_components()
+    # staff 0 departs, staff 1 gets a raise and a new hire joins
+    raises = {"gross_pay": 10_000, "net_pay": 7_000.5}
+    for index, employee in enumerate(staff[1:], start=1):
+        for variable, code in codes.items():
+            value = float(components[(str(employee.id), str(code.id))].value)
+            models.ComputationComponent(computation=current, payroll_component=code, staff=employee, value=value + raises.get(variable, 0) if index == 1 else value).save()
+    hire = models.Staff(company=previous.company, first_name="New", last_name="Hire", contact_email=fake.email(), pin_number="engine", staff_number="ENGNEW")
+    hire.save()
+    models.ComputationComponent(computation=current, payroll_component=codes["gross_pay"], staff=hire, value=50_000).save()
+    lines = list(current.diff(previous, threshold=0.01))
+    summary = lines[0]["summary"]
+    assert summary["gross_pay"]["delta"] == round(10_000 + 50_000 - float(components[(str(staff[0].id), str(codes["gross_pay"].id))].value), 2)
+    assert summary["net_pay"]["delta"] == round(7_000.5 - float(components[(str(staff[0].id), str(codes["net_pay"].id))].value), 2)
+    rows = {line["staff"]["id"]: line for line in lines[1:]}
+    assert set(rows) == {str(staff[0].id), str(staff[1].id), str(hire.id)}
+    assert rows[str(staff[0].id)]["status"] == "departed"
+    assert len(rows[str(staff[0].id)]["changes"]) == 16
+    assert rows[str(hire.id)]["status"] == "new" and rows[str(hire.id)]["staff"]["name"] == "New Hire"
+    assert rows[str(hire.id)]["changes"] == {"gross_pay": {"previous": None, "current": 50_000.0, "delta": None}}
+    assert rows[str(staff[1].id)]["status"] == "changed"
+    assert rows[str(staff[1].id)]["changes"] == {
+        variable: {"previous": float(components[(str(staff[1].id), str(codes[variable].id))].value), "current": round(float(components[(str(staff[1].id), str(codes[variable].id))].value) + delta, 2), "delta": delta}
+        for variable, delta in raises.items()
+    }
+    # a threshold above the net pay change hides it
+    rows = {line["staff"]["id"]: line for line in list(current.diff(previous, threshold=8_000))[1:]}
+    assert list(rows[str(staff[1].id)]["changes"]) == ["gross_pay"]
+
+def test_benchmark(db):
+    import benchmark
+    import mongomock
+    find = mongomock.collection.Collection.find
+    results = benchmark.run_benchmark(4, ["seed", "upload_compensation", "run", "generate_payslip"], period_start=datetime(2041, 1, 1))
+    stages = results["stages"]
+    assert list(stages) == ["seed", "upload_compensation", "run", "generate_payslip"]
+    computation = models.Computation.objects(company=models.Company.objects(name="Benchmark Company 4").first()).first()
+    assert computation.status == "completed"
+    assert models.ComputationComponent.objects(computation=computation).count() == 4 * 16
+    # every stage but the skipped pdf rendering reports its queries and peak memory
+    for stage in ["seed", "upload_compensation", "run"]:
+        assert stages[stage]["seconds"] > 0
+        assert stages[stage]["queries"] == sum(stages[stage]["commands"].values()) > 0
+        assert stages[stage]["peak_memory_bytes"] > 0
+    if "skipped" not in stages["generate_payslip"]:
+        assert stages["generate_payslip"]["sample"] == 4
+    # the query counter unwraps mongomock once the benchmark is done
+    assert mongomock.collection.Collection.find is find
+    # large companies are refused on mongomock, and comparisons say which backend each side ran on
+    with pytest.raises(SystemExit):
+        benchmark.main(["--sizes", "10000"])
+    lines = benchmark.compare({"commit": "b", "backend": "mongod", "runs": [{**results, "stages": {"run": stages["run"]}}]}, {"commit": "a", "backend": "mongomock", "runs": [results]})
+    assert lines[0] == "baseline a on mongomock, current b on mongod"
+    assert lines[1].startswith("warning") and "(1.00x)" in lines[2]
+
+def test_profiled_run(db):
+    computation = create_payroll_company(6, datetime(2041, 2, 1))
+    list(computation.run())
+    computation.reload()
+    assert computation.profile == {}
+    for mode in ["row", "vectorized"]:
+        list(computation.run(mode=mode, profile=True))
+        computation.reload()
+        profile = computation.profile
+        stages = {stage["name"]: stage for stage in profile["stages"]}
+        codes = {code["name"]: code for code in profile["codes"]}
+        queries = {query["name"]: query for query in profile["queries"]}
+        assert {"plan", "band_tables", "fingerprints", "evaluate", "run"} <= set(stages)
+        # every computed code is timed, once per staff member in the row mode and once per column otherwise
+        assert set(codes) == {code.variable for code in models.PayrollCode.objects(company=computation.company) if code.code_type != "input"}
+        assert codes["gross_paye"]["calls"] == (6 if mode == "row" else 1)
+        assert {"staff.find", "computation_components.find", "computation_components.bulk_write", "computations.save"} <= set(queries)
+        # sections are sorted by cost
+        assert [stage["seconds"] for stage in profile["stages"]] == sorted((stage["seconds"] for stage in profile["stages"]), reverse=True)
+    # the profiled program computes the same values as the plain one
+    plan = engine.get_plan(computation.company, computation.payroll_period_start)
+    band_tables = engine.get_band_tables(computation.payroll_period_start)
+    timings = [0.0] * len(plan.program(profile=True).computed)
+    assert plan.program(profile=True).bind(band_tables, timings)(50_000.0, 1_000.0) == plan.program().bind(band_tables)(50_000.0, 1_000.0)
+    assert all(seconds > 0 for seconds in timings)
+    # calculate adds the time of a formula to its code
+    profiler = engine.Profiler()
+    net_pay = models.PayrollCode.objects(company=computation.company, variable="net_pay").first()
+    component = models.ComputationComponent(computation=computation, payroll_component=net_pay, staff=models.Staff.objects(company=computation.company).first())
+    assert component.calculate({"gross_pay": 100.0, "total_deductions": 40.0}, profiler=profiler) == 60.0
+    assert profiler.to_dict()["codes"][0]["name"] == "net_pay"
+    assert engine.Profiler(enabled=False).stage("plan") is engine.Profiler(enabled=False).query("staff.find")
+
+def test_import_compensation(db):
+    previous = create_payroll_company(3, datetime(2041, 3, 1))
+    computation = models.Computation(company=previous.company, payroll_period_start=previous.payroll_period_start, payroll_period_end=previous.payroll_period_end, generated_by=previous.generated_by)
+    computation.save()
+    staff_numbers = [staff.staff_number for staff in models.Staff.objects(company=computation.company).order_by("staff_number")]
+    frame = pd.DataFrame({"staff_number": staff_numbers, "gross_pay": [50_000, 60_000.5, "70000"], "pension_benefit": [0, 1_000, 2_000]})
+    invalid = [
+        (frame.rename(columns={"pension_benefit": "overtime"}), "Payroll code with variable overtime not found"),
+        (frame.assign(staff_number=["ENG0", "ENG1", "MISSING"]), "Staff with staff number MISSING not found"),
+        (frame.assign(staff_number=["ENG0", "ENG1", "ENG1"]), "Staff with staff number ENG1 appears more than once"),
+        (frame.assign(pension_benefit=[0, "n/a", 2_000]), "Invalid value for pension_benefit of staff ENG1"),
+    ]
+    for invalid_frame, message in invalid:
+        with pytest.raises(ValueError, match=message):
+            computation.import_compensation(invalid_frame)
+    # nothing is written unless the whole sheet is valid
+    assert models.ComputationComponent.objects(computation=computation).count() == 0
+    assert computation.import_compensation(frame) == {"inserted": 6, "updated": 0, "unchanged": 0}
+    assert computation.import_compensation(frame.assign(pension_benefit=[0, 1_500, 2_000])) == {"inserted": 0, "updated": 1, "unchanged": 5}
+    components = computation.prefetch_components()
+    gross_pay = models.PayrollCode.objects(company=computation.company, variable="gross_pay").first()
+    staff = models.Staff.objects(company=computation.company, staff_number="ENG1").first()
+    assert components[(str(staff.id), str(gross_pay.id))].value == Decimal("60000.50")
+    assert len(components) == 6
+    # repeated cells of older databases are dropped, keeping the first stored one
+    collection = models.ComputationComponent._get_collection()
+    assert models.ComputationComponent.has_unique_cells()
+    collection.drop_index("computation_1_payroll_component_1_staff_1")
+    assert not models.ComputationComponent.has_unique_cells()
+    first = collection.find_one({"computation": computation.id, "staff": staff.id, "payroll_component": gross_pay.id})
+    collection.insert_one({"computation": computation.id, "payroll_component": gross_pay.id, "staff": staff.id, "value": 1.0})
+    assert models.ComputationComponent.remove_duplicates() == 1
+    assert [document["_id"] for document in collection.find({"computation": computation.id, "staff": staff.id, "payroll_component": gross_pay.id})] == [first["_id"]]
+    models.ComputationComponent.ensure_indexes()
+    assert models.ComputationComponent.has_unique_cells()
+
+def test_import_job(db):
+    previous = create_payroll_company(3, datetime(2041, 4, 1))
+    computation = models.Computation(company=previous.company, payroll_period_start=previous.payroll_period_start, payroll_period_end=previous.payroll_period_end, generated_by=previous.generated_by)
+    computation.save()
+    staff_numbers = [staff.staff_number for staff in models.Staff.objects(company=computation.company).order_by("staff_number")]
+    header = "staff_number,gross_pay,pension_benefit,overtime\nStaff Number,Gross Pay,Pension Benefit,Overtime\n,,,\n"
+    invalid = header + f"{staff_numbers[0]},50000,n/a,1\nMISSING,60000,0,1\n{staff_numbers[0]},,0,1\n"
+    # every error of the sheet is collected, not only the first
+    chunk = next(utils.read_upload_chunks(io.BytesIO(invalid.encode()), "compensation.csv", skip_rows=2))
+    errors = computation.validate_compensation(chunk)
+    assert list(errors.columns) == models.IMPORT_ERROR_COLUMNS
+    assert errors[["row", "column"]].values.tolist() == [
+        [None, "overtime"], [5, "staff_number"], [6, "staff_number"], [4, "pension_benefit"], [6, "gross_pay"]
+    ]
+    job = jobs.submit_import_job("import_compensation", computation.company, computation.generated_by, io.BytesIO(invalid.encode()), "compensation.csv", computation)
+    assert jobs.process_next_job().id == job.id
+    job.reload()
+    assert job.status == "failed" and job.error_count == 5
+    assert job.error == "Found 5 errors in 3 rows of the file, see the error report"
+    report = pd.read_csv(job.error_report)
+    assert report["row"].fillna(0).astype(int).tolist() == [0, 4, 5, 6, 6]
+    assert "Staff with staff number MISSING not found" in report["message"].iloc[2]
+    assert not os.path.exists(job.upload_path)
+    assert models.ComputationComponent.objects(computation=computation).count() == 0
+    valid = "staff_number,gross_pay,pension_benefit\nStaff Number,Gross Pay,Pension Benefit\n,,\n" + "".join(f"{staff_number},50000,1000\n" for staff_number in staff_numbers)
+    job = jobs.submit_import_job("import_compensation", computation.company, computation.generated_by, io.BytesIO(valid.encode()), "compensation.csv", computation)
+    settings.import_chunk_size, chunk_size = 2, settings.import_chunk_size
+    try:
+        assert jobs.process_next_job().id == job.id
+    finally:
+        settings.import_chunk_size = chunk_size
+    job.reload()
+    assert job.status == "completed" and job.processed == job.total == 3
+    assert job.result == {"inserted": 6, "updated": 0, "unchanged": 0}
+    assert job.error_report is None
+    assert models.ComputationComponent.objects(computation=computation).count() == 6
+    shutil.rmtree(settings.import_dir)
+
+class WorkerDied(BaseException):
+    pass
+
+def test_recovered_import_job(db, monkeypatch):
+    company = models.Company(name=fake.company(), legal_name=fake.company(), pin_number="engine", contact_email=fake.company_email())
+    company.save()
+    rows = "".join(f"import.{index}@example.com,First,Last,import.{index}@example.com,P{index},IMP{index}\n" for index in range(5))
+    upload = "User Email,First Name,Last Name,Contact Email,PIN Number,Staff Number\n" + rows
+    job = jobs.submit_import_job("import_staff", company, models.User.objects.first(), io.BytesIO(upload.encode()), "staff.csv")
+    import_staff = models.Company.import_staff
+    calls = []
+    def failing_import(self, chunk, import_job=None):
+        calls.append(len(chunk))
+        if len(calls) == 2:
+            raise RuntimeError("connection reset")
+        staff = import_staff(self, chunk, import_job=import_job)
+        if len(calls) == 3:
+            # the worker dies after inserting the chunk, before writing its checkpoint
+            raise WorkerDied()
+        return staff
+    monkeypatch.setattr(models.Company, "import_staff", failing_import)
+    settings.import_chunk_size, chunk_size = 2, settings.import_chunk_size
+    try:
+        # a transient error requeues the job, keeping its upload and checkpoint
+        assert jobs.process_next_job().id == job.id
+        job.reload()
+        assert (job.status, job.checkpoint, job.params["resume"]) == ("queued", 2, True)
+        assert os.path.exists(job.upload_path)
+        # a worker dying mid import leaves the job running until it is recovered
+        with pytest.raises(WorkerDied):
+            jobs.process_next_job()
+        job.reload()
+        assert (job.status, job.checkpoint) == ("running", 2)
+        assert models.Staff.objects(company=company).count() == 4
+        models.Job.objects(id=job.id).update_one(set__heartbeat_at=datetime.utcnow() - timedelta(seconds=settings.job_stale_after_seconds + 1))
+        assert [job.id for job in jobs.recover_orphaned_runs()] == [job.id]
+        assert jobs.process_next_job().id == job.id
+    finally:
+        settings.import_chunk_size = chunk_size
+    job.reload()
+    assert job.status == "completed"
+    # the recovered job resumes after the staff it created, not at its checkpoint
+    assert calls == [2, 2, 2, 1]
+    assert (job.checkpoint, job.processed, job.total) == (5, 5, 5)
+    assert job.result == {"created": 5}
+    assert models.Staff.objects(company=company).count() == 5
+    assert not os.path.exists(job.upload_path)
+    shutil.rmtree(settings.import_dir)
+
+def test_read_upload_chunks():
+    rows = [["staff_number", "gross_pay"], ["Staff Number", "Gross Pay"], ["", ""]] + [[f"S{index}", index * 1_000] for index in range(7)]
+    csv_file = io.BytesIO("\n".join(",".join(str(value) for value in row) for row in rows[:3] + [[], *rows[3:]]).encode())
+    workbook = openpyxl.Workbook()
+    for row in rows[:3] + [[None, None]] + rows[3:]:
+        workbook.active.append(row)
+    xlsx_file = io.BytesIO()
+    workbook.save(xlsx_file)
+    xlsx_file.seek(0)
+    for file, filename in [(csv_file, "compensation.csv"), (xlsx_file, "compensation.xlsx")]:
+        chunks = list(utils.read_upload_chunks(file, filename, skip_rows=2, chunk_size=3))
+        assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+        assert list(chunks[0].columns) == ["staff_number", "gross_pay"]
+        # chunks are indexed by line, blank lines included
+        assert list(chunks[0].index) == [5, 6, 7]
+        assert chunks[2]["staff_number"].tolist() == ["S6"]
+        assert float(chunks[2]["gross_pay"].iloc[0]) == 6_000
+        assert not file.closed
+    with pytest.raises(ValueError, match="Sheet Staff Template not found"):
+        list(utils.read_upload_chunks(xlsx_file, "staff.xlsx", sheet_name="Staff Template"))
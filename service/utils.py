@@ -1,10 +1,13 @@
 import base64
+import csv
 import datetime
+import io
 import json
 from mimetypes import init
 import uuid
 import secrets
 import string
+import threading
 import nanoid
 from pydantic_settings import BaseSettings
 from pypdf import PdfReader, PdfWriter
@@ -12,7 +15,9 @@ import models
 import config
 from config import settings
 import requests
-from typing import Tuple
+from typing import Any, BinaryIO, Callable, Iterator, List, Optional, Sequence, Tuple
+import pandas as pd
+from openpyxl import load_workbook
 
 def initialize_master_company():
     master_company = models.Company.objects.filter(name="Master Company").first()
@@ -92,7 +97,42 @@ def mailtrap_send_email(to: Tuple[str,str], subject: str, message: str) -> bool:
     except Exception as e:
         raise e
 
+class Heartbeat:
+    """
+        Call beat every interval seconds from a daemon thread while the context is open,
+        so a long step without progress still shows that its process is alive
+    """
+    def __init__(self, beat: Callable[[], Any], interval: float):
+        self.beat = beat
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> "Heartbeat":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.beat()
+            except Exception as e:
+                config.logger.warning(f"Heartbeat failed: {e}")
+
 def initialize_db(settings: BaseSettings, is_test: bool = False):
+    # computation components are unique per cell, databases created before the unique index may hold
+    # repeated uploads, removed once so the index can be built
+    if not models.ComputationComponent.has_unique_cells():
+        removed = models.ComputationComponent.remove_duplicates()
+        if removed:
+            config.logger.info(f"Removed {removed} duplicate computation components")
+    # users without a phone collide on a unique phone index that is not sparse
+    if models.User.make_phone_index_sparse():
+        config.logger.info("Rebuilding the users' phone index as sparse")
     for model in config.DEFAULT_CONTENT_CLASSES:
         content_types = models.ContentType.objects.filter(model=model).all()
         if not content_types:
@@ -195,6 +235,55 @@ async def smsleopard_send_sms(phone: str, message: str) -> bool:
     except Exception as e:
         raise e
 
+def read_upload_chunks(file: BinaryIO, filename: str, sheet_name: Optional[str] = None, skip_rows: int = 0, chunk_size: Optional[int] = None) -> Iterator[pd.DataFrame]:
+    """
+        Stream the rows of an uploaded .xlsx or .csv file as DataFrames of at most chunk_size rows
+        Workbooks are read through openpyxl's read only row iterator and CSV files line by line,
+        so only one chunk is held in memory whatever the size of the file
+        The first row holds the column names, the skip_rows rows after it are dropped, as are rows without any value
+        Each chunk is indexed by the rows' line numbers in the file
+        Raises ValueError when the sheet is missing or the file cannot be read
+    """
+    chunk_size = chunk_size or settings.import_chunk_size
+    if filename.lower().endswith(".csv"):
+        text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+        try:
+            rows = ([value if value != "" else None for value in row] for row in csv.reader(text))
+            yield from _row_chunks(rows, skip_rows, chunk_size)
+        finally:
+            # leave the upload open for its owner
+            text.detach()
+        return
+    try:
+        workbook = load_workbook(file, read_only=True, data_only=True)
+    except Exception as e:
+        raise ValueError(f"The file could not be read as an Excel workbook: {e}")
+    try:
+        if sheet_name is not None and sheet_name not in workbook.sheetnames:
+            raise ValueError(f"Sheet {sheet_name} not found in the file")
+        sheet = workbook[sheet_name] if sheet_name is not None else workbook.active
+        yield from _row_chunks(sheet.iter_rows(values_only=True), skip_rows, chunk_size)
+    finally:
+        workbook.close()
+
+def _row_chunks(rows: Iterator[Sequence[Any]], skip_rows: int, chunk_size: int) -> Iterator[pd.DataFrame]:
+    header = next(rows, None)
+    if header is None:
+        return
+    columns = [str(name).strip() if name is not None else f"Unnamed: {index}" for index, name in enumerate(header)]
+    chunk: List[Sequence[Any]] = []
+    lines: List[int] = []
+    for line, row in enumerate(rows, start=2):
+        if line - 2 < skip_rows or all(value is None for value in row):
+            continue
+        chunk.append(list(row[:len(columns)]) + [None] * (len(columns) - len(row)))
+        lines.append(line)
+        if len(chunk) == chunk_size:
+            yield pd.DataFrame(chunk, columns=columns, index=lines)
+            chunk, lines = [], []
+    if chunk:
+        yield pd.DataFrame(chunk, columns=columns, index=lines)
+
 def add_password_to_pdf(input_pdf, output_pdf, password):
     reader = PdfReader(input_pdf)
     writer = PdfWriter()